@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+# Copyright (C) 2015 Shea G Craig <shea.craig@sas.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Benchmark phasetool against synthetic Munki repos.
+
+Generates repos of the requested sizes, runs each phasetool subcommand
+against them in a fresh process, and records the wall time and peak
+RSS of every run to a JSON results file. Pass a previous results file
+with --compare to see how a change affects each measurement.
+
+Example:
+    ./benchmark.py --sizes 1000 10000 --output before.json
+    ./benchmark.py --sizes 1000 10000 --compare before.json
+"""
+
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import phasetool
+
+
+PHASETOOL = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         "phasetool.py")
+# Relative weights of the catalogs generated pkginfos are placed in.
+CATALOG_WEIGHTS = (("production", 70), ("development", 2), ("testing", 10),
+                   ("phase1", 6), ("phase2", 6), ("phase3", 6))
+CATEGORIES = ("Productivity", "Security", "Utilities", "Developer Tools",
+              "Browsers", "Media")
+FORCE_DATE = "2011-08-03T13:00:00Z"
+# Megabytes of parse cache for the parse-cache scenarios.
+PARSE_CACHE_SIZE = 256
+
+
+def main():
+    """Generate repos, run the benchmarks and write results."""
+    args = build_argparser().parse_args()
+    workdir = args.workdir or tempfile.mkdtemp(prefix="phasetool-bench-")
+    results = []
+    try:
+        for size in args.sizes:
+            repo = os.path.join(workdir, "repo-{}".format(size))
+            if not os.path.exists(repo):
+                print "Generating {} pkginfos in {}...".format(size, repo)
+                # Linux carries a process's peak RSS across exec, so keep
+                # generation out of the process that spawns phasetool.
+                generator = multiprocessing.Process(
+                    target=generate_repo, args=(repo, size, args.seed,
+                                                args.placeholders,
+                                                args.corrupt))
+                generator.start()
+                generator.join()
+            for scenario, result in run_scenarios(repo, workdir, args.jobs):
+                result.update({"size": size, "scenario": scenario})
+                results.append(result)
+                print "{:>8} {:<24} {:>9.3f}s {:>9} KB".format(
+                    size, scenario, result["seconds"], result["peak_rss_kb"])
+    finally:
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir)
+
+    report = {"created": datetime.datetime.now().isoformat(),
+              "python": platform.python_version(),
+              "platform": platform.platform(), "jobs": args.jobs,
+              "results": results}
+    with open(args.output, "w") as results_file:
+        json.dump(report, results_file, indent=2, sort_keys=True)
+    print "Results written to {}".format(args.output)
+
+    if args.compare:
+        with open(args.compare) as previous_file:
+            compare(json.load(previous_file), report)
+
+
+def build_argparser():
+    """Create our argument parser."""
+    parser = argparse.ArgumentParser(description="Benchmark phasetool "
+                                     "against synthetic Munki repos.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000],
+                        help="Number of pkginfos to generate for each repo. "
+                        "Defaults to 1000.")
+    parser.add_argument("--jobs", type=int, default=4,
+                        help="Value of phasetool's --jobs for the parallel "
+                        "scenarios. Defaults to 4.")
+    parser.add_argument("--placeholders", type=float, default=0.01,
+                        help="Fraction of pkginfos that are placeholders.")
+    parser.add_argument("--corrupt", type=float, default=0.005,
+                        help="Fraction of pkginfos that are truncated.")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Random seed for repo generation.")
+    parser.add_argument("--workdir", help="Directory to generate repos in. "
+                        "Repos already present are reused and kept.")
+    parser.add_argument("--keep", action="store_true",
+                        help="Keep the generated repos.")
+    parser.add_argument("--output", default="bench_results.json",
+                        help="Path to write the JSON results to.")
+    parser.add_argument("--compare", help="Path to a previous results file "
+                        "to compare against.")
+    return parser
+
+
+def generate_repo(repo, size, seed=0, placeholders=0.01, corrupt=0.005):
+    """Write a synthetic Munki repo of size pkginfos, with catalogs.
+
+    Pkginfos are spread over category subdirectories, carry realistic
+    installs and receipts arrays, and are distributed over the
+    production and TESTING_CATALOGS catalogs by CATALOG_WEIGHTS.
+
+    Args:
+        repo (str): Path to create the repo at.
+        size (int): Number of pkginfo files to generate.
+        seed (int): Random seed, so repos are reproducible.
+        placeholders (float): Fraction of items named as placeholders.
+        corrupt (float): Fraction of pkginfo files to truncate. These
+            are left out of the catalogs.
+    """
+    rand = random.Random(seed)
+    catalogs = {"all": []}
+    for category in CATEGORIES:
+        os.makedirs(os.path.join(repo, "pkgsinfo", category))
+    os.makedirs(os.path.join(repo, "catalogs"))
+
+    for number in xrange(size):
+        pkginfo = make_pkginfo(rand, number, placeholders)
+        path = os.path.join(
+            repo, "pkgsinfo", pkginfo["category"], "{}-{}.pkginfo".format(
+                pkginfo["name"], pkginfo["version"]))
+        data = phasetool.PLIST_IO.dumps(pkginfo)
+        if rand.random() < corrupt:
+            data = data[:rand.randint(1, len(data) - 1)]
+        else:
+            entry = phasetool.make_catalog_entry(pkginfo)
+            catalogs["all"].append(entry)
+            for catalog in pkginfo["catalogs"]:
+                catalogs.setdefault(catalog, []).append(entry)
+        with open(path, "w") as pkginfo_file:
+            pkginfo_file.write(data)
+
+    for catalog, entries in catalogs.items():
+        path = os.path.join(repo, "catalogs", catalog)
+        with open(path, "w") as catalog_file:
+            catalog_file.write(phasetool.PLIST_IO.dumps(entries))
+
+
+def make_pkginfo(rand, number, placeholders):
+    """Return a random, realistically sized pkginfo dict."""
+    name = "{}App{}".format(
+        "Placeholder" if rand.random() < placeholders else "", number)
+    version = "{}.{}.{}".format(rand.randint(0, 20), rand.randint(0, 9),
+                                rand.randint(0, 99))
+    bundle_id = "com.example.{}".format(name.lower())
+    installs = [{"CFBundleIdentifier": "{}.{}".format(bundle_id, index),
+                 "CFBundleName": name,
+                 "CFBundleShortVersionString": version,
+                 "CFBundleVersion": version,
+                 "minosversion": "10.9",
+                 "path": "/Applications/{}.app/Contents/Helpers/{}.app".format(
+                     name, index),
+                 "type": "application",
+                 "version_comparison_key": "CFBundleShortVersionString"}
+                for index in xrange(rand.randint(1, 8))]
+    receipts = [{"installed_size": rand.randint(100, 500000),
+                 "packageid": "{}.pkg{}".format(bundle_id, index),
+                 "version": version}
+                for index in xrange(rand.randint(1, 6))]
+    return {
+        "_metadata": {"created_by": "benchmark",
+                      "creation_date": datetime.datetime(2015, 11, 1),
+                      "munki_version": "2.3.1"},
+        "autoremove": False,
+        "catalogs": [weighted_choice(rand, CATALOG_WEIGHTS)],
+        "category": rand.choice(CATEGORIES),
+        "description": "Synthetic item {} for benchmarking. ".format(
+            number) * rand.randint(1, 5),
+        "display_name": "App {}".format(number),
+        "installed_size": sum(receipt["installed_size"] for receipt in
+                              receipts),
+        "installer_item_hash": "{:064x}".format(rand.getrandbits(256)),
+        "installer_item_location": "apps/{}-{}.pkg".format(name, version),
+        "installer_item_size": rand.randint(100, 500000),
+        "installs": installs,
+        "minimum_os_version": "10.9.0",
+        "name": name,
+        "postinstall_script": "#!/bin/sh\n" + "echo configuring\n" *
+                              rand.randint(0, 200),
+        "receipts": receipts,
+        "unattended_install": rand.random() < 0.5,
+        "uninstall_method": "removepackages",
+        "uninstallable": True,
+        "version": version}
+
+
+def weighted_choice(rand, weights):
+    """Return a choice from a sequence of (choice, weight) tuples."""
+    point = rand.uniform(0, sum(weight for _, weight in weights))
+    for choice, weight in weights:
+        point -= weight
+        if point <= 0:
+            return choice
+    return weights[-1][0]
+
+
+def run_scenarios(repo, workdir, jobs):
+    """Run each phasetool subcommand against repo.
+
+    The mutating scenarios run last, against the testing items found
+    by collect, so that earlier scenarios see the generated repo. The
+    parse cache is off except in the parse-cache scenarios, where a
+    collect fills an empty cache and a prepare then reads from it.
+
+    Yields:
+        Tuples of (scenario name, result dict).
+    """
+    cache_dir = os.path.join(workdir, "cache-{}".format(
+        os.path.basename(repo)))
+    output_dir = os.path.join(workdir, "output")
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.makedirs(output_dir)
+    base = ["--repo", repo, "--cache-dir", cache_dir]
+    parallel = base + ["--jobs", str(jobs)]
+    cached = base + ["--parse-cache-size", str(PARSE_CACHE_SIZE)]
+
+    scenarios = (
+        ("collect", base + ["collect", output_dir]),
+        ("collect-jobs", parallel + ["collect", output_dir]),
+        ("collect-index-cold", base + ["collect", "--index", output_dir]),
+        ("collect-index-warm", base + ["collect", "--index", output_dir]),
+        ("collect-from-catalogs",
+         base + ["collect", "--from-catalogs", output_dir]))
+    for scenario, args in scenarios:
+        yield scenario, run_phasetool(args)
+
+    path_list = sorted(
+        filename for filename in os.listdir(output_dir) if
+        filename.endswith("-phase_testing_files.txt"))[-1]
+    path_list = os.path.join(output_dir, path_list)
+    scenarios = (
+        ("collect-parse-cache-cold", cached + ["collect", output_dir]),
+        ("prepare-parse-cache-warm",
+         cached + ["prepare", FORCE_DATE, "phase3", path_list]),
+        ("prepare", base + ["prepare", FORCE_DATE, "phase1", path_list]),
+        ("prepare-unchanged",
+         base + ["prepare", FORCE_DATE, "phase1", path_list]),
+        ("prepare-jobs", parallel + ["prepare", FORCE_DATE, "phase2",
+                                     path_list]),
+        ("release", parallel + ["release", FORCE_DATE, path_list]),
+        ("release-update-catalogs",
+         parallel + ["release", "--update-catalogs", "", path_list]),
+        ("bulk", parallel + ["bulk", "developer", "Benchmark", path_list]))
+    for scenario, args in scenarios:
+        yield scenario, run_phasetool(args)
+
+
+def run_phasetool(args):
+    """Run phasetool with args in a new process and measure it.
+
+    Returns:
+        Dict with the run's wall time in seconds, peak RSS in KB and
+        return code.
+    """
+    start = time.time()
+    with open(os.devnull, "w") as devnull:
+        process = subprocess.Popen([sys.executable, PHASETOOL] + args,
+                                   stdout=devnull)
+        _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.time() - start
+    peak_rss = usage.ru_maxrss
+    if sys.platform == "darwin":
+        # Darwin reports bytes; Linux reports kilobytes.
+        peak_rss /= 1024
+    return {"seconds": seconds, "peak_rss_kb": peak_rss,
+            "returncode": os.WEXITSTATUS(status)}
+
+
+def compare(previous, current):
+    """Print the change in time and memory for each common run."""
+    previous_results = {(result["size"], result["scenario"]): result for
+                        result in previous["results"]}
+    print "\nChange from {}:".format(previous["created"])
+    for result in current["results"]:
+        key = (result["size"], result["scenario"])
+        if key not in previous_results:
+            continue
+        old = previous_results[key]
+        print "{:>8} {:<24} time {:>+7.1%} rss {:>+7.1%}".format(
+            key[0], key[1], relative_change(old["seconds"], result["seconds"]),
+            relative_change(old["peak_rss_kb"], result["peak_rss_kb"]))
+
+
+def relative_change(old, new):
+    """Return the change from old to new as a fraction of old."""
+    return float(new - old) / old if old else 0.0
+
+
+if __name__ == "__main__":
+    main()
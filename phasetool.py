@@ -23,36 +23,238 @@ and unattended_install value of False.
 
 
 import argparse
+import base64
+import collections
+import cPickle
+import contextlib
 import datetime
+import difflib
+import errno
+import functools
+import hashlib
+import heapq
+import itertools
+import json
+import operator
 import os
-import subprocess
+import re
+import shutil
+import StringIO
 import sys
+import threading
+import time
+import traceback
+from xml.parsers import expat
 from xml.parsers.expat import ExpatError
 
-try:
-    import mount_shares_better
-except ImportError:
-    mount_shares_better = None
 
-try:
-    sys.path.append("/usr/local/munki/munkilib")
-    import FoundationPlist as plistlib
-except ImportError:
-    import plistlib
+class LazyModule(object):
+    """Stands in for a module that is only imported on first use.
+
+    phasetool runs many times a day from cron and automation, so
+    modules that only some subcommands need are not imported up front.
+    The first of the candidate module names that imports successfully
+    is used. If none do, the proxy is false and attribute access raises
+    AttributeError, like the None stand-in used for missing optional
+    modules.
+    """
+
+    def __init__(self, *names, **kwargs):
+        """Set up the proxy.
+
+        Args:
+            names (str): Module names to try, in order.
+            path (str): Optional directory to add to sys.path first.
+        """
+        self._names = names
+        self._path = kwargs.get("path")
+        self._module = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _load(self):
+        """Import the module if needed and return it, or None."""
+        with self._lock:
+            if not self._loaded:
+                if self._path and self._path not in sys.path:
+                    sys.path.append(self._path)
+                for name in self._names:
+                    try:
+                        __import__(name)
+                    except ImportError:
+                        continue
+                    self._module = sys.modules[name]
+                    break
+                self._loaded = True
+        return self._module
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        module = self._load()
+        if module is None:
+            raise AttributeError("No module named {}".format(
+                " or ".join(self._names)))
+        return getattr(module, name)
+
+    def __nonzero__(self):
+        return self._load() is not None
+
+
+# pylint: disable=invalid-name
+multiprocessing = LazyModule("multiprocessing")
+multiprocessing_pool = LazyModule("multiprocessing.pool")
+multiprocessing_util = LazyModule("multiprocessing.util")
+socket = LazyModule("socket")
+SocketServer = LazyModule("SocketServer")
+sqlite3 = LazyModule("sqlite3")
+subprocess = LazyModule("subprocess")
+mount_shares_better = LazyModule("mount_shares_better")
+pyinotify = LazyModule("pyinotify")
+scheduler = LazyModule("scheduler")
+stdlib_plistlib = LazyModule("plistlib")
+# pylint: enable=invalid-name
 
 
 # TODO: Get this from Munki preferences.
 PKGINFO_EXTENSIONS = (".pkginfo", ".plist")
 # TODO (Shea): this should be a preference.
 TESTING_CATALOGS = {"development", "testing", "phase1", "phase2", "phase3"}
+# Bit of each of TESTING_CATALOGS in a PkginfoRecord's catalog_mask.
+CATALOG_BITS = collections.OrderedDict(
+    (catalog, 1 << bit) for bit, catalog in enumerate(sorted(
+        TESTING_CATALOGS)))
+# The only pkginfo keys collect needs.
+COLLECT_KEYS = ("name", "display_name", "version", "catalogs")
+DEFAULT_CACHE_DIR = "~/Library/Caches/phasetool"
+INDEX_FILENAME = "pkginfo_index.sqlite"
+# Written to collect's output_path by --since-last.
+SNAPSHOT_FILENAME = "phase_testing_snapshot.plist"
+HASH_READ_SIZE = 1024 * 1024
+MUNKIIMPORT_PREFS = (
+    "~/Library/Preferences/com.googlecode.munki.munkiimport.plist")
+# Strings shared between PkginfoRecords, by value.
+_INTERNED_STRINGS = {}
+# Number of strings to share before starting over, so a long-running
+# serve doesn't keep the values of long-gone pkginfos.
+INTERNED_STRINGS_LIMIT = 64 * 1024
+# Number of paths handed to a parse worker at a time.
+PARSE_CHUNKSIZE = 16
+# Bytes fed to the partial plist reader per read.
+PARTIAL_READ_SIZE = 64 * 1024
+# Bytes of a catalog the CatalogReader reads and parses at a time.
+CATALOG_READ_SIZE = 1024 * 1024
+PLIST_DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+# Keys a pkginfo must have before prepare, release or bulk change it.
+REQUIRED_PKGINFO_KEYS = ("name", "version", "catalogs")
+# Keys of a group of edits in a bulk --spec.
+EDIT_SPEC_KEYS = ("set", "remove", "if")
+# Per-file outcomes of a batch of pkginfo mutations, in report order.
+MUTATION_STATUSES = ("changed", "unchanged", "missing", "invalid", "failed")
+# Outcomes that stop a validated batch from changing anything.
+PROBLEM_STATUSES = ("missing", "invalid", "failed")
+JOURNAL_DIRNAME = "journal"
+JOURNAL_MANIFEST = "manifest.plist"
+# Staged pkginfo writes are named ".<filename>.<batch id><TEMP_SUFFIX>".
+TEMP_SUFFIX = ".phasetool-tmp"
+SOCKET_FILENAME = "phasetool.sock"
+QUERY_INDEX_FILENAME = "query_index.sqlite"
+# Pkginfo keys the query index stores; queries on other keys parse
+# every pkginfo.
+QUERY_INDEX_KEYS = (
+    "autoremove", "blocking_applications", "catalogs", "category",
+    "developer", "display_name", "force_install_after_date",
+    "installer_type", "maximum_os_version", "minimum_os_version", "name",
+    "requires", "unattended_install", "unattended_uninstall", "update_for",
+    "version")
+QUERY_DATE_FORMATS = ("%Y-%m-%dT%H:%M:%SZ", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d")
+QUERY_TOKENS = re.compile(r"""
+    \s*(?:
+    (?P<paren>[()])
+    | (?P<operator>==|!=|<=|>=|<|>)
+    | "(?P<double_quoted>(?:[^"\\]|\\.)*)"
+    | '(?P<single_quoted>[^']*)'
+    | (?P<word>[^\s()<>=!"']+)
+    )""", re.VERBOSE)
+COMPARISON_OPERATORS = {"==": "=", "!=": "!=", "<": "<", "<=": "<=",
+                        ">": ">", ">=": ">="}
+STRING_OPERATORS = ("contains", "startswith", "endswith")
+# Keys whose string values queries compare as versions.
+VERSION_KEYS = ("version", "minimum_os_version", "maximum_os_version")
+# Splits versions as distutils' LooseVersion does; text between
+# matches, other than ".", is a component too.
+VERSION_COMPONENTS = re.compile(r"(\d+|[a-z]+|\.)")
+# Parsed version keys, by version string.
+_VERSION_KEY_CACHE = {}
+# Numbers this process's PkginfoWriter batches, as serve runs many.
+_BATCH_NUMBERS = itertools.count(1)
+BINARY_PLIST_HEADER = "bplist00"
+MOUNT_CACHE_FILENAME = "mounts.plist"
+# Default seconds to wait for a mount point to respond, or to mount.
+MOUNT_TIMEOUT = 5
+# Errors from stat that indicate a dead network mount.
+STALE_MOUNT_ERRNOS = {errno.ESTALE, errno.EIO, errno.ENOTCONN,
+                      errno.EHOSTDOWN, errno.ETIMEDOUT}
+# Filesystem types inotify can't see remote changes on.
+NETWORK_FILESYSTEMS = {"afpfs", "smbfs", "cifs", "nfs", "nfs4", "webdav",
+                       "fuse.sshfs"}
+SCHEDULE_FILENAME = "schedule.sqlite"
+PARSE_CACHE_FILENAME = "parse_cache.sqlite"
+# Bytes of pickled plists each process keeps in memory.
+PARSE_CACHE_MEMORY_BYTES = 64 * 1024 * 1024
+PARSE_CACHE_STATS = ("hits", "misses", "evictions")
+# Global options that set up the process running phasetool, so that
+# phasetool serve can't apply them to a request sent with --socket.
+SERVER_LOCAL_OPTIONS = ("--repo", "--repo_url", "--profile", "--cprofile",
+                        "--plist-backend", "--binary-cache",
+                        "--parse-cache-size")
 
 
 def main():
     """Build and parse args, and then kick-off action function."""
     parser = build_argparser()
     args = parser.parse_args()
-    args.repo = get_munki_repo(args)
-    args.func(args)
+    if args.socket and args.func is not serve:
+        try:
+            check_sendable(parser, args)
+        except PhasetoolError as error:
+            print >> sys.stderr, error
+            sys.exit(1)
+        status = send_request(args.socket, sys.argv[1:])
+        sys.exit(1 if status is None else status)
+    try:
+        PLIST_IO.configure(args.plist_backend, args.binary_cache)
+    except PhasetoolError as error:
+        print >> sys.stderr, error
+        sys.exit(1)
+    if args.parse_cache_size > 0:
+        PARSE_CACHE.configure(
+            get_cache_path(args.cache_dir, PARSE_CACHE_FILENAME),
+            int(args.parse_cache_size * 1024 * 1024))
+    if args.profile or args.cprofile:
+        PROFILER.enable(args.profile_slowest)
+    try:
+        with PROFILER.stage("find repo"):
+            try:
+                args.repo = get_munki_repo(args)
+            except PhasetoolError as error:
+                print >> sys.stderr, error
+                sys.exit(1)
+        with PROFILER.stage(args.func.__name__):
+            if args.cprofile:
+                import cProfile
+                profile = cProfile.Profile()
+                try:
+                    profile.runcall(args.func, args)
+                finally:
+                    profile.dump_stats(args.cprofile)
+            else:
+                args.func(args)
+    finally:
+        PARSE_CACHE.close()
+        if args.profile:
+            PROFILER.print_summary()
+            PROFILER.write_report(args.profile)
 
 
 def build_argparser():
@@ -66,6 +268,54 @@ def build_argparser():
                         "munkiimport's configured repo if not specified.")
     parser.add_argument("-u", "--repo_url", help="Full mount URL to Munki "
                         "repo. Will attempt to mount if the share is missing.")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR,
+                        help="Directory for phasetool's cache and index "
+                        "files. Defaults to '{}'.".format(DEFAULT_CACHE_DIR))
+    parser.add_argument("--mount-timeout", type=float, default=MOUNT_TIMEOUT,
+                        metavar="SECONDS", help="Seconds to wait for the "
+                        "repo's mount point to respond, and for the repo to "
+                        "mount, before giving up. Defaults to {}.".format(
+                            MOUNT_TIMEOUT))
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of parallel workers: processes for "
+                        "parsing pkginfo files during collect, and threads "
+                        "for reading and writing pkginfo files during "
+                        "prepare, release and bulk. Defaults to 1.")
+    parser.add_argument("--profile", metavar="REPORT_PATH",
+                        help="Time each stage of the run, count files and "
+                        "bytes read and written, and find the slowest files. "
+                        "Prints a summary and writes a JSON report to "
+                        "REPORT_PATH.")
+    parser.add_argument("--profile-slowest", type=int, default=10,
+                        metavar="N", help="Number of slowest files to "
+                        "report with --profile. Defaults to 10.")
+    parser.add_argument("--cprofile", metavar="STATS_PATH",
+                        help="Run the subcommand under cProfile and dump "
+                        "the stats to STATS_PATH.")
+    parser.add_argument("--plist-backend", default="auto",
+                        choices=("auto", "foundation", "stdlib", "biplist"),
+                        help="Library to read and write plists with: "
+                        "Munki's FoundationPlist, Python's plistlib, or "
+                        "biplist. 'auto', the default, picks the fastest "
+                        "one installed.")
+    parser.add_argument("--binary-cache", action="store_true",
+                        help="Write phasetool's own plist files (the mount "
+                        "cache, journal manifests and collect snapshots) as "
+                        "binary plists. Requires biplist. Pkginfos and "
+                        "catalogs are always written as XML.")
+    parser.add_argument("--parse-cache-size", type=float, default=0,
+                        metavar="MB",
+                        help="Megabytes of parsed plists to keep in the "
+                        "cache dir (e.g. 256), so that files unchanged since "
+                        "a previous run (e.g. collect followed by prepare) "
+                        "are not parsed again. With the cache on, collect "
+                        "parses testing pkginfos in full to cache them. "
+                        "Defaults to 0, which disables the cache.")
+    parser.add_argument("--socket", metavar="SOCKET_PATH",
+                        help="Send the subcommand to the 'phasetool serve' "
+                        "daemon listening on SOCKET_PATH rather than running "
+                        "it here. For serve, the path to listen on; defaults "
+                        "to '{}' in the cache dir.".format(SOCKET_FILENAME))
 
     subparser = parser.add_subparsers(help="Sub-command help")
 
@@ -77,6 +327,41 @@ def build_argparser():
     collect_parser.set_defaults(func=collect)
     phelp = "Path to save output files."
     collect_parser.add_argument("output_path", help=phelp)
+    source_group = collect_parser.add_mutually_exclusive_group()
+    phelp = ("Use a persistent index of pkginfo files stored in the cache "
+             "dir. Only files whose modification time or size changed "
+             "since the last indexed run are parsed.")
+    source_group.add_argument("-i", "--index", action="store_true",
+                              help=phelp)
+    phelp = ("Build the listing from the repo's compiled testing catalogs "
+             "rather than from every pkginfo file. Catalogs must be current "
+             "(i.e. run makecatalogs first).")
+    source_group.add_argument("--from-catalogs", action="store_true",
+                              help=phelp)
+    phelp = ("List only the highest version of each item name, comparing "
+             "versions as Munki does.")
+    collect_parser.add_argument("--latest", action="store_true", help=phelp)
+    phelp = ("Only list items added or changed since the last --since-last "
+             "run, and print the added, changed and removed paths. A "
+             "snapshot of the listed items is kept in output_path; files "
+             "whose modification time and size are unchanged are not "
+             "re-hashed.")
+    collect_parser.add_argument("--since-last", action="store_true",
+                                help=phelp)
+
+    # query subcommand
+    phelp = ("Print the path of every pkginfo matching an expression, "
+             "answered from a persistent index of pkginfo values stored in "
+             "the cache dir.")
+    query_parser = subparser.add_parser("query", help=phelp)
+    phelp = ("Expression to match, e.g. 'catalogs contains phase2 and name "
+             "startswith Office and force_install_after_date < 2026-11-01'. "
+             "Compare keys with ==, !=, <, <=, >, >=, contains, startswith "
+             "or endswith, and combine comparisons with and, or, not and "
+             "parentheses. Quote values containing spaces. Comparisons with "
+             "list values match if any item matches.")
+    query_parser.add_argument("expression", help=phelp, nargs="+")
+    query_parser.set_defaults(func=query)
 
     # Prepare arguments
     phelp = ("Set the force_install_after_date and unattended_install value "
@@ -113,37 +398,626 @@ def build_argparser():
     release_parser.set_defaults(func=release)
 
     # bulk subcommand
-    phelp = "Set a top-level key on any number of pkginfo files."
+    phelp = ("Set or remove top-level keys on any number of pkginfo files, "
+             "reading and writing each file once.")
     bulk_parser = subparser.add_parser("bulk", help=phelp)
-    phelp = "Key to set."
-    bulk_parser.add_argument("key", help=phelp)
+    phelp = "Key to set. Leave out when using --set, --remove or --spec."
+    bulk_parser.add_argument("key", help=phelp, nargs="?")
     phelp = "Value to set on key, or '-' (literal hyphen) to remove the key."
-    bulk_parser.add_argument("val", help=phelp)
+    bulk_parser.add_argument("val", help=phelp, nargs="?")
+    phelp = ("Set KEY to VALUE. VALUE is a string unless given as TYPE:value, "
+             "where TYPE is one of string, bool, int, real, date (e.g. "
+             "date:2011-08-03T13:00:00Z), list (comma separated strings, or "
+             "a JSON array) or dict (a JSON object). May be repeated.")
+    bulk_parser.add_argument("--set", dest="set_values", action="append",
+                             metavar="KEY=VALUE", default=[], help=phelp)
+    phelp = "Remove KEY. May be repeated."
+    bulk_parser.add_argument("--remove", action="append", metavar="KEY",
+                             default=[], help=phelp)
+    phelp = ("Path to a plist of edits: an array of dicts with any of a "
+             "'set' dict of keys and values, a 'remove' array of keys, and "
+             "an 'if' query expression (see 'query') limiting the dict's "
+             "edits to matching pkginfo files. Values keep their plist "
+             "types.")
+    bulk_parser.add_argument("--spec", metavar="SPEC_PATH", help=phelp)
+    phelp = ("Only edit pkginfo files matching this query expression (see "
+             "'query'), tested against each file as it is read.")
+    bulk_parser.add_argument("--if", dest="condition", metavar="EXPRESSION",
+                             help=phelp)
     phelp = ("Any number of paths to pkginfo files to update, or a path to a "
              "file to use for input. Format should have one path per line, "
              "with comments allowed.")
     bulk_parser.add_argument("pkginfo", help=phelp, nargs="*")
     bulk_parser.set_defaults(func=bulk)
 
+    # schedule subcommand
+    phelp = ("Move pkginfo files through the phases on a rolling schedule "
+             "of their own, kept in the cache dir.")
+    schedule_parser = subparser.add_parser("schedule", help=phelp)
+    schedule_subparser = schedule_parser.add_subparsers(
+        help="Schedule action help")
+    phelp = "Add pkginfo files to the schedule."
+    schedule_add_parser = schedule_subparser.add_parser("add", help=phelp)
+    phelp = ("Day to start phase testing the pkginfo files on, as "
+             "'yyyy-mm-dd'. Defaults to today.")
+    schedule_add_parser.add_argument("--start", help=phelp)
+    phelp = ("Any number of paths to pkginfo files to add, or a path to a "
+             "file to use for input. Format should have one path per line, "
+             "with comments allowed.")
+    schedule_add_parser.add_argument("pkginfo", help=phelp, nargs="*")
+    schedule_add_parser.set_defaults(func=schedule, action="add")
+    phelp = ("Move every scheduled pkginfo that is due into its next phase, "
+             "setting its catalog, force_install_after_date and "
+             "unattended_install as prepare and release do.")
+    schedule_tick_parser = schedule_subparser.add_parser("tick", help=phelp)
+    phelp = ("Day to tick the schedule for, as 'yyyy-mm-dd'. Defaults to "
+             "today.")
+    schedule_tick_parser.add_argument("--date", help=phelp)
+    schedule_tick_parser.set_defaults(func=schedule, action="tick")
+    phelp = "Print each scheduled pkginfo's phase and next phase change."
+    schedule_status_parser = schedule_subparser.add_parser("status",
+                                                           help=phelp)
+    schedule_status_parser.set_defaults(func=schedule, action="status")
+
+    phelp = ("After changing pkginfo files, update their entries in the "
+             "repo's catalogs rather than needing a full makecatalogs run.")
+    for mutation_parser in (prepare_parser, release_parser, bulk_parser,
+                            schedule_tick_parser):
+        mutation_parser.add_argument("--update-catalogs", action="store_true",
+                                     help=phelp)
+    phelp = ("Only change pkginfo files matching this query expression (see "
+             "'query'). Without pkginfo paths, every matching pkginfo in "
+             "the repo is changed.")
+    for mutation_parser in (prepare_parser, release_parser, bulk_parser,
+                            schedule_add_parser):
+        mutation_parser.add_argument("--where", metavar="EXPRESSION",
+                                     help=phelp)
+    phelp = ("Print a unified diff of each top-level key that would change "
+             "in each pkginfo file, without writing anything.")
+    for mutation_parser in (prepare_parser, release_parser, bulk_parser,
+                            schedule_tick_parser):
+        mutation_parser.add_argument("--dry-run", action="store_true",
+                                     help=phelp)
+
+    # journal subcommand
+    phelp = ("Recover from an interrupted prepare, release or bulk run. "
+             "Each run journals the original pkginfo files to the cache dir "
+             "until all of its writes are committed.")
+    journal_parser = subparser.add_parser("journal", help=phelp)
+    phelp = ("'list' the journals of interrupted runs, 'resume' committing "
+             "the writes an interrupted run had staged, or 'rollback' an "
+             "interrupted run's pkginfo files to their original content.")
+    journal_parser.add_argument("action", help=phelp,
+                                choices=("list", "resume", "rollback"))
+    phelp = "Journal to resume or rollback, as shown by 'list'."
+    journal_parser.add_argument("journal_id", help=phelp, nargs="?")
+    journal_parser.set_defaults(func=journal)
+
+    # cache subcommand
+    phelp = "Inspect or clear the cache of parsed plists."
+    cache_parser = subparser.add_parser("cache", help=phelp)
+    phelp = ("Print the cache's 'stats' (hits, misses and evictions since "
+             "it was last cleared, and its current entries and size), or "
+             "'clear' it.")
+    cache_parser.add_argument("action", help=phelp,
+                              choices=("stats", "clear"))
+    cache_parser.set_defaults(func=cache)
+
+    # serve subcommand
+    phelp = ("Mount the repo and load its pkginfo files once, keep them "
+             "current as files change, and answer collect, prepare, release "
+             "and bulk requests sent with --socket until interrupted.")
+    serve_parser = subparser.add_parser("serve", help=phelp)
+    phelp = ("How to notice changed pkginfo files: 'inotify' (requires "
+             "pyinotify, and only sees local changes), 'poll' to re-stat the "
+             "repo periodically, or 'auto' to use inotify unless it is "
+             "unavailable or the repo is on a network mount.")
+    serve_parser.add_argument("--watch", help=phelp, default="auto",
+                              choices=("auto", "inotify", "poll"))
+    phelp = "Seconds between polls of the repo. Defaults to 30."
+    serve_parser.add_argument("--poll-interval", help=phelp, type=float,
+                              default=30)
+    serve_parser.set_defaults(func=serve)
+
     return parser
 
 
 def get_munki_repo(args):
-    """Use cli arg for repo, otherwise, get from munkiimport prefs."""
-    prefs = read_plist(
-        "~/Library/Preferences/com.googlecode.munki.munkiimport.plist")
-    repo = args.repo if args.repo else prefs.get("repo_path")
-    repo_url = args.repo_url if args.repo_url else prefs.get("repo_url")
+    """Use cli arg for repo, otherwise, get from munkiimport prefs.
 
-    if not is_mounted(repo):
-        repo = mount(repo_url)
+    The prefs are only read for values not given as args, so phasetool
+    can run on machines without munkiimport configured.
 
+    The repo path, and where the repo was last found, are probed
+    concurrently, with a timeout, so a stale network mount can't hang
+    the run. The repo is mounted only if neither responds, and where it
+    was found is cached in the cache dir for the next run.
+
+    Raises:
+        PhasetoolError if the repo can't be found or mounted in time.
+    """
+    repo = args.repo if args.repo else get_munkiimport_prefs().get(
+        "repo_path")
+    timeout = getattr(args, "mount_timeout", MOUNT_TIMEOUT)
+    cache_path = None
+    cache = {}
+    if getattr(args, "cache_dir", None):
+        cache_path = get_cache_path(args.cache_dir, MOUNT_CACHE_FILENAME)
+        cache = read_mount_cache(cache_path)
+    cache_key = args.repo_url or repo
+
+    candidates = [candidate for candidate in (repo, cache.get(cache_key))
+                  if candidate]
+    statuses = probe_mounts(candidates, timeout)
+    for candidate in candidates:
+        if statuses[candidate] == "mounted":
+            repo = candidate
+            break
+        elif statuses[candidate] == "stale":
+            print >> sys.stderr, (
+                "Warning: {} is not responding; it may be a stale "
+                "mount.".format(candidate))
+    else:
+        repo_url = args.repo_url if args.repo_url else (
+            get_munkiimport_prefs().get("repo_url"))
+        if not repo_url:
+            raise PhasetoolError(
+                "The repo at {} is unavailable, and no repo URL is "
+                "configured to mount it from.".format(repo))
+        repo = call_with_timeout(timeout, "mounting {}".format(repo_url),
+                                 mount, repo_url)
+        if not repo:
+            raise PhasetoolError("Unable to mount {}.".format(repo_url))
+
+    if cache_path and cache.get(cache_key) != repo:
+        cache[cache_key] = repo
+        write_file_atomically(PLIST_IO.dumps_cache(cache), cache_path)
     return repo
 
 
+def probe_mounts(paths, timeout=MOUNT_TIMEOUT):
+    """Stat paths concurrently, giving up on those that take too long.
+
+    Args:
+        paths (list of str): Paths to probe.
+        timeout (float): Seconds to wait for all of the probes.
+
+    Returns:
+        Dict of path: "mounted", "missing", or "stale" for paths that
+        didn't respond in time or failed with STALE_MOUNT_ERRNOS.
+    """
+    statuses = {}
+
+    def probe(path):
+        """Record the status of one path."""
+        try:
+            os.stat(path)
+            statuses[path] = "mounted"
+        except OSError as error:
+            statuses[path] = ("stale" if error.errno in STALE_MOUNT_ERRNOS
+                              else "missing")
+
+    threads = []
+    for path in paths:
+        # A probe hung on a dead mount must not keep phasetool alive.
+        thread = threading.Thread(target=probe, args=(path,))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    deadline = time.time() + timeout
+    for thread in threads:
+        thread.join(max(0, deadline - time.time()))
+    return {path: statuses.get(path, "stale") for path in paths}
+
+
+def call_with_timeout(timeout, description, func, *args):
+    """Return func(*args), raising PhasetoolError if it takes too long.
+
+    func runs on a daemon thread, which is abandoned on timeout.
+    Description names what func does for the error message.
+    """
+    result = {}
+
+    def run():
+        """Call func, keeping its result or exception."""
+        try:
+            result["value"] = func(*args)
+        except Exception:  # pylint: disable=broad-except
+            result["error"] = sys.exc_info()
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        raise PhasetoolError("Gave up on {} after {:g} seconds.".format(
+            description, timeout))
+    if "error" in result:
+        raise result["error"][0], result["error"][1], result["error"][2]
+    return result.get("value")
+
+
+def read_mount_cache(path):
+    """Return the cached repo locations at path, or an empty dict."""
+    try:
+        return read_plist(path)
+    except (IOError, ExpatError):
+        return {}
+
+
+def get_munkiimport_prefs():
+    """Return munkiimport's prefs, or an empty dict if there are none."""
+    try:
+        return read_plist(MUNKIIMPORT_PREFS)
+    except IOError:
+        return {}
+
+
 def read_plist(path):
-    """Read the plist at path."""
-    return plistlib.readPlist(os.path.expanduser(path))
+    """Read the plist at path.
+
+    Unchanged files already in PARSE_CACHE are not parsed again.
+    """
+    path = os.path.expanduser(path)
+    with PROFILER.file("read plist", path) as record, \
+            open(path, "rb") as plist_file:
+        key = ParseCache.get_key(os.fstat(plist_file.fileno()))
+        plist = PARSE_CACHE.get(key)
+        if plist is not None:
+            return plist
+        data = plist_file.read()
+        record.bytes_read = len(data)
+    plist = PLIST_IO.loads(data)
+    PARSE_CACHE.put(key, plist)
+    return plist
+
+
+class PlistReadError(ExpatError):
+    """A plist backend could not parse its input.
+
+    Subclasses ExpatError, which the stdlib backend raises, so callers
+    handle a bad plist the same way whichever backend read it.
+    """
+    pass
+
+
+class PlistCodec(object):
+    """Reads and writes plists with the stdlib plistlib.
+
+    Subclasses wrap the other backends PlistIO chooses between.
+    """
+
+    name = "stdlib"
+    module_names = ("plistlib",)
+    module_path = None
+    reads_binary = False
+    writes_binary = False
+
+    def __init__(self):
+        self.module = LazyModule(*self.module_names, path=self.module_path)
+
+    def is_available(self):
+        """Return whether the backend can be imported."""
+        return bool(self.module)
+
+    def loads(self, data):
+        """Return the plist object serialized in data."""
+        return self.module.readPlistFromString(data)
+
+    def dumps(self, plist, binary=False):  # pylint: disable=unused-argument
+        """Return plist serialized, as a binary plist if binary."""
+        return self.module.writePlistToString(plist)
+
+
+class FoundationPlistCodec(PlistCodec):
+    """Reads and writes plists with Munki's FoundationPlist (PyObjC)."""
+
+    name = "foundation"
+    module_names = ("FoundationPlist",)
+    module_path = "/usr/local/munki/munkilib"
+    reads_binary = True
+
+    def loads(self, data):
+        try:
+            return self.module.readPlistFromString(data)
+        except self.module.FoundationPlistException as error:
+            raise PlistReadError(str(error))
+
+
+class BiplistCodec(PlistCodec):
+    """Reads and writes binary plists, and XML via plistlib, with biplist."""
+
+    name = "biplist"
+    module_names = ("biplist",)
+    reads_binary = True
+    writes_binary = True
+
+    def loads(self, data):
+        try:
+            return self.module.readPlistFromString(data)
+        except self.module.InvalidPlistException as error:
+            raise PlistReadError(str(error))
+
+    def dumps(self, plist, binary=False):
+        return self.module.writePlistToString(plist, binary=binary)
+
+
+class PlistIO(object):
+    """Reads and writes plists with the configured backend.
+
+    Binary plists are read, and written, with the first available
+    backend able to when the configured one can't.
+    """
+
+    def __init__(self, codecs):
+        """Set up with codecs, fastest first, for auto selection."""
+        self.codecs = collections.OrderedDict(
+            (codec.name, codec) for codec in codecs)
+        self.backend = "auto"
+        self.binary_cache = False
+        self._codec = None
+
+    def configure(self, backend="auto", binary_cache=False):
+        """Choose the backend, and whether to write binary cache files.
+
+        Raises:
+            PhasetoolError if the backend, or one that can write binary
+            plists if binary_cache is set, is unavailable.
+        """
+        if backend != "auto" and not self.codecs[backend].is_available():
+            raise PhasetoolError(
+                "The {} plist backend is not installed.".format(backend))
+        if binary_cache and not self.get_binary_codec(writes=True):
+            raise PhasetoolError(
+                "Writing binary plists requires biplist to be installed.")
+        self.backend = backend
+        self.binary_cache = binary_cache
+        self._codec = None
+
+    @property
+    def codec(self):
+        """The configured codec, or the fastest available for auto."""
+        if self._codec is None:
+            if self.backend == "auto":
+                self._codec = next(codec for codec in self.codecs.values()
+                                   if codec.is_available())
+            else:
+                self._codec = self.codecs[self.backend]
+        return self._codec
+
+    def get_binary_codec(self, writes=False):
+        """Return a codec that reads (or writes) binary plists, or None."""
+        for codec in [self.codec] + self.codecs.values():
+            if ((codec.writes_binary if writes else codec.reads_binary) and
+                    codec.is_available()):
+                return codec
+        return None
+
+    def loads(self, data):
+        """Return the plist object serialized in data.
+
+        Raises:
+            PlistReadError (an ExpatError) if data can't be parsed.
+        """
+        codec = self.codec
+        if data.startswith(BINARY_PLIST_HEADER) and not codec.reads_binary:
+            codec = self.get_binary_codec()
+            if not codec:
+                raise PlistReadError("No installed plist backend can read "
+                                     "binary plists.")
+        return codec.loads(data)
+
+    def dumps(self, plist, binary=False):
+        """Return plist serialized as XML, or as a binary plist."""
+        codec = self.codec
+        if binary and not codec.writes_binary:
+            codec = self.get_binary_codec(writes=True)
+        return codec.dumps(plist, binary=binary)
+
+    def dumps_cache(self, plist):
+        """Serialize one of phasetool's own files, as configured."""
+        return self.dumps(plist, binary=self.binary_cache)
+
+
+class ParseCache(object):
+    """Bounded LRU cache of parsed plists, keyed by file identity.
+
+    Plists are keyed by the device, inode, modification time and size
+    of the file they were parsed from, so a changed or replaced file
+    is never served stale. They are stored pickled, so each get
+    returns a new deep copy that callers are free to change.
+
+    Each process keeps an LRU of up to memory_bytes in front of an
+    optional sqlite store of up to disk_bytes, which is shared between
+    runs and with collect's worker processes. The store is trimmed to
+    size, least recently used first, when the process that configured
+    the cache closes it.
+
+    Hits, misses and evictions are counted in stats, and the store
+    accumulates them across runs for 'cache stats'.
+    """
+
+    schema = (
+        "CREATE TABLE IF NOT EXISTS plists ("
+        "key TEXT PRIMARY KEY, data BLOB NOT NULL, size INTEGER NOT NULL, "
+        "used REAL NOT NULL);"
+        "CREATE INDEX IF NOT EXISTS plists_by_use ON plists (used);"
+        "CREATE TABLE IF NOT EXISTS stats ("
+        "name TEXT PRIMARY KEY, value INTEGER NOT NULL);")
+
+    def __init__(self):
+        """Set up disabled, until configured."""
+        self.path = None
+        self.memory_bytes = 0
+        self.disk_bytes = 0
+        self.stats = collections.Counter()
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._connection = None
+        self._connection_pid = None
+        self._owner_pid = None
+
+    def configure(self, path=None, disk_bytes=0,
+                  memory_bytes=PARSE_CACHE_MEMORY_BYTES):
+        """Enable the cache, storing up to disk_bytes at path if set."""
+        self.close()
+        self.path = path
+        self.disk_bytes = disk_bytes
+        self.memory_bytes = memory_bytes
+        self._owner_pid = os.getpid()
+
+    @property
+    def enabled(self):
+        """Whether plists are cached at all."""
+        return self.memory_bytes > 0
+
+    @staticmethod
+    def get_key(stat):
+        """Return the cache key for a file's os.stat result."""
+        return "{}:{}:{!r}:{}".format(stat.st_dev, stat.st_ino,
+                                      stat.st_mtime, stat.st_size)
+
+    def get(self, key):
+        """Return a copy of the plist cached under key, or None."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            data = self._entries.pop(key, None)
+            if data is not None:
+                self._entries[key] = data
+            elif self.path:
+                data = self._get_stored(key)
+                if data is not None:
+                    self._remember(key, data)
+            self.stats["hits" if data is not None else "misses"] += 1
+        return None if data is None else cPickle.loads(data)
+
+    def put(self, key, plist):
+        """Cache a copy of plist under key.
+
+        Plists that can't be pickled, or are too big to cache, are
+        skipped.
+        """
+        if not self.enabled:
+            return
+        try:
+            data = cPickle.dumps(plist, cPickle.HIGHEST_PROTOCOL)
+        except (cPickle.PicklingError, TypeError):
+            return
+        with self._lock:
+            self._remember(key, data)
+            if self.path and len(data) <= self.disk_bytes:
+                connection = self._connect()
+                connection.execute(
+                    "INSERT OR REPLACE INTO plists VALUES (?, ?, ?, ?)",
+                    (key, sqlite3.Binary(data), len(data), time.time()))
+                connection.commit()
+
+    def read_stats(self):
+        """Return the store's accumulated stats, entries and size."""
+        with self._lock:
+            self._flush_stats()
+            connection = self._connect()
+            stats = collections.OrderedDict(
+                (name, 0) for name in PARSE_CACHE_STATS)
+            stats.update(connection.execute("SELECT name, value FROM stats"))
+            stats["entries"], stats["bytes"] = connection.execute(
+                "SELECT COUNT(*), TOTAL(size) FROM plists").fetchone()
+        stats["bytes"] = int(stats["bytes"])
+        return stats
+
+    def clear(self):
+        """Remove every cached plist and reset the stats."""
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+            self.stats.clear()
+            if self.path:
+                connection = self._connect()
+                connection.executescript(
+                    "DELETE FROM plists; DELETE FROM stats;")
+
+    def close(self):
+        """Save the stats, trim the store to size and disconnect."""
+        with self._lock:
+            if not self._connection and not (self.path and self.stats):
+                return
+            self._flush_stats()
+            if os.getpid() == self._owner_pid:
+                self._trim()
+            self._connection.close()
+            self._connection = None
+            self._connection_pid = None
+
+    def _remember(self, key, data):
+        """Add data to the in-memory LRU, evicting to fit."""
+        if len(data) > self.memory_bytes:
+            return
+        self._entries[key] = data
+        self._size += len(data)
+        while self._size > self.memory_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= len(evicted)
+
+    def _get_stored(self, key):
+        """Return the pickled plist stored under key, or None."""
+        connection = self._connect()
+        row = connection.execute("SELECT data FROM plists WHERE key = ?",
+                                 (key,)).fetchone()
+        if row is None:
+            return None
+        connection.execute("UPDATE plists SET used = ? WHERE key = ?",
+                           (time.time(), key))
+        connection.commit()
+        return str(row[0])
+
+    def _trim(self):
+        """Evict the least recently used plists over disk_bytes."""
+        cursor = self._connection.execute(
+            "SELECT key, size FROM plists ORDER BY used DESC")
+        total = 0
+        evict = []
+        for key, size in cursor:
+            total += size
+            if total > self.disk_bytes:
+                evict.append((key,))
+        self._connection.executemany("DELETE FROM plists WHERE key = ?",
+                                     evict)
+        self.stats["evictions"] += len(evict)
+        self._flush_stats()
+
+    def _flush_stats(self):
+        """Add this process's stats to the store's, and reset them."""
+        if not (self.path and self.stats):
+            return
+        connection = self._connect()
+        for name, value in self.stats.items():
+            connection.execute(
+                "INSERT OR IGNORE INTO stats VALUES (?, 0)", (name,))
+            connection.execute(
+                "UPDATE stats SET value = value + ? WHERE name = ?",
+                (value, name))
+        connection.commit()
+        self.stats.clear()
+
+    def _connect(self):
+        """Return this process's connection to the store.
+
+        Forked worker processes open their own, and save their stats
+        when they exit.
+        """
+        if self._connection_pid != os.getpid():
+            self._connection = sqlite3.connect(
+                self.path, timeout=30, check_same_thread=False)
+            self._connection.executescript(
+                "PRAGMA journal_mode = WAL; PRAGMA synchronous = OFF;" +
+                self.schema)
+            if os.getpid() != self._owner_pid:
+                multiprocessing_util.Finalize(self, self.close,
+                                              exitpriority=10)
+            self._connection_pid = os.getpid()
+        return self._connection
 
 
 def is_mounted(path):
@@ -172,45 +1046,818 @@ def mount(path):
             except subprocess.CalledProcessError as error:
                 raise PhasetoolError(
                     "Unable to mount {} at {} with error '{}'.".format(
-                        path, mount_point, error.meesage))
+                        path, mount_point, error))
             mount_location = mount_point
 
     return mount_location
 
 
+class PhasetoolError(Exception):
+    """The repo could not be found or mounted."""
+    pass
+
+
 def collect(args):
-    """Collect available updates."""
-    pkginfos = get_testing_pkginfos(args.repo)
+    """Collect available updates.
+
+    Pkginfo files are streamed through the walk, parse and filter
+    stages; only the compact records of matching items are held in
+    memory for sorting.
+    """
+    model = getattr(args, "model", None)
+    if args.from_catalogs:
+        records = (make_record(path, summary) for path, summary in
+                   get_testing_pkginfos_from_catalogs(args.repo).iteritems())
+    elif model:
+        records = filter_testing_records(model.records())
+    else:
+        index = None
+        if args.index:
+            index = PkginfoIndex(
+                get_cache_path(args.cache_dir, INDEX_FILENAME))
+        records = iter_testing_records(args.repo, index, args.jobs)
+    with PROFILER.stage("scan"):
+        if getattr(args, "latest", False):
+            records = filter_latest_versions(records)
+        records = sorted(records, key=operator.attrgetter("path"))
     output_path = os.path.expanduser(args.output_path)
     prefix = os.path.join(output_path,
                           datetime.datetime.now().strftime("%Y%m%d-%H%M%S"))
 
-    write_markdown(pkginfos, "{}-phase_testing.md".format(prefix))
-    write_path_list(pkginfos, "{}-phase_testing_files.txt".format(prefix))
+    if getattr(args, "since_last", False):
+        snapshot_path = os.path.join(output_path, SNAPSHOT_FILENAME)
+        with PROFILER.stage("compare snapshot"):
+            delta, snapshot = diff_snapshot(records, snapshot_path)
+        for status in ("added", "changed", "removed"):
+            for path in sorted(delta[status]):
+                print "{}: {}".format(status.capitalize(), path)
+        records = [record for record in records if
+                   record.path in delta["added"] or
+                   record.path in delta["changed"]]
+        write_file_atomically(PLIST_IO.dumps_cache(snapshot),
+                              snapshot_path)
+        if not records:
+            if not delta["removed"]:
+                print "No changes since the last collect."
+            return
+
+    with PROFILER.stage("write output"):
+        write_markdown(records, "{}-phase_testing.md".format(prefix))
+        write_path_list(records, "{}-phase_testing_files.txt".format(prefix))
+
+
+def iter_candidates(repo, index=None, jobs=1):
+    """Yield (path, summary) for each readable pkginfo in repo.
+
+    Args:
+        repo (str): Path to the Munki repo.
+        index (PkginfoIndex): Optional index to consult instead of
+            parsing every pkginfo file.
+        jobs (int): Number of worker processes to parse with.
+    """
+    if index:
+        return index.update(repo, jobs)
+    return iter_pkginfo_summaries(repo, jobs)
+
+
+def iter_testing_records(repo, index=None, jobs=1):
+    """Yield a PkginfoRecord for each testing, non-placeholder pkginfo.
+
+    Each summary is projected down to a record as soon as it is
+    parsed. Args are as per iter_candidates.
+    """
+    return filter_testing_records(
+        make_record(path, summary) for path, summary in
+        iter_candidates(repo, index, jobs))
+
+
+def filter_testing_records(records):
+    """Yield the testing, non-placeholder records."""
+    for record in records:
+        if record.catalog_mask and not is_placeholder(record.name or u""):
+            yield record
+
 
+def diff_snapshot(records, snapshot_path):
+    """Compare records with the snapshot of a previous collect.
+
+    Records whose file's mtime and size match the snapshot reuse its
+    content hash; others are hashed.
+
+    Args:
+        records (iterable of PkginfoRecord): Items collected this run.
+        snapshot_path (str): Path to the previous snapshot. A missing
+            snapshot counts every record as added.
+
+    Returns:
+        Tuple of (delta, snapshot). Delta is a dict of "added",
+        "changed" and "removed" sets of paths; snapshot is the new
+        snapshot to write.
+    """
+    try:
+        previous = read_plist(snapshot_path)["items"]
+    except IOError:
+        previous = {}
+    items = {}
+    delta = {"added": set(), "changed": set(), "removed": set()}
+    for record in records:
+        stat = os.stat(record.path)
+        old = previous.get(record.path)
+        if old and (old["mtime"], old["size"]) == (stat.st_mtime,
+                                                  stat.st_size):
+            content_hash = old["hash"]
+        else:
+            content_hash = hash_file(record.path)
+        item = {"mtime": stat.st_mtime, "size": stat.st_size,
+                "hash": content_hash, "catalogs": list(record.catalogs),
+                "version": record.version or u""}
+        items[record.path] = item
+        if not old:
+            delta["added"].add(record.path)
+        elif any(old[key] != item[key] for key in
+                 ("hash", "catalogs", "version")):
+            delta["changed"].add(record.path)
+    delta["removed"] = set(previous) - set(items)
+    return delta, {"created": datetime.datetime.utcnow(), "items": items}
+
+
+def hash_file(path):
+    """Return the hex SHA-1 digest of path's content."""
+    digest = hashlib.sha1()
+    with PROFILER.file("hash", path) as record, open(path, "rb") as handle:
+        for block in iter(lambda: handle.read(HASH_READ_SIZE), ""):
+            digest.update(block)
+        if PROFILER.enabled:
+            record.bytes_read = handle.tell()
+    return digest.hexdigest()
+
+
+def filter_latest_versions(records):
+    """Return the highest versioned PkginfoRecord for each name.
+
+    Records are consumed in a single pass, holding only the current
+    highest version of each name. Ties go to the lowest path.
+
+    Args:
+        records (iterable of PkginfoRecord): Records to filter.
+
+    Returns:
+        List of PkginfoRecords, in no particular order.
+    """
+    latest = {}
+    for record in records:
+        key = get_version_key(record.version)
+        current = latest.get(record.name)
+        if (current is None or key > current[0] or
+                (key == current[0] and record.path < current[1].path)):
+            latest[record.name] = (key, record)
+    return [record for _, record in latest.itervalues()]
+
+
+def get_version_key(version):
+    """Return a sort key for a version string, comparing as Munki does.
+
+    Like Munki's MunkiLooseVersion, versions are split into components
+    as LooseVersion does. Numbers compare numerically and below any
+    other component, as Python 2 orders ints before strings, and
+    trailing zero components are ignored. So "1.10" > "1.9",
+    "1.0" == "1.0.0" and "1.0b1" > "1.0.1". Keys are cached, as the
+    same versions are compared many times.
+    """
+    key = _VERSION_KEY_CACHE.get(version)
+    if key is None:
+        components = [
+            (0, int(component)) if component.isdigit() else (1, component)
+            for component in VERSION_COMPONENTS.split(
+                to_unicode(version or u"")) if component and component != "."]
+        while components and components[-1] == (0, 0):
+            components.pop()
+        key = _VERSION_KEY_CACHE[version] = tuple(components)
+    return key
 
-def get_testing_pkginfos(repo):
-    """Return all pkginfo files with testing catalogs."""
+
+def compare_versions(version, other):
+    """Compare two version strings as Munki does, for sqlite."""
+    return cmp(get_version_key(version), get_version_key(other))
+
+
+def make_record(path, summary):
+    """Project a pkginfo summary down to a PkginfoRecord."""
+    return PkginfoRecord(path, summary.get("name"),
+                         summary.get("display_name"), summary.get("version"),
+                         summary.get("catalogs"))
+
+
+class PkginfoRecord(object):
+    """Compact summary of a pkginfo, for collect.
+
+    Records are slotted, and their names, display names and versions
+    are interned, as the same values recur across a repo's versions
+    of an item. Catalogs are held as a bitmask of CATALOG_BITS, so only
+    TESTING_CATALOGS are kept.
+    """
+
+    __slots__ = ("path", "name", "display_name", "version", "catalog_mask")
+
+    def __init__(self, path, name, display_name, version, catalogs=None):
+        self.path = path
+        self.name = intern_string(name)
+        self.display_name = intern_string(display_name)
+        self.version = intern_string(version)
+        self.catalog_mask = 0
+        for catalog in catalogs or ():
+            self.catalog_mask |= CATALOG_BITS.get(catalog, 0)
+
+    @property
+    def catalogs(self):
+        """The record's testing catalogs, sorted."""
+        return tuple(catalog for catalog, bit in CATALOG_BITS.iteritems()
+                     if self.catalog_mask & bit)
+
+    def __eq__(self, other):
+        if not isinstance(other, PkginfoRecord):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in
+                   self.__slots__)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def __repr__(self):
+        return "PkginfoRecord({})".format(", ".join(
+            "{}={!r}".format(name, getattr(self, name)) for name in
+            self.__slots__))
+
+
+def intern_string(value):
+    """Return the shared copy of a str or unicode value (or None)."""
+    if value is None:
+        return None
+    if len(_INTERNED_STRINGS) >= INTERNED_STRINGS_LIMIT:
+        _INTERNED_STRINGS.clear()
+    return _INTERNED_STRINGS.setdefault(value, value)
+
+
+def get_testing_pkginfos_from_catalogs(repo):
+    """Return testing pkginfos as listed in repo's compiled catalogs.
+
+    Only the catalogs named in TESTING_CATALOGS are read. Catalog
+    entries are mapped back to pkginfo files by PkginfoPathResolver.
+    Prints a warning if any pkginfo is newer than the catalogs read.
+
+    Args:
+        repo (str): Path to the Munki repo.
+
+    Returns:
+        Dict of pkginfo path: pkginfo summary (see summarize_pkginfo).
+    """
+    catalog_dir = os.path.join(repo, "catalogs")
+    catalog_paths = [os.path.join(catalog_dir, catalog) for catalog in
+                     sorted(TESTING_CATALOGS) if
+                     os.path.exists(os.path.join(catalog_dir, catalog))]
+
+    items = {}
+    with PROFILER.stage("read catalogs"):
+        for catalog_path in catalog_paths:
+            for item in iter_catalog_entries(catalog_path,
+                                             catalogs=TESTING_CATALOGS):
+                summary = summarize_pkginfo(item)
+                if not is_placeholder(summary.get("name")):
+                    items.setdefault(
+                        (summary["name"], summary["version"]), summary)
+
+    with PROFILER.stage("resolve paths"):
+        resolver = PkginfoPathResolver(repo)
     pkginfos = {}
+    for summary in items.values():
+        path = resolver.resolve(summary)
+        if path:
+            pkginfos[path] = summary
+        else:
+            print >> sys.stderr, (
+                u"Unable to find a pkginfo file for {} {}.".format(
+                    summary["name"], summary["version"]).encode("utf-8"))
+
+    if catalog_paths:
+        oldest_catalog = min(os.path.getmtime(path) for path in catalog_paths)
+        if resolver.newest_mtime > oldest_catalog:
+            print >> sys.stderr, ("Warning: pkginfo files have changed since "
+                                  "the catalogs were built. Run makecatalogs "
+                                  "for an accurate listing.")
+
+    return pkginfos
+
+
+def iter_catalog_entries(path, names=None, catalogs=None):
+    """Yield the pkginfo entries of the compiled catalog at path.
+
+    Args:
+        path (str): Path to a catalog file.
+        names (iterable of str): Only yield entries with these names.
+        catalogs (iterable of str): Only yield entries in any of these
+            catalogs.
+
+    Raises:
+        ExpatError if the catalog is not a well-formed plist array.
+    """
+    return CatalogReader(names, catalogs).iter_entries(path)
+
+
+class CatalogReader(object):
+    """Incrementally parse the entries of a compiled catalog.
+
+    The catalog is read and fed to expat a chunk at a time. Each entry
+    of the top-level array is built as it is parsed, and yielded (if it
+    passes the filters) once the chunk that closes it has been parsed,
+    so memory use depends on the size of an entry rather than of the
+    catalog. Binary catalogs fall back to a full read_plist.
+    """
+
+    def __init__(self, names=None, catalogs=None):
+        self.names = set(names) if names else None
+        self.catalogs = set(catalogs) if catalogs else None
+        self.entries = []
+        self.depth = 0
+        # [container, pending dict key] for each open dict or array.
+        self.stack = []
+        self.text = None
+
+    def iter_entries(self, path):
+        """Yield the wanted entries of the catalog at path."""
+        with PROFILER.file("read catalogs", path) as record, \
+                open(path, "rb") as catalog_file:
+            size = os.fstat(catalog_file.fileno()).st_size
+            if not size:
+                raise PlistReadError("{} is empty.".format(path))
+            header = catalog_file.read(len(BINARY_PLIST_HEADER))
+            if header == BINARY_PLIST_HEADER:
+                entries = read_plist(path)
+            else:
+                catalog_file.seek(0)
+                entries = self._iter_parsed(catalog_file)
+            for entry in entries:
+                if self._is_wanted(entry):
+                    yield entry
+            record.bytes_read = size
+
+    def _iter_parsed(self, catalog_file):
+        """Yield the top-level entries parsed from the open file."""
+        parser = expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = self._start
+        parser.EndElementHandler = self._end
+        parser.CharacterDataHandler = self._characters
+        for chunk in iter(lambda: catalog_file.read(CATALOG_READ_SIZE), ""):
+            parser.Parse(chunk, False)
+            entries, self.entries = self.entries, []
+            for entry in entries:
+                yield entry
+        parser.Parse("", True)
+
+    def _is_wanted(self, entry):
+        """Return whether entry passes the filters."""
+        if not hasattr(entry, "get"):
+            return False
+        if self.names is not None and entry.get("name") not in self.names:
+            return False
+        return self.catalogs is None or any(
+            catalog in self.catalogs for catalog in
+            entry.get("catalogs") or [])
+
+    def _start(self, name, _):
+        """Handle an element opening."""
+        self.depth += 1
+        if self.depth <= 2:
+            if name != ("plist", "array")[self.depth - 1]:
+                raise PlistReadError("Not a catalog: found <{}> at depth "
+                                     "{}.".format(name, self.depth))
+        elif name == "dict":
+            self.stack.append([{}, None])
+        elif name == "array":
+            self.stack.append([[], None])
+        else:
+            self.text = []
+
+    def _end(self, name):
+        """Handle an element closing."""
+        self.depth -= 1
+        if self.depth < 2:
+            return
+        if name == "key":
+            self.stack[-1][1] = u"".join(self.text)
+            self.text = None
+            return
+        if name in ("dict", "array"):
+            value = self.stack.pop()[0]
+        else:
+            value = self._convert(name, u"".join(self.text))
+            self.text = None
+        if not self.stack:
+            self.entries.append(value)
+        elif isinstance(self.stack[-1][0], dict):
+            self.stack[-1][0][self.stack[-1][1]] = value
+        else:
+            self.stack[-1][0].append(value)
+
+    def _characters(self, data):
+        """Accumulate the text of keys and values."""
+        if self.text is not None:
+            self.text.append(data)
+
+    @staticmethod
+    def _convert(name, text):
+        """Return the value of a scalar plist element, as plistlib does."""
+        if name == "string":
+            try:
+                return text.encode("ascii")
+            except UnicodeError:
+                return text
+        elif name == "integer":
+            return int(text)
+        elif name == "real":
+            return float(text)
+        elif name in ("true", "false"):
+            return name == "true"
+        elif name == "date":
+            return datetime.datetime.strptime(text, PLIST_DATE_FORMAT)
+        elif name == "data":
+            return stdlib_plistlib.Data(base64.b64decode(text))
+        raise PlistReadError("Unknown plist element <{}>.".format(name))
+
+
+class PkginfoPathResolver(object):
+    """Map catalog entries back to the pkginfo files they came from.
+
+    The pkgsinfo dir is walked once for filenames and stat data only.
+    Entries are matched on munkiimport's "<name>-<version>" naming
+    scheme; files are only parsed to break ties between duplicates
+    (e.g. "Crypt-1.0.0__1.plist") or when no filename matches.
+    """
+
+    def __init__(self, repo):
+        self.newest_mtime = 0
+        self.paths_by_stem = {}
+        self.paths = []
+        for path in iter_pkginfo_paths(repo):
+            self.paths.append(path)
+            self.newest_mtime = max(self.newest_mtime,
+                                    os.path.getmtime(path))
+            stem = os.path.splitext(os.path.basename(path))[0]
+            stem = stem.split("__")[0].lower()
+            self.paths_by_stem.setdefault(stem, []).append(path)
+
+    def resolve(self, summary):
+        """Return the path to summary's pkginfo file, or None."""
+        stem = u"{}-{}".format(summary["name"], summary["version"]).lower()
+        candidates = self.paths_by_stem.get(stem, [])
+        if len(candidates) == 1:
+            return candidates[0]
+
+        if not candidates:
+            prefix = summary["name"].lower()
+            candidates = [path for path in self.paths if
+                          os.path.basename(path).lower().startswith(prefix)]
+        for path, candidate in iter_parsed_summaries(candidates):
+            if candidate and all(candidate[key] == summary[key] for key in
+                                 ("name", "version", "catalogs")):
+                return path
+        return None
+
+
+def iter_pkginfo_paths(repo):
+    """Yield the path to every pkginfo file in repo's pkgsinfo dir."""
     pkginfo_dir = os.path.join(repo, "pkgsinfo")
-    for dirpath, _, filenames in os.walk(pkginfo_dir):
+    walk = PROFILER.iter_stage("walk", os.walk(pkginfo_dir))
+    for dirpath, _, filenames in walk:
         for pfile in [fname for fname in filenames if is_pkginfo(fname)]:
-            try:
-                path = os.path.join(dirpath, pfile)
-                pkginfo_file = read_plist(path)
-            except ExpatError:
-                continue
+            yield os.path.join(dirpath, pfile)
 
-            if (is_testing(pkginfo_file) and
-                    not is_placeholder(pkginfo_file.get("name"))):
-                pkginfos[path] = pkginfo_file
 
-    return pkginfos
+def iter_pkginfo_summaries(repo, jobs=1):
+    """Yield (path, summary) for each readable pkginfo in repo."""
+    for path, summary in iter_parsed_summaries(iter_pkginfo_paths(repo),
+                                               jobs):
+        if summary is not None:
+            yield path, summary
+
+
+def iter_parsed_summaries(paths, jobs=1, parser=None):
+    """Yield (path, summary) for each path, in no particular order.
+
+    With more than one job, files are parsed by a pool of worker
+    processes. The pool consumes paths from a feeder thread, so a
+    directory walk generator keeps discovering files while earlier
+    ones are being parsed.
+
+    Args:
+        paths (iterable of str): Paths to pkginfo files.
+        jobs (int): Number of worker processes to use.
+        parser (callable): Module-level function taking a path and
+            returning (path, summary). Defaults to
+            parse_pkginfo_summary.
+
+    Yields:
+        Tuples of (path, summary). Summary is None for files that
+        could not be parsed.
+    """
+    parser = parser or parse_pkginfo_summary
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        worker = parser
+        if PROFILER.enabled:
+            # Workers' own profilers are lost, so they report back.
+            worker = functools.partial(parse_timed, parser)
+        try:
+            for result in pool.imap_unordered(worker, paths,
+                                              PARSE_CHUNKSIZE):
+                if PROFILER.enabled:
+                    result, seconds, size = result
+                    PROFILER.record_file("parse", result[0], seconds,
+                                         bytes_read=size)
+                yield result
+            # Let workers exit cleanly, so they save their parse cache
+            # stats.
+            pool.close()
+            pool.join()
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        for path in paths:
+            yield parser(path)
+
+
+def parse_pkginfo_summary(path):
+    """Return (path, summary) for path, or (path, None) if unreadable."""
+    try:
+        summary = read_pkginfo_summary(path)
+    except ExpatError:
+        return path, None
+    return path, summary
+
+
+def parse_timed(parser, path):
+    """Return parser's result for path, seconds taken and size."""
+    start = time.time()
+    result = parser(path)
+    return result, time.time() - start, os.path.getsize(path)
+
+
+def read_pkginfo_summary(path):
+    """Return a summary of just the COLLECT_KEYS of the pkginfo at path.
+
+    Pkginfos in PARSE_CACHE are summarized from it. Otherwise, XML
+    pkginfos are read with a PartialPlistReader, which builds only the
+    COLLECT_KEYS values as it tokenizes the file. Binary plists, and anything
+    the partial reader does not handle, fall back to a full read_plist.
+
+    With the cache enabled, testing pkginfos are parsed in full and
+    cached, as they are the ones prepare and release go on to read.
+
+    Raises:
+        ExpatError if the file is not a well-formed plist.
+    """
+    with PROFILER.file("parse", path) as record, \
+            open(path, "rb") as pkginfo_file:
+        key = ParseCache.get_key(os.fstat(pkginfo_file.fileno()))
+        pkginfo = PARSE_CACHE.get(key)
+        if pkginfo is not None:
+            return summarize_pkginfo(pkginfo)
+        header = pkginfo_file.read(8)
+        try:
+            if header != "bplist00":
+                reader = PartialPlistReader(COLLECT_KEYS)
+                try:
+                    summary = reader.read(pkginfo_file, header)
+                except PartialPlistReader.Unsupported:
+                    pass
+                else:
+                    if PARSE_CACHE.enabled and is_testing(summary):
+                        pkginfo_file.seek(0)
+                        PARSE_CACHE.put(key, PLIST_IO.loads(
+                            pkginfo_file.read()))
+                    return summary
+        finally:
+            record.bytes_read = pkginfo_file.tell()
+    return summarize_pkginfo(read_plist(path))
+
+
+class PartialPlistReader(object):
+    """Pull selected top-level keys out of an XML plist dict.
+
+    Only string and integer values, and arrays of strings, are
+    captured. Every other element is tokenized by expat and skipped
+    without building any objects, so large installs, receipts and
+    script values cost little. The whole document is still tokenized,
+    so truncated or malformed files fail as they would with a full
+    parse.
+    """
+
+    class Unsupported(Exception):
+        """The plist has structure the reader does not handle."""
+
+    def __init__(self, keys):
+        self.keys = set(keys)
+        self.found = {}
+        self.depth = 0
+        self.text = None
+        self.key = None
+        self.capture = None
+        self.array = None
+
+    def read(self, file_obj, data=""):
+        """Read a summary from file_obj; data is any already-read head.
+
+        Returns:
+            Dict with a value for every wanted key (None if absent);
+            "catalogs" is always a list.
+
+        Raises:
+            ExpatError if the file is not a well-formed XML document.
+        """
+        parser = expat.ParserCreate()
+        parser.StartElementHandler = self._start
+        parser.EndElementHandler = self._end
+        parser.CharacterDataHandler = self._characters
+        while data:
+            parser.Parse(data, False)
+            data = file_obj.read(PARTIAL_READ_SIZE)
+        parser.Parse("", True)
+
+        summary = {key: self.found.get(key) for key in self.keys}
+        summary["catalogs"] = summary.get("catalogs") or []
+        return summary
+
+    def _start(self, name, _):
+        """Handle an element opening."""
+        self.depth += 1
+        if self.depth == 1 and name != "plist":
+            raise self.Unsupported
+        elif self.depth == 2 and name != "dict":
+            raise self.Unsupported
+        elif self.depth == 3:
+            if name == "key":
+                self.text = []
+            elif self.key in self.keys:
+                self.capture = name
+                if name == "array":
+                    self.array = []
+                elif name in ("string", "integer"):
+                    self.text = []
+                else:
+                    raise self.Unsupported
+        elif self.depth == 4 and self.capture == "array":
+            if name != "string":
+                raise self.Unsupported
+            self.text = []
+
+    def _end(self, name):
+        """Handle an element closing."""
+        if self.depth == 3:
+            if name == "key":
+                self.key = u"".join(self.text)
+            elif self.capture:
+                self.found[self.key] = self._captured_value()
+                self.capture = None
+            self.text = None
+        elif self.depth == 4 and self.capture == "array":
+            self.array.append(u"".join(self.text))
+            self.text = None
+        self.depth -= 1
+
+    def _characters(self, data):
+        """Accumulate text only for elements being captured."""
+        if self.text is not None:
+            self.text.append(data)
+
+    def _captured_value(self):
+        """Return the value of the element just captured."""
+        if self.capture == "array":
+            return self.array
+        elif self.capture == "integer":
+            return unicode(int(u"".join(self.text)))
+        return u"".join(self.text)
+
+
+def summarize_pkginfo(pkginfo):
+    """Return a plain dict of just the COLLECT_KEYS from pkginfo.
+
+    Values are converted to plain unicode objects so that summaries
+    can be pickled back from worker processes, even when pkginfo is a
+    FoundationPlist object.
+    """
+    summary = {key: to_unicode(pkginfo.get(key)) for key in COLLECT_KEYS}
+    summary["catalogs"] = [
+        to_unicode(catalog) for catalog in pkginfo.get("catalogs") or []]
+    return summary
+
+
+def to_unicode(value):
+    """Return value as a plain unicode object, passing None through."""
+    return None if value is None else unicode(value)
+
+
+def get_cache_path(cache_dir, filename):
+    """Return the path to filename in cache_dir, creating the dir."""
+    cache_dir = os.path.expanduser(cache_dir)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    return os.path.join(cache_dir, filename)
+
+
+class PkginfoIndex(object):
+    """Persistent index of pkginfo stat data and collect fields.
+
+    Rows are keyed on the repo and the pkginfo's path relative to the
+    repo. Each row stores the mtime and size seen when the file was
+    last parsed; files whose stat data is unchanged are not re-read.
+    Files that fail to parse are recorded as invalid so that they are
+    skipped until they change.
+    """
+
+    schema = (
+        "CREATE TABLE IF NOT EXISTS pkginfos ("
+        "repo TEXT NOT NULL, relpath TEXT NOT NULL, mtime REAL, "
+        "size INTEGER, valid INTEGER, name TEXT, display_name TEXT, "
+        "version TEXT, catalogs TEXT, PRIMARY KEY (repo, relpath))")
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.text_factory = unicode
+        self.connection.execute(self.schema)
+
+    def update(self, repo, jobs=1):
+        """Bring the index up to date with repo and return summaries.
+
+        Args:
+            repo (str): Path to the Munki repo.
+            jobs (int): Number of worker processes to parse with.
+
+        Returns:
+            Iterator of (pkginfo path, pkginfo summary) for every valid
+            pkginfo in the repo, read lazily from the index. Paths are
+            joined to repo as given.
+        """
+        repo_key = os.path.abspath(repo)
+        cursor = self.connection.execute(
+            "SELECT relpath, mtime, size FROM pkginfos WHERE repo = ?",
+            (repo_key,))
+        known = {row[0]: (row[1], row[2]) for row in cursor}
+
+        seen = set()
+        stats = {}
+        for path in iter_pkginfo_paths(repo):
+            relpath = os.path.relpath(path, repo)
+            seen.add(relpath)
+            stat = os.stat(path)
+            if known.get(relpath) != (stat.st_mtime, stat.st_size):
+                stats[path] = stat
+
+        with PROFILER.stage("update index"):
+            for path, summary in iter_parsed_summaries(stats, jobs):
+                self._store(repo_key, os.path.relpath(path, repo),
+                            stats[path], summary)
+
+        removed = [(repo_key, relpath) for relpath in known
+                   if relpath not in seen]
+        self.connection.executemany(
+            "DELETE FROM pkginfos WHERE repo = ? AND relpath = ?", removed)
+        self.connection.commit()
+
+        cursor = self.connection.execute(
+            "SELECT relpath, name, display_name, version, catalogs "
+            "FROM pkginfos WHERE repo = ? AND valid = 1", (repo_key,))
+        return ((os.path.join(repo, row[0]), self._row_to_summary(row))
+                for row in cursor)
+
+    def _store(self, repo_key, relpath, stat, summary):
+        """Replace relpath's row; a summary of None marks it invalid."""
+        if summary is None:
+            row = (repo_key, relpath, stat.st_mtime, stat.st_size, 0, None,
+                   None, None, None)
+        else:
+            row = (repo_key, relpath, stat.st_mtime, stat.st_size, 1,
+                   summary["name"], summary["display_name"],
+                   summary["version"], "\n".join(summary["catalogs"]))
+        self.connection.execute(
+            "INSERT OR REPLACE INTO pkginfos VALUES (?, ?, ?, ?, ?, ?, ?, ?, "
+            "?)", row)
+
+    @staticmethod
+    def _row_to_summary(row):
+        """Convert a pkginfos row back into a pkginfo summary."""
+        return {"name": row[1], "display_name": row[2], "version": row[3],
+                "catalogs": row[4].split("\n") if row[4] else []}
 
 
 def is_testing(pkginfo):
     """Return whether a pkginfo file specifies any testing catalogs."""
-    catalogs = pkginfo.get("catalogs")
+    catalogs = pkginfo.get("catalogs") or []
     return any(catalog in TESTING_CATALOGS for catalog in catalogs)
 
 
@@ -224,114 +1871,1843 @@ def is_pkginfo(candidate):
     return os.path.splitext(candidate)[-1].lower() in PKGINFO_EXTENSIONS
 
 
-def write_markdown(data, path):
-    """Write markdown data string to path."""
+def write_markdown(records, path):
+    """Write a markdown listing of records to path.
+
+    Args:
+        records (iterable of PkginfoRecord): Items to list, in order.
+        path (str): Output file path.
+    """
+    write_lines(iter_markdown_lines(records), path)
+
+
+def iter_markdown_lines(records):
+    """Yield the lines of the markdown listing for records."""
     # TODO: Add template stuff.
     month = datetime.datetime.now().strftime("%B")
-    schedule = []
     today = datetime.date.today()
-    phases = (("Phase 1", 0, 3),
-              ("Phase 2", 6, 10),
-              ("Phase 3", 13, 17),
-              ("Production", 20, 25))
-    output = [u"## {} Phase Testing Updates\n".format(month)]
-    output.append("## Schedule")
-    output.append("| Phase | Available | Required |")
-    output.append("| ----- | --------- | -------- |")
-    for phase in phases:
-        start = today + datetime.timedelta(days=phase[1])
-        end = today + datetime.timedelta(days=phase[2])
-        output.append("| {} | {} | {} |".format(phase[0], start, end))
-    output.append("")
-    for _, item_val in sorted(data.items()):
-        output.append(u"- {} {}".format(
-            item_val.get("display_name") or item_val.get("name"),
-            item_val["version"]))
-    output_string = u"\n".join(output).encode("utf-8")
-    write_file(output_string, path)
-
-
-def write_path_list(data, path):
-    """Write pkginfo path data to path."""
-    output_string = u"\n".join(sorted(data.keys())).encode("utf-8")
-    write_file(output_string, path)
-
-
-def write_file(output_string, path):
-    """Write output_string to path."""
-    with open(path, "w") as markdown_file:
-        markdown_file.write(output_string)
+    yield u"## {} Phase Testing Updates\n".format(month)
+    yield u"## Schedule"
+    yield u"| Phase | Available | Required |"
+    yield u"| ----- | --------- | -------- |"
+    for phase in scheduler.PHASES:
+        start = today + datetime.timedelta(days=phase.available)
+        end = today + datetime.timedelta(days=phase.required)
+        yield u"| {} | {} | {} |".format(phase.title, start, end)
+    yield u""
+    for record in records:
+        yield u"- {} {}".format(record.display_name or record.name,
+                                record.version)
+
+
+def write_path_list(records, path):
+    """Write the path of each of records to path."""
+    write_lines((record.path for record in records), path)
+
+
+def write_lines(lines, path):
+    """Write lines to path, newline separated, as they are produced."""
+    with PROFILER.file("write output", path) as record, \
+            open(path, "w") as output_file:
+        for line_number, line in enumerate(lines):
+            if line_number:
+                output_file.write("\n")
+            output_file.write(line.encode("utf-8"))
+        record.bytes_written = output_file.tell()
 
 
 def prepare(args):
     """Set keys relevent to phase deployment."""
-    if (len(args.pkginfo) is 1 and
-            not args.pkginfo[0].endswith((".plist", ".pkginfo"))):
-        # File input
-        paths_to_change = get_pkginfo_from_file(args.pkginfo[0])
+    paths_to_change = get_selected_paths(args)
+    date = get_date_arg(args.date)
+    run_mutation(args, paths_to_change,
+                 functools.partial(prepare_pkginfo, date, args.phase))
+
+
+def prepare_pkginfo(date, phase, pkginfo):
+    """Prepare pkginfo for phase testing in catalog phase.
+
+    Returns:
+        Boolean whether pkginfo was changed.
+    """
+    return any([set_force_install_after_date(date, pkginfo),
+                set_unattended_install(False, pkginfo),
+                set_catalog(phase, pkginfo)])
+
+
+def release(args):
+    """Set keys relevent to production deployment."""
+    paths_to_change = get_selected_paths(args)
+    date = get_date_arg(args.date)
+    run_mutation(args, paths_to_change,
+                 functools.partial(release_pkginfo, date))
+
+
+def release_pkginfo(date, pkginfo):
+    """Prepare pkginfo for production.
+
+    Returns:
+        Boolean whether pkginfo was changed.
+    """
+    return any([set_force_install_after_date(date, pkginfo),
+                set_unattended_install(True, pkginfo),
+                set_catalog("production", pkginfo)])
+
+
+def bulk(args):
+    """Set or remove keys on multiple pkginfo files.
+
+    Edits are compiled once, then applied to each pkginfo in a single
+    read and write.
+    """
+    edits = get_bulk_edits(args)
+    paths_to_change = get_selected_paths(args)
+
+    def mutator(pkginfo):
+        """Apply each matching group of edits to pkginfo."""
+        changed = False
+        for condition, operations in edits:
+            if condition is None or condition.matches(pkginfo):
+                for operation in operations:
+                    changed = operation(pkginfo) or changed
+        return changed
+
+    run_mutation(args, paths_to_change, mutator)
+
+
+def get_bulk_edits(args):
+    """Return bulk's compiled edits from the commandline args.
+
+    With --set, --remove or --spec, any key and val positional args
+    are pkginfo paths, and args.pkginfo is updated to include them.
+    Exits if the edits are invalid.
+    """
+    groups = []
+    if args.set_values or args.remove:
+        edit_values = {}
+        for edit in args.set_values:
+            key, _, value = edit.partition("=")
+            try:
+                edit_values[key] = parse_typed_value(value)
+            except ValueError as error:
+                print "Invalid --set {}: {}".format(edit, error)
+                sys.exit(1)
+        groups.append({"set": edit_values, "remove": args.remove})
+    if args.spec:
+        try:
+            spec = read_plist(args.spec)
+        except (IOError, ExpatError) as error:
+            print "Unable to read spec {}: {}".format(args.spec, error)
+            sys.exit(1)
+        error = check_edit_spec(spec)
+        if error:
+            print "Invalid spec {}: {}".format(args.spec, error)
+            sys.exit(1)
+        groups.extend(spec)
+
+    if groups:
+        args.pkginfo = [arg for arg in (args.key, args.val) if arg
+                        is not None] + args.pkginfo
+    elif args.key is None or args.val is None:
+        print "Please specify a key and value, or edits to make."
+        sys.exit(1)
+    elif args.val == "-":
+        groups.append({"remove": [args.key]})
     else:
-        paths_to_change = args.pkginfo
+        groups.append({"set": {args.key: args.val}})
 
-    if not args.date:
-        date = None
-    elif not is_valid_date(args.date):
-        print "Invalid date! Please check formatting."
+    try:
+        return compile_edits(groups, args.condition)
+    except QueryError as error:
+        print "Invalid query: {}".format(error)
         sys.exit(1)
+
+
+def check_edit_spec(spec):
+    """Return a description of what's wrong with a bulk spec, or None.
+
+    Specs must be lists of dicts using only the EDIT_SPEC_KEYS, with
+    "set" a dict, "remove" a list of strings and "if" a string.
+    """
+    if (isinstance(spec, basestring) or hasattr(spec, "keys") or
+            not hasattr(spec, "__iter__")):
+        return "Not a list of edit groups"
+    problems = []
+    for index, group in enumerate(spec):
+        if not hasattr(group, "keys"):
+            problems.append("group {} is not a dictionary".format(index))
+            continue
+        unknown = sorted(set(group) - set(EDIT_SPEC_KEYS))
+        if unknown:
+            problems.append("group {} has unknown keys {}".format(
+                index, ", ".join(unknown)))
+        if not hasattr(group.get("set", {}), "keys"):
+            problems.append("group {} set is not a dictionary".format(index))
+        remove = group.get("remove", [])
+        if (isinstance(remove, basestring) or not hasattr(remove, "__iter__")
+                or not all(isinstance(key, basestring) for key in remove)):
+            problems.append(
+                "group {} remove is not a list of strings".format(index))
+        if not isinstance(group.get("if", ""), basestring):
+            problems.append("group {} if is not a string".format(index))
+    return "; ".join(problems) or None
+
+
+def compile_edits(groups, condition=None):
+    """Compile groups of edits into operations on a pkginfo.
+
+    Args:
+        groups (list of dict): Edit groups, with optional "set" (dict
+            of key: value), "remove" (list of keys) and "if" (query
+            expression) keys.
+        condition (str): Query expression every group also requires,
+            or None.
+
+    Returns:
+        List of (condition, operations) for each group. Condition is
+        a parsed query or None. Operations are callables taking the
+        pkginfo and returning whether they changed it; removals come
+        before sets.
+
+    Raises:
+        QueryError if a query expression is invalid.
+    """
+    compiled = []
+    for group in groups:
+        queries = [parse_query(text) for text in (condition, group.get("if"))
+                   if text]
+        query = reduce(QueryAnd, queries) if queries else None
+        operations = [functools.partial(remove_key, key) for key in
+                      group.get("remove", [])]
+        operations += [functools.partial(set_key, key, value) for key, value
+                       in sorted(group.get("set", {}).items())]
+        compiled.append((query, operations))
+    return compiled
+
+
+def parse_typed_value(text):
+    """Return a value from a "TYPE:value" string, or text if untyped.
+
+    See bulk's --set help for the types.
+
+    Raises:
+        ValueError if value is not valid for TYPE.
+    """
+    value_type, separator, value = text.partition(":")
+    if not separator or value_type not in (
+            "string", "bool", "int", "real", "date", "list", "dict"):
+        return text
+    elif value_type == "string":
+        return value
+    elif value_type == "bool":
+        if value.lower() not in ("true", "yes", "1", "false", "no", "0"):
+            raise ValueError("'{}' is not a bool".format(value))
+        return value.lower() in ("true", "yes", "1")
+    elif value_type == "int":
+        return int(value)
+    elif value_type == "real":
+        return float(value)
+    elif value_type == "date":
+        for date_format in QUERY_DATE_FORMATS:
+            try:
+                return datetime.datetime.strptime(value, date_format)
+            except ValueError:
+                continue
+        raise ValueError("'{}' is not a date".format(value))
+    elif value_type == "list" and not value.startswith("["):
+        return value.split(",") if value else []
+
+    parsed = json.loads(value)
+    if not isinstance(parsed, list if value_type == "list" else dict):
+        raise ValueError("'{}' is not a {}".format(value, value_type))
+    return parsed
+
+
+def run_mutation(args, paths_to_change, mutator):
+    """Apply mutator to paths_to_change and report the results.
+
+    Args:
+        args (argparse.Namespace): The parsed commandline args.
+        paths_to_change (list of str): Paths to pkginfo files.
+        mutator (callable or dict): As per mutate_pkginfos.
+
+    Returns:
+        The run's MutationSummary.
+    """
+    dry_run = getattr(args, "dry_run", False)
+    summary = mutate_pkginfos(
+        paths_to_change, mutator, args.jobs,
+        get_cache_path(args.cache_dir, JOURNAL_DIRNAME),
+        keep_changes=args.update_catalogs, dry_run=dry_run, validate=True)
+    if summary.aborted:
+        summary.report()
+        sys.exit(1)
+    if dry_run:
+        for diff in summary.diffs.values():
+            print "\n".join(diff).encode("utf-8")
+        print "Dry run; no pkginfo files were written."
+    summary.report()
+    model = getattr(args, "model", None)
+    if model and not dry_run:
+        model.refresh(os.path.abspath(path) for path in
+                      summary.results["changed"])
+    if args.update_catalogs and summary.changes:
+        if dry_run:
+            print "Would update catalogs: {}".format(", ".join(
+                get_affected_catalogs(summary.changes)))
+        else:
+            with PROFILER.stage("update catalogs"):
+                updated = update_catalogs(args.repo, summary.changes)
+            print "Updated catalogs: {}".format(", ".join(updated))
+    return summary
+
+
+def schedule(args):
+    """Add pkginfo files to the rolling phase schedule, or tick it."""
+    state = scheduler.Schedule(get_cache_path(args.cache_dir,
+                                              SCHEDULE_FILENAME))
+    repo_key = os.path.abspath(args.repo)
+    if args.action == "add":
+        paths = get_selected_paths(args)
+        if not paths:
+            print "Please specify pkginfo files to schedule."
+            sys.exit(1)
+        start = get_day_arg(args.start)
+        state.add(repo_key, [os.path.relpath(os.path.abspath(path), repo_key)
+                             for path in paths], start)
+        print "Scheduled {} pkginfo files to start phase testing on " \
+            "{}.".format(len(paths), start)
+    elif args.action == "tick":
+        tick_schedule(args, state, repo_key)
     else:
-        date = get_datetime(args.date)
+        for entry in state.entries(repo_key):
+            phase = (scheduler.PHASES[entry.phase].title if entry.phase >= 0
+                     else "Not started")
+            print u"{}: {}; {} on {}".format(
+                entry.relpath, phase, scheduler.PHASES[entry.phase + 1].title,
+                entry.due).encode("utf-8")
 
-    for path in paths_to_change:
-        if os.path.exists(path):
-            pkginfo = read_plist(path)
-            set_force_install_after_date(date, pkginfo)
-            set_unattended_install(False, pkginfo)
-            set_catalog(args.phase, pkginfo)
-            plistlib.writePlist(pkginfo, path)
 
+def tick_schedule(args, state, repo_key):
+    """Move every scheduled pkginfo that is due into its next phase.
 
-def release(args):
-    """Set keys relevent to production deployment."""
-    if (len(args.pkginfo) is 1 and
-            not args.pkginfo[0].endswith((".plist", ".pkginfo"))):
-        # File input
-        paths_to_change = get_pkginfo_from_file(args.pkginfo[0])
+    Only the schedule's due items are read, and their changes are all
+    applied in one run_mutation batch. Pkginfo files that no longer
+    exist are dropped from the schedule first, so they don't fail the
+    batch's validation; those that fail stay due.
+    """
+    today = get_day_arg(args.date)
+    transitions = {os.path.join(args.repo, transition.relpath): transition
+                   for transition in state.due(repo_key, today)}
+    missing = [path for path in transitions if not os.path.exists(path)]
+    for path in sorted(missing):
+        print "Unscheduled missing pkginfo: {}".format(path)
+        if not getattr(args, "dry_run", False):
+            state.remove(repo_key, [transitions[path].relpath])
+        del transitions[path]
+    if not transitions:
+        print "No scheduled pkginfo files are due."
+        return
+    mutators = {path: get_phase_mutator(transition) for path, transition in
+                transitions.items()}
+    summary = run_mutation(args, sorted(transitions), mutators)
+    if getattr(args, "dry_run", False):
+        return
+    state.advance(repo_key, [transitions[path] for path in
+                             summary.results["changed"] +
+                             summary.results["unchanged"]])
+
+
+def get_phase_mutator(transition):
+    """Return a mutator moving a pkginfo into transition's phase."""
+    phase = scheduler.PHASES[transition.phase]
+    date = scheduler.get_required_date(transition.start, transition.phase)
+    if phase.catalog == "production":
+        return functools.partial(release_pkginfo, date)
+    return functools.partial(prepare_pkginfo, date, phase.catalog)
+
+
+def get_day_arg(day):
+    """Return a date for a 'yyyy-mm-dd' commandline arg, or today.
+
+    Exits if the date is not correctly formatted.
+    """
+    if not day:
+        return datetime.date.today()
+    try:
+        return scheduler.parse_date(day)
+    except ValueError:
+        print "Invalid date! Please use 'yyyy-mm-dd'."
+        sys.exit(1)
+
+
+def journal(args):
+    """List, resume or roll back journals of interrupted runs."""
+    journal_dir = get_cache_path(args.cache_dir, JOURNAL_DIRNAME)
+    if args.action == "list":
+        for entry in MutationJournal.list(journal_dir):
+            print "{}: {} ({} pkginfo files)".format(
+                entry.journal_id, " ".join(entry.manifest["argv"]),
+                len(entry.paths))
+        return
+
+    if not args.journal_id:
+        print "Please specify a journal to {}.".format(args.action)
+        sys.exit(1)
+    entry = MutationJournal(os.path.join(journal_dir, args.journal_id))
+    if args.action == "resume":
+        errors = entry.resume()
     else:
-        paths_to_change = args.pkginfo
+        errors = entry.rollback()
+    for path, error in errors.items():
+        print "Failed: {} ({})".format(path, error)
+    if errors:
+        sys.exit(1)
 
-    if not args.date:
-        date = None
-    elif not is_valid_date(args.date):
-        print "Invalid date! Please check formatting."
+
+def cache(args):
+    """Print the parse cache's stats, or clear it."""
+    if not PARSE_CACHE.path:
+        print "The parse cache is disabled; enable it with --parse-cache-size."
         sys.exit(1)
+    if args.action == "clear":
+        PARSE_CACHE.clear()
+        print "Cleared the parse cache."
+        return
+    for name, value in PARSE_CACHE.read_stats().items():
+        print "{}: {}".format(name, value)
+
+
+def serve(args):
+    """Answer requests against a live model of the repo until killed."""
+    socket_path = args.socket or get_cache_path(args.cache_dir,
+                                                SOCKET_FILENAME)
+    if os.path.exists(socket_path):
+        if send_request(socket_path, None) is not None:
+            print >> sys.stderr, "phasetool is already serving on {}.".format(
+                socket_path)
+            sys.exit(1)
+        # Left behind by a server that was killed.
+        os.remove(socket_path)
+
+    model = PkginfoModel(os.path.abspath(args.repo), args.jobs)
+    with PROFILER.stage("scan"):
+        model.scan()
+    method = start_watching(model, args.watch, args.poll_interval)
+    server = PhasetoolServer(socket_path, model)
+    try:
+        # Requests can change any pkginfo, so only we may connect.
+        os.chmod(socket_path, 0600)
+        print "Serving {} pkginfo files from {} on {} ({}).".format(
+            len(model), model.repo, socket_path, method)
+        sys.stdout.flush()
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        remove_quietly(socket_path)
+
+
+def check_sendable(parser, args):
+    """Check that args can be run by phasetool serve.
+
+    Raises:
+        PhasetoolError if any of the SERVER_LOCAL_OPTIONS were given.
+    """
+    options = []
+    for option in SERVER_LOCAL_OPTIONS:
+        dest = option.lstrip("-").replace("-", "_")
+        if getattr(args, dest) != parser.get_default(dest):
+            options.append(option)
+    if options:
+        raise PhasetoolError(
+            "{} can't be sent to phasetool serve; it runs with the options "
+            "it was started with.".format(", ".join(options)))
+
+
+def send_request(socket_path, argv):
+    """Have the server at socket_path run a phasetool commandline.
+
+    Output from the run is written to stdout.
+
+    Args:
+        socket_path (str): Path to a serve daemon's socket.
+        argv (list of str or None): Commandline arguments, as given to
+            phasetool. None only checks that the server is answering.
+
+    Returns:
+        The run's exit status, or None if the server could not be
+        reached.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except socket.error as error:
+        if argv is not None:
+            print >> sys.stderr, (
+                "Unable to reach phasetool serve at {}: {}".format(
+                    socket_path, error))
+        return None
+    try:
+        client.sendall(json.dumps({"argv": argv, "cwd": os.getcwd()}) + "\n")
+        response = json.loads(client.makefile().readline())
+    finally:
+        client.close()
+    sys.stdout.write(response["output"].encode("utf-8"))
+    return response["status"]
+
+
+class PhasetoolServer(object):
+    """Runs phasetool commandlines against a live PkginfoModel.
+
+    Requests are handled one at a time, each in the requesting client's
+    working directory and with its output captured for the response.
+    Only the handling thread's output is captured; the watcher's goes
+    to the server's own stdout. Each request is a JSON line, and is
+    answered with one.
+    """
+
+    def __init__(self, socket_path, model):
+        self.model = model
+        self.server = SocketServer.UnixStreamServer(socket_path,
+                                                    self.handle)
+        self.streams = sys.stdout, sys.stderr
+        sys.stdout = self.stdout = RedirectableOutput(sys.stdout)
+        sys.stderr = self.stderr = RedirectableOutput(sys.stderr)
+
+    def serve_forever(self):
+        """Handle requests until interrupted."""
+        self.server.serve_forever()
+
+    def handle_request(self):
+        """Handle a single request."""
+        self.server.handle_request()
+
+    def server_close(self):
+        """Stop listening."""
+        self.server.server_close()
+        sys.stdout, sys.stderr = self.streams
+
+    def handle(self, connection, *_):
+        """Read a request from connection and write the response."""
+        line = connection.makefile("rb").readline()
+        if not line:
+            return
+        request = json.loads(line)
+        if request["argv"] is None:
+            status, output = 0, u""
+        else:
+            status, output = self.run(request["argv"], request["cwd"])
+        connection.sendall(json.dumps({"status": status, "output": output}) +
+                           "\n")
+
+    def run(self, argv, cwd):
+        """Run a phasetool commandline and return (status, output)."""
+        output = StringIO.StringIO()
+        server_cwd = os.getcwd()
+        status = 0
+        try:
+            self.stdout.redirect(output)
+            self.stderr.redirect(output)
+            os.chdir(cwd)
+            parser = build_argparser()
+            args = parser.parse_args(argv)
+            if args.func is serve:
+                raise SystemExit("phasetool is already serving.")
+            try:
+                check_sendable(parser, args)
+            except PhasetoolError as error:
+                raise SystemExit(str(error))
+            args.repo = self.model.repo
+            args.model = self.model
+            args.func(args)
+        except SystemExit as error:
+            if isinstance(error.code, (int, type(None))):
+                status = error.code or 0
+            else:
+                print error.code
+                status = 1
+        except Exception:  # pylint: disable=broad-except
+            traceback.print_exc()
+            status = 1
+        finally:
+            self.stdout.redirect(None)
+            self.stderr.redirect(None)
+            os.chdir(server_cwd)
+        value = output.getvalue()
+        if isinstance(value, str):
+            value = value.decode("utf-8", "replace")
+        return status, value
+
+
+class RedirectableOutput(object):
+    """Stand-in for sys.stdout or sys.stderr that threads can redirect.
+
+    A thread that has redirected writes to its own target; every other
+    thread keeps writing to the original stream.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def redirect(self, target):
+        """Send the current thread's output to target, or None to stop."""
+        self.local.target = target
+
+    def get_target(self):
+        """Return the file the current thread's output goes to."""
+        target = getattr(self.local, "target", None)
+        return self.stream if target is None else target
+
+    @property
+    def softspace(self):
+        """The print statement's state, kept by the current target."""
+        return getattr(self.get_target(), "softspace", 0)
+
+    @softspace.setter
+    def softspace(self, value):
+        self.get_target().softspace = value
+
+    def __getattr__(self, name):
+        return getattr(self.get_target(), name)
+
+
+class PkginfoModel(object):
+    """Live, in-memory PkginfoRecords of every pkginfo in a repo.
+
+    Paths are re-parsed only when their modification time or size
+    changes, so scan costs a walk and a stat per file.
+    """
+
+    def __init__(self, repo, jobs=1):
+        """Create an empty model of repo; call scan to load it."""
+        self.repo = repo
+        self.jobs = jobs
+        self.lock = threading.Lock()
+        # Path: ((mtime, size), record, or None for unreadable files).
+        self.entries = {}
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def scan(self):
+        """Bring the whole model up to date with the repo."""
+        stats = {}
+        for path in iter_pkginfo_paths(self.repo):
+            try:
+                stats[path] = os.stat(path)
+            except OSError:
+                continue
+        with self.lock:
+            removed = [path for path in self.entries if path not in stats]
+        self._update(stats, removed)
+
+    def refresh(self, paths):
+        """Bring the given absolute paths up to date."""
+        stats = {}
+        removed = []
+        for path in paths:
+            if not is_pkginfo(path):
+                continue
+            try:
+                stats[path] = os.stat(path)
+            except OSError:
+                removed.append(path)
+        self._update(stats, removed)
+
+    def records(self):
+        """Return a PkginfoRecord for each readable pkginfo."""
+        with self.lock:
+            return [record for _, record in self.entries.itervalues() if
+                    record is not None]
+
+    def _update(self, stats, removed):
+        """Parse changed paths from stats and drop removed paths."""
+        with self.lock:
+            changed = {
+                path: stat for path, stat in stats.iteritems() if
+                self.entries.get(path, (None,))[0] !=
+                (stat.st_mtime, stat.st_size)}
+        # Parse without the lock so requests aren't held up.
+        parsed = list(iter_parsed_summaries(changed, self.jobs))
+        with self.lock:
+            for path, summary in parsed:
+                stat = changed[path]
+                record = (make_record(path, summary) if summary is not None
+                          else None)
+                self.entries[path] = ((stat.st_mtime, stat.st_size), record)
+            for path in removed:
+                self.entries.pop(path, None)
+
+
+def start_watching(model, method="auto", interval=30):
+    """Keep model current from a background thread.
+
+    Args:
+        model (PkginfoModel): Model to keep current.
+        method (str): "inotify", "poll", or "auto" to pick inotify for
+            local repos when pyinotify is installed.
+        interval (float): Seconds between polls.
+
+    Returns:
+        Description of the method used.
+    """
+    if method == "auto":
+        method = "inotify" if pyinotify and not is_network_filesystem(
+            model.repo) else "poll"
+
+    if method == "inotify":
+        if not pyinotify:
+            print >> sys.stderr, "Watching with inotify requires pyinotify."
+            sys.exit(1)
+
+        def handle_event(event):
+            """Refresh the model for one inotify event."""
+            if event.mask & pyinotify.IN_Q_OVERFLOW or event.dir:
+                # Events were lost, or a whole directory came or went.
+                model.scan()
+            else:
+                model.refresh([event.pathname])
+
+        manager = pyinotify.WatchManager()
+        mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO |
+                pyinotify.IN_MOVED_FROM | pyinotify.IN_DELETE)
+        manager.add_watch(os.path.join(model.repo, "pkgsinfo"), mask,
+                          rec=True, auto_add=True)
+        watcher = pyinotify.ThreadedNotifier(manager, handle_event)
+        description = "watching with inotify"
+    else:
+        def poll():
+            """Rescan the model every interval seconds."""
+            while True:
+                time.sleep(interval)
+                model.scan()
+
+        watcher = threading.Thread(target=poll)
+        description = "polling every {:g}s".format(interval)
+
+    watcher.daemon = True
+    watcher.start()
+    return description
+
+
+def is_network_filesystem(path):
+    """Return whether path is on a network mount."""
+    path = os.path.realpath(path)
+    mount_type = None
+    mount_point = ""
+    for candidate, candidate_type in iter_mounts():
+        if ((path == candidate or path.startswith(
+                candidate.rstrip("/") + "/")) and
+                len(candidate) > len(mount_point)):
+            mount_point, mount_type = candidate, candidate_type
+    return mount_type in NETWORK_FILESYSTEMS
+
+
+def iter_mounts():
+    """Yield (mount point, filesystem type) for each mounted fs."""
+    if os.path.exists("/proc/mounts"):
+        with open("/proc/mounts") as mounts:
+            for line in mounts:
+                fields = line.split()
+                yield fields[1].decode("string_escape"), fields[2]
     else:
-        date = get_datetime(args.date)
+        # OS X: "//user@host/share on /Volumes/share (afpfs, nodev, ...)"
+        for line in subprocess.check_output(["mount"]).splitlines():
+            _, _, rest = line.partition(" on ")
+            mount_point, _, options = rest.rpartition(" (")
+            yield mount_point, options.split(",")[0]
+
+
+def query(args):
+    """Print the path of each pkginfo matching a query expression."""
+    expression = get_query_arg(" ".join(args.expression))
+    for path in select_pkginfos(args, expression):
+        print path
+
+
+def get_query_arg(text):
+    """Return the parsed query for text, exiting if it is invalid."""
+    try:
+        return parse_query(text)
+    except QueryError as error:
+        print "Invalid query: {}".format(error)
+        sys.exit(1)
+
 
-    for path in paths_to_change:
-        if os.path.exists(path):
+def get_selected_paths(args):
+    """Return the paths a mutation command should change.
+
+    These are the paths given on the commandline, filtered by --where
+    if it is used, or every pkginfo in the repo matching --where if
+    no paths are given.
+    """
+    paths = get_paths_to_change(args.pkginfo)
+    where = getattr(args, "where", None)
+    if not where:
+        return paths
+    selected = select_pkginfos(args, get_query_arg(where))
+    if not paths:
+        return selected
+    selected = {os.path.abspath(path) for path in selected}
+    return [path for path in paths if os.path.abspath(path) in selected]
+
+
+def select_pkginfos(args, expression):
+    """Return the sorted paths of the pkginfos matching expression.
+
+    Expressions using only QUERY_INDEX_KEYS are answered by the query
+    index, which only re-parses pkginfos changed since its last update.
+    Others are matched against every pkginfo in the repo.
+
+    Args:
+        args (argparse.Namespace): The parsed commandline args.
+        expression: The parsed query, as returned by parse_query.
+    """
+    if expression.keys() <= set(QUERY_INDEX_KEYS):
+        index = QueryIndex(get_cache_path(args.cache_dir,
+                                          QUERY_INDEX_FILENAME))
+        with PROFILER.stage("update query index"):
+            index.update(args.repo, args.jobs)
+        return index.select(args.repo, expression)
+
+    paths = []
+    for path in iter_pkginfo_paths(args.repo):
+        try:
             pkginfo = read_plist(path)
-            set_force_install_after_date(date, pkginfo)
-            set_unattended_install(True, pkginfo)
-            set_catalog("production", pkginfo)
-            plistlib.writePlist(pkginfo, path)
+        except ExpatError:
+            continue
+        if expression.matches(pkginfo):
+            paths.append(path)
+    return sorted(paths)
 
 
-def bulk(args):
-    """Set a key on multiple pkginfo files."""
-    if (len(args.pkginfo) is 1 and
-            not args.pkginfo[0].endswith((".plist", ".pkginfo"))):
+class QueryError(Exception):
+    """A query expression could not be parsed."""
+    pass
+
+
+def parse_query(text):
+    """Parse a query expression.
+
+    Grammar, loosest binding first:
+        expression: term ("or" term)*
+        term: factor ("and" factor)*
+        factor: "not" factor | "(" expression ")" | comparison
+        comparison: key operator value
+
+    Args:
+        text (str): The expression.
+
+    Returns:
+        The root QueryComparison, QueryAnd, QueryOr or QueryNot node.
+
+    Raises:
+        QueryError if text is not a valid expression.
+    """
+    tokens = tokenize_query(text)
+    expression, position = _parse_or(tokens, 0)
+    if position < len(tokens):
+        raise QueryError("unexpected '{}'".format(tokens[position][1]))
+    return expression
+
+
+def tokenize_query(text):
+    """Return a list of (kind, text) tokens of a query expression.
+
+    Kinds are "paren", "operator", "keyword" (and, or, not), "word"
+    and "string" (quoted values).
+    """
+    tokens = []
+    position = 0
+    text = text.strip()
+    while position < len(text):
+        match = QUERY_TOKENS.match(text, position)
+        if not match:
+            raise QueryError("unable to parse '{}'".format(text[position:]))
+        position = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == "double_quoted":
+            kind, value = "string", re.sub(r"\\(.)", r"\1", value)
+        elif kind == "single_quoted":
+            kind = "string"
+        elif kind == "word" and value in STRING_OPERATORS:
+            kind = "operator"
+        elif kind == "word" and value in ("and", "or", "not"):
+            kind = "keyword"
+        tokens.append((kind, value))
+    return tokens
+
+
+def _parse_or(tokens, position):
+    """Parse an "or" expression starting at position."""
+    left, position = _parse_and(tokens, position)
+    while position < len(tokens) and tokens[position] == ("keyword", "or"):
+        right, position = _parse_and(tokens, position + 1)
+        left = QueryOr(left, right)
+    return left, position
+
+
+def _parse_and(tokens, position):
+    """Parse an "and" expression starting at position."""
+    left, position = _parse_not(tokens, position)
+    while position < len(tokens) and tokens[position] == ("keyword", "and"):
+        right, position = _parse_not(tokens, position + 1)
+        left = QueryAnd(left, right)
+    return left, position
+
+
+def _parse_not(tokens, position):
+    """Parse a negation, parenthesized expression or comparison."""
+    if position >= len(tokens):
+        raise QueryError("expression ends unexpectedly")
+    token = tokens[position]
+    if token == ("keyword", "not"):
+        operand, position = _parse_not(tokens, position + 1)
+        return QueryNot(operand), position
+    if token == ("paren", "("):
+        expression, position = _parse_or(tokens, position + 1)
+        if position >= len(tokens) or tokens[position] != ("paren", ")"):
+            raise QueryError("missing ')'")
+        return expression, position + 1
+
+    comparison = tokens[position:position + 3]
+    if (len(comparison) < 3 or comparison[0][0] != "word" or
+            comparison[1][0] != "operator" or
+            comparison[2][0] not in ("word", "string")):
+        raise QueryError("expected 'key operator value' at '{}'".format(
+            " ".join(value for _, value in comparison)))
+    key, operator, value = (value for _, value in comparison)
+    return QueryComparison(key, operator, value), position + 3
+
+
+class QueryComparison(object):
+    """Compares one pkginfo key with a value.
+
+    The value is converted to the type of each pkginfo's value for the
+    key (string, date, integer, real or boolean); pkginfos whose value
+    it can't be converted to don't match. Comparisons with list values
+    match if any item matches, and "contains" tests list membership.
+    Strings of VERSION_KEYS are compared as versions.
+    """
+
+    comparisons = {"==": lambda a, b: a == b, "!=": lambda a, b: a != b,
+                   "<": lambda a, b: a < b, "<=": lambda a, b: a <= b,
+                   ">": lambda a, b: a > b, ">=": lambda a, b: a >= b}
+
+    def __init__(self, key, operator, value):
+        self.key = key
+        self.operator = operator
+        # The value as each type it converts to, normalized as in
+        # get_query_value.
+        self.values = {}
+        for value_type in ("string", "date", "integer", "real", "boolean"):
+            converted = convert_query_value(value, value_type)
+            if converted is not None:
+                self.values[value_type] = converted
+
+    def keys(self):
+        """Return the set of keys the expression uses."""
+        return {self.key}
+
+    def matches(self, pkginfo):
+        """Return whether pkginfo matches the comparison."""
+        value = pkginfo.get(self.key)
+        if isinstance(value, list):
+            operator = "==" if self.operator == "contains" else self.operator
+            return any(self._compare(operator, item) for item in value)
+        return value is not None and self._compare(self.operator, value)
+
+    def _compare(self, operator, value):
+        """Return whether a single value satisfies operator."""
+        value_type, value = get_query_value(value)
+        other = self.values.get(value_type)
+        if other is None:
+            return False
+        if operator in STRING_OPERATORS:
+            if value_type != "string":
+                return False
+            elif operator == "contains":
+                return other in value
+            return getattr(value, operator)(other)
+        if value_type == "string" and self.key in VERSION_KEYS:
+            value, other = get_version_key(value), get_version_key(other)
+        return self.comparisons[operator](value, other)
+
+    def to_sql(self, repo_key):
+        """Return (SQL condition on a files row, params)."""
+        clauses = []
+        params = []
+        for value_type, value in sorted(self.values.items()):
+            if self.operator in COMPARISON_OPERATORS:
+                collation = ""
+                if value_type == "string" and self.key in VERSION_KEYS:
+                    collation = " COLLATE version"
+                clauses.append("(type = ? AND value {} ?{})".format(
+                    COMPARISON_OPERATORS[self.operator], collation))
+                params.extend((value_type, value))
+                continue
+            if self.operator == "contains":
+                clauses.append("(in_list = 1 AND type = ? AND value = ?)")
+                params.extend((value_type, value))
+            if value_type != "string":
+                continue
+            if self.operator == "contains":
+                clauses.append("(in_list = 0 AND type = 'string' AND "
+                               "instr(value, ?) > 0)")
+                params.append(value)
+            elif self.operator == "startswith":
+                clauses.append("(type = 'string' AND "
+                               "substr(value, 1, ?) = ?)")
+                params.extend((len(value), value))
+            else:
+                clauses.append("(type = 'string' AND length(value) >= ? AND "
+                               "substr(value, length(value) - ? + 1) = ?)")
+                params.extend((len(value), len(value), value))
+
+        if not clauses:
+            return "0", []
+        sql = ("relpath IN (SELECT relpath FROM attributes WHERE repo = ? "
+               "AND key = ? AND ({}))".format(" OR ".join(clauses)))
+        return sql, [repo_key, self.key] + params
+
+
+class QueryAnd(object):
+    """Matches if both operands match."""
+
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+
+    def keys(self):
+        """Return the set of keys the expression uses."""
+        return self.left.keys() | self.right.keys()
+
+    def matches(self, pkginfo):
+        """Return whether pkginfo matches both operands."""
+        return self.left.matches(pkginfo) and self.right.matches(pkginfo)
+
+    def to_sql(self, repo_key):
+        """Return (SQL condition on a files row, params)."""
+        left, left_params = self.left.to_sql(repo_key)
+        right, right_params = self.right.to_sql(repo_key)
+        return "({} AND {})".format(left, right), left_params + right_params
+
+
+class QueryOr(QueryAnd):
+    """Matches if either operand matches."""
+
+    def matches(self, pkginfo):
+        """Return whether pkginfo matches either operand."""
+        return self.left.matches(pkginfo) or self.right.matches(pkginfo)
+
+    def to_sql(self, repo_key):
+        """Return (SQL condition on a files row, params)."""
+        left, left_params = self.left.to_sql(repo_key)
+        right, right_params = self.right.to_sql(repo_key)
+        return "({} OR {})".format(left, right), left_params + right_params
+
+
+class QueryNot(object):
+    """Matches if its operand doesn't."""
+
+    def __init__(self, operand):
+        self.operand = operand
+
+    def keys(self):
+        """Return the set of keys the expression uses."""
+        return self.operand.keys()
+
+    def matches(self, pkginfo):
+        """Return whether pkginfo doesn't match the operand."""
+        return not self.operand.matches(pkginfo)
+
+    def to_sql(self, repo_key):
+        """Return (SQL condition on a files row, params)."""
+        sql, params = self.operand.to_sql(repo_key)
+        return "NOT {}".format(sql), params
+
+
+def get_query_value(value):
+    """Return (type, normalized value) for a pkginfo value.
+
+    Dates are normalized to sortable strings and booleans to 0 or 1,
+    so values compare the same way in Python and in the query index.
+    Type is None for values queries can't compare, like dicts.
+    """
+    if isinstance(value, bool):
+        return "boolean", int(value)
+    elif isinstance(value, (int, long)):
+        return "integer", value
+    elif isinstance(value, float):
+        return "real", value
+    elif isinstance(value, datetime.datetime):
+        return "date", unicode(value.strftime(QUERY_DATE_FORMATS[0]))
+    elif isinstance(value, basestring):
+        return "string", to_unicode(value)
+    return None, None
+
+
+def convert_query_value(value, value_type):
+    """Return a query's value as value_type, or None if it can't be.
+
+    Results are normalized as in get_query_value.
+    """
+    if value_type == "string":
+        return to_unicode(value)
+    elif value_type == "date":
+        for date_format in QUERY_DATE_FORMATS:
+            try:
+                return unicode(datetime.datetime.strptime(
+                    value, date_format).strftime(QUERY_DATE_FORMATS[0]))
+            except ValueError:
+                continue
+    elif value_type == "boolean":
+        return {"true": 1, "yes": 1, "false": 0, "no": 0}.get(value.lower())
+    else:
+        try:
+            return int(value) if value_type == "integer" else float(value)
+        except ValueError:
+            pass
+    return None
+
+
+class QueryIndex(object):
+    """Persistent secondary index of pkginfo values for queries.
+
+    The attributes table holds a row per value of each of a pkginfo's
+    QUERY_INDEX_KEYS (a row per item for lists), indexed by key and
+    value. As with PkginfoIndex, the files table records the stat data
+    each pkginfo was indexed with so unchanged files are not re-read.
+    """
+
+    schema = (
+        "CREATE TABLE IF NOT EXISTS files ("
+        "repo TEXT NOT NULL, relpath TEXT NOT NULL, mtime REAL, "
+        "size INTEGER, valid INTEGER, PRIMARY KEY (repo, relpath));"
+        "CREATE TABLE IF NOT EXISTS attributes ("
+        "repo TEXT NOT NULL, relpath TEXT NOT NULL, key TEXT NOT NULL, "
+        "type TEXT NOT NULL, value, in_list INTEGER);"
+        "CREATE INDEX IF NOT EXISTS attributes_by_value "
+        "ON attributes (repo, key, value);"
+        "CREATE INDEX IF NOT EXISTS attributes_by_path "
+        "ON attributes (repo, relpath);")
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.text_factory = unicode
+        self.connection.create_collation("version", compare_versions)
+        self.connection.executescript(self.schema)
+
+    def update(self, repo, jobs=1):
+        """Bring the index up to date with repo.
+
+        Args:
+            repo (str): Path to the Munki repo.
+            jobs (int): Number of worker processes to parse with.
+        """
+        repo_key = os.path.abspath(repo)
+        cursor = self.connection.execute(
+            "SELECT relpath, mtime, size FROM files WHERE repo = ?",
+            (repo_key,))
+        known = {row[0]: (row[1], row[2]) for row in cursor}
+
+        seen = set()
+        stats = {}
+        for path in iter_pkginfo_paths(repo):
+            relpath = os.path.relpath(path, repo)
+            seen.add(relpath)
+            stat = os.stat(path)
+            if known.get(relpath) != (stat.st_mtime, stat.st_size):
+                stats[path] = stat
+
+        for path, attributes in iter_parsed_summaries(
+                stats, jobs, parse_pkginfo_attributes):
+            relpath = os.path.relpath(path, repo)
+            self._remove(repo_key, relpath)
+            stat = stats[path]
+            self.connection.execute(
+                "INSERT INTO files VALUES (?, ?, ?, ?, ?)",
+                (repo_key, relpath, stat.st_mtime, stat.st_size,
+                 int(attributes is not None)))
+            self.connection.executemany(
+                "INSERT INTO attributes VALUES (?, ?, ?, ?, ?, ?)",
+                ((repo_key, relpath) + row for row in attributes or []))
+
+        for relpath in known:
+            if relpath not in seen:
+                self._remove(repo_key, relpath)
+        self.connection.commit()
+
+    def select(self, repo, expression):
+        """Return the sorted paths of repo's pkginfos matching expression.
+
+        Paths are joined to repo as given.
+        """
+        repo_key = os.path.abspath(repo)
+        condition, params = expression.to_sql(repo_key)
+        cursor = self.connection.execute(
+            "SELECT relpath FROM files WHERE repo = ? AND valid = 1 AND {} "
+            "ORDER BY relpath".format(condition), [repo_key] + params)
+        return [os.path.join(repo, row[0]) for row in cursor]
+
+    def _remove(self, repo_key, relpath):
+        """Remove relpath's rows."""
+        for table in ("files", "attributes"):
+            self.connection.execute(
+                "DELETE FROM {} WHERE repo = ? AND relpath = ?".format(table),
+                (repo_key, relpath))
+
+
+def parse_pkginfo_attributes(path):
+    """Return (path, attribute rows) for path, or (path, None).
+
+    Rows are (key, type, value, in_list) for each value of the
+    pkginfo's QUERY_INDEX_KEYS that queries can compare.
+    """
+    try:
+        pkginfo = read_plist(path)
+    except ExpatError:
+        return path, None
+    rows = []
+    for key in QUERY_INDEX_KEYS:
+        value = pkginfo.get(key)
+        in_list = isinstance(value, list)
+        for item in value if in_list else [value]:
+            value_type, item = get_query_value(item)
+            if value_type:
+                rows.append((key, value_type, item, int(in_list)))
+    return path, rows
+
+
+def get_paths_to_change(pkginfo_args):
+    """Return the pkginfo paths specified on the commandline.
+
+    Args:
+        pkginfo_args (list of str): Paths to pkginfo files, or a single
+            path to a file listing pkginfo paths.
+    """
+    if (len(pkginfo_args) is 1 and
+            not pkginfo_args[0].endswith((".plist", ".pkginfo"))):
         # File input
-        paths_to_change = get_pkginfo_from_file(args.pkginfo[0])
+        return get_pkginfo_from_file(pkginfo_args[0])
     else:
-        paths_to_change = args.pkginfo
+        return pkginfo_args
 
-    for path in paths_to_change:
-        if os.path.exists(path):
-            pkginfo = read_plist(path)
-            if args.val == "-":
-                remove_key(args.key, pkginfo)
-            else:
-                set_key(args.key, args.val, pkginfo)
-            plistlib.writePlist(pkginfo, path)
+
+def get_date_arg(date):
+    """Return a datetime for a commandline date arg, or None if blank.
+
+    Exits if the date is not correctly formatted.
+    """
+    if not date:
+        return None
+    try:
+        return get_datetime(date)
+    except ValueError:
+        print "Invalid date! Please check formatting."
+        sys.exit(1)
+
+
+def check_pkginfo(pkginfo):
+    """Return a description of what's wrong with pkginfo, or None.
+
+    Pkginfos must be dicts with string names and versions and a list
+    of string catalogs. Types are checked loosely, so that
+    FoundationPlist's objects pass.
+    """
+    if not hasattr(pkginfo, "keys"):
+        return "Not a dictionary"
+    problems = ["Missing {}".format(key) for key in REQUIRED_PKGINFO_KEYS if
+                key not in pkginfo]
+    for key in ("name", "version"):
+        if key in pkginfo and not isinstance(pkginfo[key], basestring):
+            problems.append("{} is not a string".format(key))
+    catalogs = pkginfo.get("catalogs", [])
+    if (isinstance(catalogs, basestring) or not hasattr(catalogs, "__iter__")
+            or not all(isinstance(item, basestring) for item in catalogs)):
+        problems.append("catalogs is not a list of strings")
+    return "; ".join(problems) or None
+
+
+def mutate_pkginfos(paths, mutator, jobs=1, journal_dir=None,
+                    keep_changes=False, dry_run=False, validate=False):
+    """Read, change and write back any number of pkginfo files.
+
+    Files are processed by a pool of threads so that the latency of
+    reads and writes to a network share overlap. Paths listed more
+    than once are processed one after another, never concurrently.
+    Changed pkginfos are staged by a PkginfoWriter and only replace
+    the originals once every file has been read and changed.
+
+    Args:
+        paths (list of str): Paths to pkginfo files.
+        mutator (callable or dict): Called with each pkginfo to change
+            it in place. Returns whether it changed anything; unchanged
+            pkginfos are not written. May instead be a dict of a
+            mutator for each path.
+        jobs (int): Number of threads to use.
+        journal_dir (str): Directory in which to journal the batch so
+            that it can be resumed or rolled back if interrupted.
+            Defaults to no journal.
+        keep_changes (bool): Whether to record the original and
+            changed pkginfo of each changed file in the summary.
+        dry_run (bool): Don't write or journal anything; instead
+            record a diff of each changed file in the summary. Implies
+            keep_changes.
+        validate (bool): Check each pkginfo with check_pkginfo as it
+            is read, before it is changed. Unless every path exists,
+            is valid and is staged, the staged writes are discarded
+            and the summary is marked aborted; nothing is changed.
+
+    Returns:
+        MutationSummary of the outcome for each path.
+    """
+    locks = {path: threading.Lock() for path in paths}
+    writer = None if dry_run else PkginfoWriter(paths, journal_dir)
+
+    def mutate(path):
+        """Mutate path while holding its lock."""
+        func = mutator[path] if isinstance(mutator, dict) else mutator
+        with locks[path]:
+            status, error, change = mutate_pkginfo(
+                path, func, writer, keep_changes or dry_run, validate)
+        diff = None
+        if dry_run and change:
+            diff = diff_pkginfos(path, *change)
+        return path, status, error, change, diff
+
+    with PROFILER.stage("read and stage"):
+        results = map_threaded(mutate, paths, jobs)
+
+    aborted = validate and any(result[1] in PROBLEM_STATUSES for result in
+                               results)
+    commit_errors = {}
+    if writer and aborted:
+        writer.discard()
+    elif writer:
+        with PROFILER.stage("commit"):
+            commit_errors = writer.commit(jobs)
+    summary = MutationSummary()
+    summary.aborted = aborted
+    for path, status, error, change, diff in results:
+        if path in commit_errors:
+            status, error = "failed", commit_errors[path]
+        summary.add(path, status, error, change)
+        if diff:
+            summary.diffs[path] = diff
+    return summary
+
+
+def diff_pkginfos(path, original, changed):
+    """Return a unified diff of each top-level key that differs.
+
+    Each key's values are rendered as plist XML and diffed on their
+    own, with the key named in the hunk headers, so the diff reads the
+    same whatever order the backend writes keys in.
+
+    Returns:
+        List of diff lines.
+    """
+    lines = [u"--- {}".format(path), u"+++ {}".format(path)]
+    for key in sorted(set(original) | set(changed)):
+        if (key in original and key in changed and
+                is_same_value(original[key], changed[key])):
+            continue
+        old = render_plist_value(original[key]) if key in original else []
+        new = render_plist_value(changed[key]) if key in changed else []
+        for line in list(difflib.unified_diff(old, new, lineterm=""))[2:]:
+            lines.append(u"@@ {} @@".format(key) if line.startswith("@@")
+                         else line)
+    return lines
+
+
+def render_plist_value(value):
+    """Return the lines of value serialized as a plist XML element."""
+    lines = PLIST_IO.dumps(value).decode("utf-8").splitlines()
+    # Drop the XML declaration, doctype and plist element.
+    return lines[3:-1]
+
+
+def map_threaded(func, items, jobs=1):
+    """Return [func(item) for item in items], using jobs threads.
+
+    A single job runs in the calling thread, so simple runs don't pay
+    for importing and starting a thread pool.
+    """
+    if jobs <= 1:
+        return [func(item) for item in items]
+    pool = multiprocessing_pool.ThreadPool(jobs)
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def mutate_pkginfo(path, mutator, writer, keep_changes=False,
+                   validate=False):
+    """Apply mutator to the pkginfo at path and stage any changes.
+
+    Changes are only staged if there is a writer. If validate is set,
+    pkginfos that fail check_pkginfo are left alone as "invalid".
+
+    Returns:
+        Tuple of (status, error, change). Status is one of
+        MUTATION_STATUSES; error is the exception that caused a
+        failure, or None. Change is a tuple of the (original, changed)
+        pkginfo if it changed and keep_changes is True, else None.
+    """
+    if not os.path.exists(path):
+        return "missing", None, None
+    try:
+        with PROFILER.file("read pkginfo", path) as record, \
+                open(path, "rb") as pkginfo_file:
+            original = pkginfo_file.read()
+            record.bytes_read = len(original)
+            key = ParseCache.get_key(os.fstat(pkginfo_file.fileno()))
+        pkginfo = PARSE_CACHE.get(key)
+        if pkginfo is None:
+            pkginfo = PLIST_IO.loads(original)
+            PARSE_CACHE.put(key, pkginfo)
+        problem = check_pkginfo(pkginfo) if validate else None
+        if problem:
+            return "invalid", problem, None
+        if not mutator(pkginfo):
+            return "unchanged", None, None
+        if writer:
+            writer.stage(pkginfo, path, original)
+    # Any error is confined to its file and reported in the summary.
+    except Exception as error:  # pylint: disable=broad-except
+        return "failed", error, None
+    change = None
+    if keep_changes:
+        original_pkginfo = PARSE_CACHE.get(key)
+        if original_pkginfo is None:
+            original_pkginfo = PLIST_IO.loads(original)
+        change = (original_pkginfo, pkginfo)
+    return "changed", None, change
+
+
+class PkginfoWriter(object):
+    """Crash-safe writer for a batch of pkginfo files.
+
+    Changed pkginfos are first staged to hidden temp files alongside
+    the originals. On commit, each directory's temp files are synced
+    together, renamed over their originals, and then the directory is
+    synced once, rather than paying for a directory sync per file. An
+    interruption therefore leaves every pkginfo either entirely old or
+    entirely new, never truncated.
+
+    If given a journal_dir, the batch is recorded in a MutationJournal
+    with backups of the original files, which is removed once the
+    commit succeeds.
+    """
+
+    def __init__(self, paths, journal_dir=None):
+        self.batch_id = "{}-{}-{}".format(
+            datetime.datetime.now().strftime("%Y%m%d-%H%M%S"), os.getpid(),
+            next(_BATCH_NUMBERS))
+        self.journal = None
+        if journal_dir:
+            self.journal = MutationJournal.create(
+                journal_dir, self.batch_id, paths)
+        self.staged = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def stage(self, pkginfo, path, original):
+        """Write pkginfo to a temp file beside path, to be committed.
+
+        Args:
+            pkginfo (plist): The changed pkginfo.
+            path (str): Path of the pkginfo file it will replace.
+            original (str): The current content of path, for the
+                journal.
+        """
+        if self.journal:
+            self.journal.backup(path, original)
+        temp_path = get_temp_path(path, self.batch_id)
+        data = PLIST_IO.dumps(pkginfo)
+        with PROFILER.file("stage write", path) as record, \
+                open(temp_path, "wb") as temp_file:
+            temp_file.write(data)
+            record.bytes_written = len(data)
+        shutil.copymode(path, temp_path)
+        with self.lock:
+            self.staged[path] = temp_path
+
+    def discard(self):
+        """Remove every staged file and the journal, changing nothing."""
+        for temp_path in self.staged.values():
+            remove_quietly(temp_path)
+        self.staged.clear()
+        if self.journal:
+            self.journal.close()
+
+    def commit(self, jobs=1):
+        """Replace each staged pkginfo's original file.
+
+        Directories are committed concurrently by jobs threads.
+
+        Returns:
+            Dict of path: exception for any file that could not be
+            committed. The journal is kept if there are any.
+        """
+        if self.journal:
+            self.journal.sync()
+        directories = collections.OrderedDict()
+        for path, temp_path in self.staged.items():
+            directories.setdefault(os.path.dirname(path), []).append(
+                (path, temp_path))
+
+        errors = {}
+        for result in map_threaded(commit_directory, directories.items(),
+                                   jobs):
+            errors.update(result)
+
+        if self.journal and not errors:
+            self.journal.close()
+        return errors
+
+
+def commit_directory(directory_items):
+    """Sync and rename staged files over their originals in one dir.
+
+    Args:
+        directory_items (tuple): (directory path, list of
+            (path, temp path) tuples for files in that directory).
+
+    Returns:
+        Dict of path: exception for any file that failed.
+    """
+    directory, items = directory_items
+    errors = {}
+    with PROFILER.file("commit directory", directory):
+        for path, temp_path in items:
+            try:
+                fsync_path(temp_path)
+            except EnvironmentError as error:
+                errors[path] = error
+        for path, temp_path in items:
+            if path in errors:
+                remove_quietly(temp_path)
+                continue
+            try:
+                os.rename(temp_path, path)
+            except EnvironmentError as error:
+                errors[path] = error
+                remove_quietly(temp_path)
+        try:
+            fsync_path(directory)
+        except EnvironmentError:
+            # Not every (network) filesystem supports syncing directories.
+            pass
+    return errors
+
+
+def write_file_atomically(data, path):
+    """Replace path's content with data via a synced temp file."""
+    temp_path = get_temp_path(path, os.getpid())
+    with PROFILER.file("write file", path) as record, \
+            open(temp_path, "wb") as temp_file:
+        record.bytes_written = len(data)
+        temp_file.write(data)
+        temp_file.flush()
+        os.fsync(temp_file.fileno())
+    if os.path.exists(path):
+        shutil.copymode(path, temp_path)
+    os.rename(temp_path, path)
+    fsync_path(os.path.dirname(path) or ".")
+
+
+def get_temp_path(path, batch_id):
+    """Return the hidden temp path used to stage a write to path."""
+    return os.path.join(os.path.dirname(path), ".{}.{}{}".format(
+        os.path.basename(path), batch_id, TEMP_SUFFIX))
+
+
+def fsync_path(path):
+    """Flush the file or directory at path to disk."""
+    descriptor = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def remove_quietly(path):
+    """Remove the file at path, ignoring errors."""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class MutationJournal(object):
+    """Record of a batch of pkginfo writes, for crash recovery.
+
+    A journal is a directory holding a manifest of the batch (the
+    command line and the paths it may change) and a backup of each
+    original file, made before its replacement is staged. The manifest
+    is written once per batch, and backups are synced together before
+    any original is replaced. Paths are stored absolute, so a journal
+    can be resumed or rolled back from any working directory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.journal_id = os.path.basename(path)
+        self.manifest = read_plist(os.path.join(path, JOURNAL_MANIFEST))
+        # Relative paths are resolved against the batch's working dir.
+        self.paths = [os.path.join(self.manifest["cwd"], path) for path in
+                      self.manifest["paths"]]
+        self.indexes = {path: index for index, path in enumerate(self.paths)}
+
+    @classmethod
+    def create(cls, journal_dir, journal_id, paths):
+        """Start a new journal for the batch of paths."""
+        path = os.path.join(journal_dir, journal_id)
+        os.makedirs(path)
+        paths = (os.path.abspath(path) for path in paths)
+        manifest = {"argv": sys.argv, "cwd": os.getcwd(),
+                    "paths": list(collections.OrderedDict.fromkeys(paths))}
+        with open(os.path.join(path, JOURNAL_MANIFEST), "wb") as manifest_file:
+            manifest_file.write(PLIST_IO.dumps_cache(manifest))
+        return cls(path)
+
+    @classmethod
+    def list(cls, journal_dir):
+        """Return the journals left in journal_dir, oldest first."""
+        if not os.path.isdir(journal_dir):
+            return []
+        return [cls(os.path.join(journal_dir, journal_id)) for journal_id in
+                sorted(os.listdir(journal_dir))]
+
+    def backup(self, path, data):
+        """Save data, the original content of path."""
+        backup_path = self.get_backup_path(path)
+        if not os.path.exists(backup_path):
+            with PROFILER.file("journal backup", path) as record, \
+                    open(backup_path, "wb") as backup_file:
+                backup_file.write(data)
+                record.bytes_written = len(data)
+
+    def get_backup_path(self, path):
+        """Return the path of path's backup in the journal."""
+        return os.path.join(self.path, "{}.orig".format(
+            self.indexes[os.path.abspath(path)]))
+
+    def sync(self):
+        """Flush the manifest, backups and journal dir to disk."""
+        for filename in os.listdir(self.path):
+            fsync_path(os.path.join(self.path, filename))
+        fsync_path(self.path)
+
+    def resume(self):
+        """Commit every write the interrupted batch had staged.
+
+        A backed up pkginfo whose staged write is gone, but which still
+        has its original content, lost its change; it is reported as
+        an error and the journal is kept, so it can be rolled back.
+
+        Returns:
+            Dict of path: exception for any file that could not be
+            committed.
+        """
+        directories = collections.OrderedDict()
+        errors = {}
+        for path in self.paths:
+            temp_path = get_temp_path(path, self.journal_id)
+            if os.path.exists(temp_path):
+                directories.setdefault(os.path.dirname(path), []).append(
+                    (path, temp_path))
+            elif not self.is_committed(path):
+                errors[path] = EnvironmentError(
+                    errno.ENOENT, "Staged write is missing", temp_path)
+        for directory_items in directories.items():
+            errors.update(commit_directory(directory_items))
+        if not errors:
+            self.close()
+        return errors
+
+    def is_committed(self, path):
+        """Return whether path has no staged change left to commit.
+
+        That is, path was never backed up, so never staged, or it no
+        longer matches its backup.
+        """
+        backup_path = self.get_backup_path(path)
+        if not os.path.exists(backup_path):
+            return True
+        try:
+            with open(backup_path, "rb") as backup_file, \
+                    open(path, "rb") as pkginfo_file:
+                return backup_file.read() != pkginfo_file.read()
+        except EnvironmentError:
+            return False
+
+    def rollback(self):
+        """Restore every backed up pkginfo and discard staged writes."""
+        errors = {}
+        for path in self.paths:
+            remove_quietly(get_temp_path(path, self.journal_id))
+            backup_path = self.get_backup_path(path)
+            if not os.path.exists(backup_path):
+                continue
+            try:
+                with open(backup_path, "rb") as backup_file:
+                    write_file_atomically(backup_file.read(), path)
+            except EnvironmentError as error:
+                errors[path] = error
+        if not errors:
+            self.close()
+        return errors
+
+    def close(self):
+        """Delete the journal."""
+        shutil.rmtree(self.path)
+
+
+class MutationSummary(object):
+    """Per-file results of a batch of pkginfo mutations."""
+
+    def __init__(self):
+        self.results = collections.OrderedDict(
+            (status, []) for status in MUTATION_STATUSES)
+        self.errors = {}
+        self.changes = []
+        # Path: unified diff lines, for dry runs.
+        self.diffs = collections.OrderedDict()
+        # Whether a validated batch was abandoned over PROBLEM_STATUSES.
+        self.aborted = False
+
+    def add(self, path, status, error=None, change=None):
+        """Record the status of path, and its error or change if any."""
+        self.results[status].append(path)
+        if error:
+            self.errors[path] = error
+        if change and status == "changed":
+            self.changes.append(change)
+
+    def report(self):
+        """Print the count for each status and any problem paths."""
+        if self.aborted:
+            print "{} of {} pkginfo files failed validation; nothing was " \
+                "changed.".format(
+                    sum(len(self.results[status]) for status in
+                        PROBLEM_STATUSES),
+                    sum(len(paths) for paths in self.results.values()))
+        else:
+            print ", ".join("{} {}".format(len(paths), status) for
+                            status, paths in self.results.items())
+            if self.results["unchanged"]:
+                print "Skipped writing {} unchanged pkginfo files.".format(
+                    len(self.results["unchanged"]))
+        for path in self.results["missing"]:
+            print "Missing: {}".format(path)
+        for path in self.results["invalid"]:
+            print u"Invalid: {} ({})".format(path, self.errors[path]).encode(
+                "utf-8")
+        for path in self.results["failed"]:
+            print "Failed: {} ({})".format(path, self.errors[path])
+
+
+def update_catalogs(repo, changes):
+    """Patch repo's catalogs to reflect changed pkginfos.
+
+    Only the "all" catalog and the catalogs that changed pkginfos left
+    or joined are touched, each with a single read and write. A
+    catalog entry is matched to a change if it equals the original
+    pkginfo's catalog entry, or failing that, if it is the catalog's
+    only entry with the same name and version. Matched entries are
+    replaced or dropped; pkginfos new to a catalog are appended.
+
+    Args:
+        repo (str): Path to the Munki repo.
+        changes (list of tuples): (original pkginfo, changed pkginfo)
+            for each changed file.
+
+    Returns:
+        Sorted list of the names of the catalogs that were written.
+    """
+    affected = get_affected_catalogs(changes)
+    catalog_dir = os.path.join(repo, "catalogs")
+    for catalog in affected:
+        catalog_path = os.path.join(catalog_dir, catalog)
+        entries = []
+        if os.path.exists(catalog_path):
+            entries = read_plist(catalog_path)
+        entries = patch_catalog(catalog, entries, changes)
+        write_file_atomically(PLIST_IO.dumps(entries),
+                              catalog_path)
+    return affected
+
+
+def get_affected_catalogs(changes):
+    """Return the sorted names of the catalogs changes touch."""
+    affected = {"all"}
+    for original, changed in changes:
+        affected.update(original.get("catalogs") or [])
+        affected.update(changed.get("catalogs") or [])
+    return sorted(affected)
+
+
+def patch_catalog(catalog, entries, changes):
+    """Return catalog's entries updated with changes.
+
+    Args are as per update_catalogs, with catalog being the name of
+    the catalog and entries its current list of entries.
+    """
+    pending = {}
+    for change in changes:
+        pending.setdefault(get_item_key(change[0]), []).append(change)
+    entry_counts = collections.Counter(
+        get_item_key(entry) for entry in entries)
+
+    patched = []
+    for entry in entries:
+        key = get_item_key(entry)
+        candidates = pending.get(key, [])
+        match = next((change for change in candidates if
+                      make_catalog_entry(change[0]) == entry), None)
+        if not match and entry_counts[key] == 1 and len(candidates) == 1:
+            match = candidates[0]
+        if not match:
+            patched.append(entry)
+            continue
+        candidates.remove(match)
+        if is_in_catalog(catalog, match[1]):
+            patched.append(make_catalog_entry(match[1]))
+
+    for candidates in pending.values():
+        patched.extend(make_catalog_entry(changed) for _, changed in
+                       candidates if is_in_catalog(catalog, changed))
+    return patched
+
+
+def get_item_key(pkginfo):
+    """Return the (name, version) that identifies an item."""
+    return pkginfo.get("name"), pkginfo.get("version")
+
+
+def make_catalog_entry(pkginfo):
+    """Return a copy of pkginfo as makecatalogs would list it.
+
+    makecatalogs leaves out admin notes and every key starting with an
+    underscore, such as _metadata.
+    """
+    return {key: value for key, value in pkginfo.items() if
+            key != "notes" and not key.startswith("_")}
+
+
+def is_in_catalog(catalog, pkginfo):
+    """Return whether pkginfo belongs in catalog ("all" holds all)."""
+    return catalog == "all" or catalog in (pkginfo.get("catalogs") or [])
 
 
 def get_pkginfo_from_file(path):
@@ -348,37 +3724,20 @@ def get_datetime(date):
     return datetime.datetime.strptime(date, "%Y-%m-%dT%H:%M:%SZ")
 
 
-def is_valid_date(date):
-    """Ensure date is in the correct format.
-
-    Format is: 'yyyy-mm-ddThh:mm:ssZ'. For example, August 3rd 2011 at
-        1PM is: '2011-08-03T13:00:00Z'.
-
-    date (string): Date string to validate.
-
-    Returns:
-        Boolean.
-    """
-    result = False
-    try:
-        _ = datetime.datetime.strptime(date, "%Y-%m-%dT%H:%M:%SZ")
-        result = True
-    except ValueError:
-        pass
-    return result
-
-
 def set_force_install_after_date(date, pkginfo):
     """Set the force_install_after_date value for pkginfo file.
 
     Args:
         date (datetime.datetime): Date to force install after.
         pkginfo (plist): File to on which to change date.
+
+    Returns:
+        Boolean whether pkginfo was changed.
     """
     if date:
-        pkginfo["force_install_after_date"] = date
-    elif pkginfo.get("force_install_after_date"):
-        del pkginfo["force_install_after_date"]
+        return set_key("force_install_after_date", date, pkginfo)
+    else:
+        return remove_key("force_install_after_date", pkginfo)
 
 
 def set_unattended_install(val, pkginfo):
@@ -387,8 +3746,11 @@ def set_unattended_install(val, pkginfo):
     Args:
         val (bool): Value to set.
         pkginfo (plist): File to on which to change date.
+
+    Returns:
+        Boolean whether pkginfo was changed.
     """
-    set_key("unattended_install", val, pkginfo)
+    return set_key("unattended_install", val, pkginfo)
 
 
 def set_catalog(val, pkginfo):
@@ -397,11 +3759,14 @@ def set_catalog(val, pkginfo):
     Args:
         val (string): Catalog to set.
         pkginfo (plist): File to on which to change date.
+
+    Returns:
+        Boolean whether pkginfo was changed.
     """
     catalogs = []
     if val:
         catalogs.append(val)
-    set_key("catalogs", [val], pkginfo)
+    return set_key("catalogs", [val], pkginfo)
 
 
 def set_key(key, val, pkginfo):
@@ -413,8 +3778,15 @@ def set_key(key, val, pkginfo):
             List and dict values may include any combination of other
             valid types from this list.
         pkginfo (plist): The pkginfo plist object to change.
+
+    Returns:
+        Boolean whether pkginfo was changed, i.e. False if key was
+        already set to val.
     """
+    if key in pkginfo and is_same_value(pkginfo[key], val):
+        return False
     pkginfo[key] = val
+    return True
 
 
 def remove_key(key, pkginfo):
@@ -423,11 +3795,200 @@ def remove_key(key, pkginfo):
     Args:
         key (string): Key to remove.
         pkginfo (plist): The pkginfo plist object to change.
+
+    Returns:
+        Boolean whether pkginfo was changed.
     """
     if key in pkginfo:
         del pkginfo[key]
-    # TODO: This could be restricted to only when files are changed
-    # TODO: Output when something is changed/ not changed.
+        return True
+    return False
+
+
+def is_same_value(old, new):
+    """Return whether two plist values are equal.
+
+    Python considers True == 1, but a plist <true/> and <integer>
+    differ, so bools only match other bools.
+    """
+    if isinstance(old, bool) or isinstance(new, bool):
+        return type(old) is type(new) and old == new
+    elif isinstance(old, (list, tuple)) and isinstance(new, (list, tuple)):
+        return len(old) == len(new) and all(
+            is_same_value(old_item, new_item) for
+            old_item, new_item in zip(old, new))
+    elif isinstance(old, dict) and isinstance(new, dict):
+        return sorted(old.keys()) == sorted(new.keys()) and all(
+            is_same_value(old[key], new[key]) for key in old)
+    return old == new
+
+
+class Profiler(object):
+    """Per-stage timing and I/O accounting for a phasetool run.
+
+    Stages are timed with the stage context manager, or iter_stage for
+    generators, which only counts the time spent producing items. Wall
+    and CPU times are inclusive of any nested stages, and CPU time is
+    for the whole process, so it includes every thread.
+
+    Individual file operations are recorded with file (or record_file)
+    and add to a stage's file count, file time and bytes read and
+    written. Files are timed per thread, so the file time of a stage
+    run by a pool can exceed its wall time.
+
+    While disabled, every method is a cheap no-op.
+    """
+
+    class FileRecord(object):
+        """Times one file operation; set its byte counts as known."""
+
+        def __init__(self, profiler=None, stage=None, path=None):
+            self.profiler = profiler
+            self.stage = stage
+            self.path = path
+            self.bytes_read = 0
+            self.bytes_written = 0
+            self.start = None
+
+        def __enter__(self):
+            if self.profiler:
+                self.start = time.time()
+            return self
+
+        def __exit__(self, *_):
+            if self.profiler:
+                self.profiler.record_file(
+                    self.stage, self.path, time.time() - self.start,
+                    self.bytes_read, self.bytes_written)
+
+    def __init__(self):
+        self.enabled = False
+        self.slowest_count = 0
+        self.stages = collections.OrderedDict()
+        self.slowest = []
+        self.lock = threading.Lock()
+        self.started = None
+
+    def enable(self, slowest_count=10):
+        """Start recording, keeping the slowest_count slowest files."""
+        self.enabled = True
+        self.slowest_count = slowest_count
+        self.started = (time.time(), get_cpu_time())
+
+    def get_stage(self, name):
+        """Return the counters for stage name, creating them."""
+        if name not in self.stages:
+            self.stages[name] = {
+                "wall_seconds": 0.0, "cpu_seconds": 0.0, "calls": 0,
+                "files": 0, "file_seconds": 0.0, "bytes_read": 0,
+                "bytes_written": 0}
+        return self.stages[name]
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Time the enclosed block as (part of) stage name."""
+        if not self.enabled:
+            yield
+            return
+        with self.lock:
+            # Register the stage on entry, so nested stages follow it.
+            counters = self.get_stage(name)
+        wall, cpu = time.time(), get_cpu_time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                counters["wall_seconds"] += time.time() - wall
+                counters["cpu_seconds"] += get_cpu_time() - cpu
+                counters["calls"] += 1
+
+    def iter_stage(self, name, iterable):
+        """Return iterable, timing the production of each item."""
+        if not self.enabled:
+            return iterable
+        return self._iter_stage(name, iter(iterable))
+
+    def _iter_stage(self, name, iterator):
+        """Generator for iter_stage."""
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def file(self, stage, path):
+        """Return a FileRecord context manager for a file operation."""
+        if not self.enabled:
+            return _NULL_FILE_RECORD
+        return self.FileRecord(self, stage, path)
+
+    def record_file(self, stage, path, seconds, bytes_read=0,
+                    bytes_written=0):
+        """Add a completed file operation to stage's counters."""
+        if not self.enabled:
+            return
+        with self.lock:
+            counters = self.get_stage(stage)
+            counters["files"] += 1
+            counters["file_seconds"] += seconds
+            counters["bytes_read"] += bytes_read
+            counters["bytes_written"] += bytes_written
+            entry = (seconds, path, stage)
+            if len(self.slowest) < self.slowest_count:
+                heapq.heappush(self.slowest, entry)
+            elif self.slowest_count:
+                heapq.heappushpop(self.slowest, entry)
+
+    def get_report(self):
+        """Return the recorded data as a JSON-serializable dict."""
+        wall, cpu = self.started
+        return {"argv": sys.argv,
+                "wall_seconds": time.time() - wall,
+                "cpu_seconds": get_cpu_time() - cpu,
+                "stages": self.stages,
+                "slowest_files": [
+                    {"seconds": seconds, "path": path, "stage": stage} for
+                    seconds, path, stage in sorted(self.slowest,
+                                                   reverse=True)]}
+
+    def print_summary(self, output=sys.stderr):
+        """Print a human readable summary of the run."""
+        report = self.get_report()
+        print >> output, "Total: {:.3f}s wall, {:.3f}s CPU".format(
+            report["wall_seconds"], report["cpu_seconds"])
+        print >> output, (
+            "{:<20} {:>9} {:>9} {:>8} {:>10} {:>12} {:>12}".format(
+                "Stage", "Wall (s)", "CPU (s)", "Files", "File (s)", "Read",
+                "Written"))
+        for name, counters in report["stages"].items():
+            print >> output, (
+                "{:<20} {wall_seconds:>9.3f} {cpu_seconds:>9.3f} "
+                "{files:>8} {file_seconds:>10.3f} {bytes_read:>12} "
+                "{bytes_written:>12}".format(name, **counters))
+        if report["slowest_files"]:
+            print >> output, "Slowest files:"
+        for entry in report["slowest_files"]:
+            print >> output, "{seconds:>9.3f}s {stage:<16} {path}".format(
+                **entry)
+
+    def write_report(self, path):
+        """Write the JSON report to path."""
+        with open(path, "w") as report_file:
+            json.dump(self.get_report(), report_file, indent=2)
+
+
+def get_cpu_time():
+    """Return the user plus system CPU time used by this process."""
+    times = os.times()
+    return times[0] + times[1]
+
+
+_NULL_FILE_RECORD = Profiler.FileRecord()
+PROFILER = Profiler()
+PLIST_IO = PlistIO((FoundationPlistCodec(), PlistCodec(), BiplistCodec()))
+PARSE_CACHE = ParseCache()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# Copyright (C) 2015 Shea G Craig <shea.craig@sas.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""Rolling phase testing schedule.
+
+Each scheduled pkginfo starts phase testing on its own date and moves
+through PHASES on days offset from it, rather than the whole repo
+moving together each month. The schedule is kept in a sqlite file with
+the date each item is next due to change phase indexed, so finding the
+items due on a given day doesn't scan the rest.
+"""
+
+
+import collections
+import datetime
+
+
+# A phase's catalog and display title, and the days after an item's
+# start date on which it becomes available in, and is required by, the
+# phase.
+Phase = collections.namedtuple(
+    "Phase", ("catalog", "title", "available", "required"))
+# The only definition of the phases; phasetool's collect listing reads
+# it from here too.
+PHASES = (Phase("phase1", "Phase 1", 0, 3),
+          Phase("phase2", "Phase 2", 6, 10),
+          Phase("phase3", "Phase 3", 13, 17),
+          Phase("production", "Production", 20, 25))
+# Time of day on its required date that a phase's install is forced.
+REQUIRED_TIME = datetime.time(13)
+DATE_FORMAT = "%Y-%m-%d"
+# A scheduled item, the index in PHASES of the phase it is in (-1
+# before its start date), and the date it moves to the next phase.
+Entry = collections.namedtuple("Entry", ("relpath", "start", "phase", "due"))
+# A move of a scheduled item into the phase at index phase of PHASES.
+Transition = collections.namedtuple("Transition",
+                                    ("relpath", "start", "phase"))
+
+
+class Schedule(object):
+    """Persistent phase schedule of the pkginfo files in repos.
+
+    The schedule table holds a row per scheduled pkginfo, by repo and
+    path relative to it, with its start date, current phase and the
+    date its next phase begins. Items are removed once they reach the
+    last phase.
+    """
+
+    schema = (
+        "CREATE TABLE IF NOT EXISTS schedule ("
+        "repo TEXT NOT NULL, relpath TEXT NOT NULL, start TEXT NOT NULL, "
+        "phase INTEGER NOT NULL, due TEXT NOT NULL, "
+        "PRIMARY KEY (repo, relpath));"
+        "CREATE INDEX IF NOT EXISTS schedule_by_due "
+        "ON schedule (repo, due);")
+
+    def __init__(self, path):
+        # Imported here, as collect only needs PHASES.
+        import sqlite3
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.text_factory = unicode
+        self.connection.executescript(self.schema)
+
+    def add(self, repo, relpaths, start):
+        """Schedule relpaths to start phase testing on start.
+
+        Items already scheduled start over.
+
+        Args:
+            repo (str): Absolute path to the Munki repo.
+            relpaths (iterable of str): Paths to pkginfo files, relative
+                to repo.
+            start (datetime.date): Day to move the items to the first
+                phase.
+        """
+        due = format_date(get_phase_date(start, 0))
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO schedule VALUES (?, ?, ?, -1, ?)",
+            ((repo, relpath, format_date(start), due) for relpath in
+             relpaths))
+        self.connection.commit()
+
+    def due(self, repo, today):
+        """Return the Transitions due in repo on or before today.
+
+        Items that have missed more than one phase change move
+        straight to the latest phase they are due for.
+        """
+        cursor = self.connection.execute(
+            "SELECT relpath, start, phase FROM schedule WHERE repo = ? AND "
+            "due <= ? ORDER BY due, relpath", (repo, format_date(today)))
+        transitions = []
+        for relpath, start, phase in cursor:
+            start = parse_date(start)
+            phase += 1
+            while (phase + 1 < len(PHASES) and
+                   get_phase_date(start, phase + 1) <= today):
+                phase += 1
+            transitions.append(Transition(relpath, start, phase))
+        return transitions
+
+    def advance(self, repo, transitions):
+        """Record that transitions have been applied."""
+        finished = []
+        moved = []
+        for transition in transitions:
+            if transition.phase + 1 < len(PHASES):
+                due = get_phase_date(transition.start, transition.phase + 1)
+                moved.append((transition.phase, format_date(due), repo,
+                              transition.relpath))
+            else:
+                finished.append(transition.relpath)
+        self.connection.executemany(
+            "UPDATE schedule SET phase = ?, due = ? WHERE repo = ? AND "
+            "relpath = ?", moved)
+        self.remove(repo, finished)
+
+    def remove(self, repo, relpaths):
+        """Remove relpaths from the schedule."""
+        self.connection.executemany(
+            "DELETE FROM schedule WHERE repo = ? AND relpath = ?",
+            ((repo, relpath) for relpath in relpaths))
+        self.connection.commit()
+
+    def entries(self, repo):
+        """Return an Entry for each item scheduled in repo, by due date."""
+        cursor = self.connection.execute(
+            "SELECT relpath, start, phase, due FROM schedule WHERE repo = ? "
+            "ORDER BY due, relpath", (repo,))
+        return [Entry(relpath, parse_date(start), phase, parse_date(due)) for
+                relpath, start, phase, due in cursor]
+
+
+def get_phase_date(start, phase):
+    """Return the date the phase at index phase of PHASES begins."""
+    return start + datetime.timedelta(days=PHASES[phase].available)
+
+
+def get_required_date(start, phase):
+    """Return when to force installs in the phase at index phase."""
+    day = start + datetime.timedelta(days=PHASES[phase].required)
+    return datetime.datetime.combine(day, REQUIRED_TIME)
+
+
+def format_date(day):
+    """Return the schedule's string for a date."""
+    return day.strftime(DATE_FORMAT)
+
+
+def parse_date(text):
+    """Return a date from a string in DATE_FORMAT.
+
+    Raises:
+        ValueError if text is not in DATE_FORMAT.
+    """
+    return datetime.datetime.strptime(text, DATE_FORMAT).date()
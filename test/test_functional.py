@@ -130,10 +130,48 @@ class TestPhaseTool(object):
         assert_true(result[0]["unattended_install"])
         assert_list_equal(result[0]["catalogs"], ["production"])
 
-    @mock.patch("phasetool.write_file", autospec=True)
-    def test_collect_updates(self, mock_repo):
+    def test_bulk_edits(self):
+        """Leif has several keys to change on his pkginfos."""
+        # Leif starts out the old way, one key at a time.
+        args = ["bulk", "developer", "Crypt Devs", self.test_file]
+        result = self.get_phasetool_results(args)
+        assert_equal("Crypt Devs", result[0]["developer"])
+
+        # Then he realizes he can do them all in one pass.
+        args = ["bulk", "--set", "developer=Crypt Devs", "--set",
+                "unattended_install=bool:false", "--set",
+                "blocking_applications=list:Crypt.app,CryptHelper.app",
+                "--remove", "uninstallable", self.test_file]
+        result = self.get_phasetool_results(args)
+        assert_equal(1, len(result))
+        assert_equal("Crypt Devs", result[0]["developer"])
+        assert_false(result[0]["unattended_install"])
+        assert_list_equal(["Crypt.app", "CryptHelper.app"],
+                          result[0]["blocking_applications"])
+        assert_not_in("uninstallable", result[0])
+
+        # Leif only wants to touch items that are still in testing.
+        args = ["bulk", "--set", "developer=Crypt Devs", "--if",
+                "catalogs contains testing", self.test_file]
+        result = self.get_phasetool_results(args)
+        assert_is_none(result)
+
+    @mock.patch("phasetool.datetime", wraps=datetime)
+    @mock.patch("phasetool.write_lines", autospec=True)
+    def test_collect_updates(self, mock_repo, mock_datetime):
         """Test collecting updates from a repo for phase testing."""
+        mock_datetime.datetime.now.return_value = datetime.datetime(
+            2015, 11, 2)
+        mock_datetime.date.today.return_value = datetime.date(2015, 11, 2)
         expected_result = ("## November Phase Testing Updates\n\n"
+                           "## Schedule\n"
+                           "| Phase | Available | Required |\n"
+                           "| ----- | --------- | -------- |\n"
+                           "| Phase 1 | 2015-11-02 | 2015-11-05 |\n"
+                           "| Phase 2 | 2015-11-08 | 2015-11-12 |\n"
+                           "| Phase 3 | 2015-11-15 | 2015-11-19 |\n"
+                           "| Production | 2015-11-22 | 2015-11-27 |\n"
+                           "\n"
                            "- Crypt - enables FileVault encryption 0.8.0\n"
                            "- Crypt - enables FileVault encryption 0.9.0\n"
                            "- Crypt - enables FileVault encryption 1.0.0\n"
@@ -144,14 +182,15 @@ class TestPhaseTool(object):
                           "test/resources/repo/pkgsinfo/Crypt-1.5.0.pkginfo")
         # Leif is testing the collection of updates to see what it
         # finds
-        sys.argv = build_args(["--repo", "test/resources/repo", "collect"])
+        sys.argv = build_args(["--repo", "test/resources/repo", "collect",
+                               "/tmp"])
         phasetool.main()
-        result_content = mock_repo.call_args_list[0][0][0]
-        result_files = mock_repo.call_args_list[1][0][0]
+        result_content = "\n".join(mock_repo.call_args_list[0][0][0])
+        result_files = "\n".join(mock_repo.call_args_list[1][0][0])
         assert_equal(expected_result, result_content)
         assert_equal(expected_files, result_files)
 
-    @mock.patch("phasetool.plistlib.writePlist", autospec=True)
+    @mock.patch("phasetool.PkginfoWriter.stage")
     def get_phasetool_results(self, args, mock_write_plist):
         """Put args into sys.argv and run phasetool.
 
@@ -161,7 +200,7 @@ class TestPhaseTool(object):
 
         Returns:
             Takes mock.MagicMock object's call_args_list for mocked
-            plistlib.writePlist and returns a list of just the plist
+            PkginfoWriter.stage and returns a list of just the plist
             files that were "written".
         """
         sys.argv = build_args(args)
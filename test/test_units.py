@@ -19,12 +19,23 @@
 
 
 import datetime
+import errno
+import glob
 import os
+import shutil
+import StringIO
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 
 import mock
+from nose.plugins.skip import SkipTest
 from nose.tools import *  # pylint: disable=unused-wildcard-import, wildcard-import
 
 import phasetool  # pylint: disable=import-error
+import scheduler  # pylint: disable=import-error
 
 
 class MockArgs(object):
@@ -38,6 +49,18 @@ class MockArgs(object):
         self.repo_url = repo_url
 
 
+class RepoFixture(object):
+    """Base for tests that work on a scratch copy of the test repo."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.repo = os.path.join(self.tempdir, "repo")
+        shutil.copytree("test/resources/repo", self.repo)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+
 class TestGetMunkiRepo(object):
     """Test the phasetool munki repo units."""
 
@@ -72,6 +95,28 @@ class TestGetMunkiRepo(object):
         self.run_with_mock_args(args, expected, mock_mount)
         mock_mount.assert_any_call("AFP")
 
+    @mock.patch("phasetool.mount")
+    def test_get_munki_repo_from_mount_cache(self, mock_mount):
+        tempdir = tempfile.mkdtemp()
+        try:
+            mock_args = MockArgs("/nonexistent/path", "AFP")
+            mock_args.cache_dir = tempdir
+            mock_mount.return_value = tempdir
+            assert_equal(tempdir, phasetool.get_munki_repo(mock_args))
+            mock_mount.reset_mock()
+            assert_equal(tempdir, phasetool.get_munki_repo(mock_args))
+            assert_false(mock_mount.called)
+        finally:
+            shutil.rmtree(tempdir)
+
+    @mock.patch("phasetool.mount")
+    def test_get_munki_repo_mount_timeout(self, mock_mount):
+        mock_args = MockArgs("/nonexistent/path", "AFP")
+        mock_args.mount_timeout = 0.01
+        mock_mount.side_effect = lambda _: time.sleep(1)
+        assert_raises(phasetool.PhasetoolError, phasetool.get_munki_repo,
+                      mock_args)
+
 
 class TestMount(object):
     """Test os-specific mounting."""
@@ -96,6 +141,22 @@ class TestMount(object):
     def test_osx_alien_py_mount(self, mock_msb, mock_uname, mock_mount):
         self.run_mount(("Darwin", "/Volumes"), mock_uname, mock_mount)
 
+    def test_probe_mounts(self):
+        stale = OSError(errno.ESTALE, "Stale NFS file handle")
+
+        def fake_stat(path):
+            if path == "/stale":
+                raise stale
+            elif path == "/hung":
+                time.sleep(1)
+            return os.lstat(path)
+
+        with mock.patch("phasetool.os.stat", side_effect=fake_stat):
+            statuses = phasetool.probe_mounts(
+                ["/tmp", "/nonexistent/path", "/stale", "/hung"], 0.1)
+        assert_equal({"/tmp": "mounted", "/nonexistent/path": "missing",
+                      "/stale": "stale", "/hung": "stale"}, statuses)
+
     def run_mount(self, os_info, mock_uname, mock_mount):
         expected = os.path.join(os_info[1], "repo")
         args = "afp://u:p@server/repo"
@@ -107,48 +168,166 @@ class TestMount(object):
 class TestDates(object):
     """Test the date functions."""
 
-    def test_is_valid_date(self):
+    def test_get_date_arg(self):
         test_date = "2011-08-03T13:00:00Z"
         invalid_test_dates = ("Both how I'm livin' and my nose are large.",
                               "2011-08-0313:00:00", "February 15th, 2015",
                               "101015")
-        assert_true(phasetool.is_valid_date(test_date))
+        assert_equal(datetime.datetime(2011, 8, 3, 13),
+                     phasetool.get_date_arg(test_date))
+        assert_is_none(phasetool.get_date_arg(""))
         for invalid_date in invalid_test_dates:
-            assert_false(phasetool.is_valid_date(invalid_date))
+            assert_raises(SystemExit, phasetool.get_date_arg, invalid_date)
 
 
 class TestPlistSetters(object):
     """Test the plist property setting and removing funcs."""
 
+    def setUp(self):
+        self.pkginfo = {"catalogs": ["phase1"], "unattended_install": False,
+                        "force_install_after_date": datetime.datetime(
+                            2011, 8, 3, 13)}
+
     def test_set_key(self):
-        assert(False)
+        assert_true(phasetool.set_key("name", "Crypt", self.pkginfo))
+        assert_equal("Crypt", self.pkginfo["name"])
+        assert_false(phasetool.set_key("name", u"Crypt", self.pkginfo))
+        # A bool is not the same plist value as an equal integer.
+        assert_true(phasetool.set_key("unattended_install", 0, self.pkginfo))
 
     def test_set_catalog(self):
-        pass
+        assert_false(phasetool.set_catalog("phase1", self.pkginfo))
+        assert_true(phasetool.set_catalog("phase2", self.pkginfo))
+        assert_list_equal(["phase2"], self.pkginfo["catalogs"])
 
     def test_set_unattended_install(self):
-        pass
+        assert_false(phasetool.set_unattended_install(False, self.pkginfo))
+        assert_true(phasetool.set_unattended_install(True, self.pkginfo))
 
     def test_set_force_install_after_date(self):
-        pass
+        date = datetime.datetime(2011, 8, 3, 13)
+        assert_false(
+            phasetool.set_force_install_after_date(date, self.pkginfo))
+        assert_true(
+            phasetool.set_force_install_after_date(None, self.pkginfo))
+        assert_false(
+            phasetool.set_force_install_after_date(None, self.pkginfo))
 
     def test_remove_key(self):
-        pass
+        assert_true(phasetool.remove_key("catalogs", self.pkginfo))
+        assert_not_in("catalogs", self.pkginfo)
+        assert_false(phasetool.remove_key("catalogs", self.pkginfo))
 
 
 class TestCollectUnits(object):
     """Test the collection units."""
 
-    def test_get_testing_pkginfos(self):
+    def test_iter_testing_records(self):
         repo = "test/resources/repo"
-        pkginfos = sorted(phasetool.get_testing_pkginfos(repo).keys())
+        paths = sorted(record.path for record in
+                       phasetool.iter_testing_records(repo))
         # This excludes the production and placeholder pkginfos.
         expected_filenames = ["Crypt-0.8.0.pkginfo", "Crypt-0.9.0.pkginfo",
                               "Crypt-1.0.0.pkginfo", "Crypt-1.5.0.pkginfo"]
         expected = sorted(
             [os.path.join("test/resources/repo/pkgsinfo", filename) for
              filename in expected_filenames])
-        assert_list_equal(expected, pkginfos)
+        assert_list_equal(expected, paths)
+
+    def test_iter_testing_records_fields(self):
+        repo = "test/resources/repo"
+        records = {record.path: record for record in
+                   phasetool.iter_testing_records(repo)}
+        record = records["test/resources/repo/pkgsinfo/Crypt-1.0.0.pkginfo"]
+        assert_equal("Crypt", record.name)
+        assert_equal("1.0.0", record.version)
+        assert_equal(("phase1",), record.catalogs)
+
+    def test_iter_testing_records_with_jobs(self):
+        repo = "test/resources/repo"
+        expected = sorted(phasetool.iter_testing_records(repo),
+                          key=lambda record: record.path)
+        assert_list_equal(
+            expected, sorted(phasetool.iter_testing_records(repo, jobs=2),
+                             key=lambda record: record.path))
+
+    def test_get_testing_pkginfos_from_catalogs(self):
+        repo = "test/resources/repo"
+        pkginfos = phasetool.get_testing_pkginfos_from_catalogs(repo)
+        # The fixture catalogs were built when every phase catalog
+        # held Crypt 0.7.2.
+        expected = [os.path.join(repo, "pkgsinfo", filename) for filename in
+                    ("Crypt-0.7.2.pkginfo", "Crypt-1.5.0.pkginfo")]
+        assert_list_equal(expected, sorted(pkginfos))
+
+    def test_catalog_reads_are_profiled(self):
+        repo = "test/resources/repo"
+        catalogs = [os.path.join(repo, "catalogs", catalog) for catalog in
+                    phasetool.TESTING_CATALOGS if os.path.exists(
+                        os.path.join(repo, "catalogs", catalog))]
+        profiler = phasetool.Profiler()
+        profiler.enable()
+        with mock.patch("phasetool.PROFILER", profiler), \
+                mock.patch("sys.stderr"):
+            phasetool.get_testing_pkginfos_from_catalogs(repo)
+        stage = profiler.get_report()["stages"]["read catalogs"]
+        assert_equal(len(catalogs), stage["files"])
+        assert_equal(sum(os.path.getsize(path) for path in catalogs),
+                     stage["bytes_read"])
+
+    def test_path_resolver_breaks_ties_by_parsing(self):
+        repo = "test/resources/repo"
+        resolver = phasetool.PkginfoPathResolver(repo)
+        duplicate = os.path.join(repo, "pkgsinfo", "Crypt-1.5.0__1.pkginfo")
+        resolver.paths_by_stem["crypt-1.5.0"].append(duplicate)
+        summary = {"name": "Crypt", "version": "1.5.0",
+                   "catalogs": ["testing"]}
+        assert_equal(os.path.join(repo, "pkgsinfo", "Crypt-1.5.0.pkginfo"),
+                     resolver.resolve(summary))
+
+    def test_filter_latest_versions(self):
+        repo = "test/resources/repo"
+        records = phasetool.iter_testing_records(repo)
+        latest = phasetool.filter_latest_versions(records)
+        assert_list_equal(
+            [os.path.join(repo, "pkgsinfo", "Crypt-1.5.0.pkginfo")],
+            [record.path for record in latest])
+
+    def test_pkginfo_record(self):
+        record = phasetool.make_record(
+            "a.pkginfo", {"name": u"Crypt", "version": u"1.0",
+                          "catalogs": [u"phase2", u"production", u"phase1"]})
+        other = phasetool.make_record(
+            "b.pkginfo", {"name": u"Crypt", "version": u"1.0"})
+        assert_equal(("phase1", "phase2"), record.catalogs)
+        assert_equal((), other.catalogs)
+        assert_is(record.name, other.name)
+        assert_false(hasattr(record, "__dict__"))
+
+    @mock.patch("phasetool.INTERNED_STRINGS_LIMIT", 2)
+    @mock.patch("phasetool._INTERNED_STRINGS", {})
+    def test_interned_strings_are_bounded(self):
+        for value in ("a", "b", "c"):
+            phasetool.intern_string(value)
+        assert_equal({"c": "c"}, phasetool._INTERNED_STRINGS)
+
+    def test_get_version_key(self):
+        versions = ("0.9", "1.0", "1.0.1", "1.9", "1.10", "10.0")
+        for version, newer in zip(versions, versions[1:]):
+            assert_less(phasetool.get_version_key(version),
+                        phasetool.get_version_key(newer))
+        assert_equal(phasetool.get_version_key("1.0"),
+                     phasetool.get_version_key("1.0.0"))
+        # As LooseVersion, letters and other separators order above
+        # numbers, and are compared as given.
+        assert_greater(phasetool.get_version_key("1.0b1"),
+                       phasetool.get_version_key("1.0.1"))
+        assert_greater(phasetool.get_version_key("1.0-2"),
+                       phasetool.get_version_key("1.0.2"))
+        assert_not_equal(phasetool.get_version_key("1.0-2"),
+                         phasetool.get_version_key("1.0.2"))
+        assert_not_equal(phasetool.get_version_key("1.0B1"),
+                         phasetool.get_version_key("1.0b1"))
 
     def test_is_testing(self):
         catalogs = ("testing", "phase1", "development")
@@ -166,6 +345,469 @@ class TestCollectUnits(object):
             assert_false(phasetool.is_placeholder(pkginfo))
 
 
+class TestCatalogReader(object):
+    """Test incremental reading of compiled catalogs."""
+
+    def setUp(self):
+        self.catalog = "test/resources/repo/catalogs/all"
+
+    @mock.patch("phasetool.CATALOG_READ_SIZE", 512)
+    def test_matches_read_plist(self):
+        for path in glob.glob("test/resources/repo/catalogs/*"):
+            assert_equal(phasetool.read_plist(path),
+                         list(phasetool.iter_catalog_entries(path)))
+
+    def test_filters(self):
+        entries = phasetool.iter_catalog_entries(
+            self.catalog, names=["Crypt"], catalogs=["phase1", "testing"])
+        assert_list_equal(
+            [("0.7.2", ["phase1"]), ("1.5.0", ["testing"])],
+            [(entry["version"], entry["catalogs"]) for entry in entries])
+        assert_list_equal([], list(phasetool.iter_catalog_entries(
+            self.catalog, names=["Missing"])))
+
+    def test_not_a_catalog(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempdir, "catalog")
+            write_plist({"name": "Crypt"}, path)
+            assert_raises(phasetool.ExpatError, list,
+                          phasetool.iter_catalog_entries(path))
+        finally:
+            shutil.rmtree(tempdir)
+
+
+class TestDiffSnapshot(RepoFixture):
+    """Test comparing collected items with a previous snapshot."""
+
+    def setUp(self):
+        super(TestDiffSnapshot, self).setUp()
+        self.snapshot_path = os.path.join(self.tempdir, "snapshot.plist")
+
+    def get_records(self):
+        return list(phasetool.iter_testing_records(self.repo))
+
+    def diff(self):
+        delta, snapshot = phasetool.diff_snapshot(self.get_records(),
+                                                  self.snapshot_path)
+        write_plist(snapshot, self.snapshot_path)
+        return delta
+
+    def test_diff_snapshot(self):
+        records = self.get_records()
+        assert_equal({record.path for record in records},
+                     self.diff()["added"])
+
+        path = os.path.join(self.repo, "pkgsinfo", "Crypt-1.0.0.pkginfo")
+        removed = os.path.join(self.repo, "pkgsinfo", "Crypt-0.8.0.pkginfo")
+        pkginfo = phasetool.read_plist(path)
+        pkginfo["description"] = "Changed"
+        write_plist(pkginfo, path)
+        os.remove(removed)
+        with mock.patch("phasetool.hash_file",
+                        wraps=phasetool.hash_file) as mock_hash_file:
+            delta = self.diff()
+        mock_hash_file.assert_called_once_with(path)
+        assert_equal({"added": set(), "changed": {path},
+                      "removed": {removed}}, delta)
+
+
+class TestPartialPlistReader(object):
+    """Test reading pkginfo summaries without a full parse."""
+
+    def setUp(self):
+        self.pkgsinfo = "test/resources/repo/pkgsinfo"
+
+    def test_matches_full_read(self):
+        for filename in os.listdir(self.pkgsinfo):
+            path = os.path.join(self.pkgsinfo, filename)
+            if not phasetool.is_pkginfo(path):
+                continue
+            expected = phasetool.summarize_pkginfo(
+                phasetool.read_plist(path))
+            assert_equal(expected, phasetool.read_pkginfo_summary(path))
+
+    @mock.patch("phasetool.read_plist")
+    def test_does_not_fall_back_for_xml(self, mock_read_plist):
+        path = os.path.join(self.pkgsinfo, "Crypt-1.0.0.pkginfo")
+        phasetool.read_pkginfo_summary(path)
+        assert_false(mock_read_plist.called)
+
+    def test_unsupported_values_fall_back(self):
+        data = ("<plist><dict><key>name</key><dict/></dict></plist>")
+        reader = phasetool.PartialPlistReader(phasetool.COLLECT_KEYS)
+        assert_raises(phasetool.PartialPlistReader.Unsupported, reader.read,
+                      None, data)
+
+    def test_malformed_plist_raises(self):
+        data = "<plist><dict><key>name</key><string>Crypt</dict></plist>"
+        reader = phasetool.PartialPlistReader(phasetool.COLLECT_KEYS)
+        assert_raises(phasetool.ExpatError, reader.read, None, data)
+
+    def test_truncated_plist_raises(self):
+        path = os.path.join(self.pkgsinfo, "Crypt-1.0.0.pkginfo")
+        with open(path) as pkginfo_file:
+            data = pkginfo_file.read()
+        truncated = StringIO.StringIO(data[:-len("</dict>\n</plist>\n")])
+        reader = phasetool.PartialPlistReader(phasetool.COLLECT_KEYS)
+        assert_raises(phasetool.ExpatError, reader.read, truncated,
+                      truncated.read(8))
+
+
+class TestPlistCodecs(object):
+    """Test the interchangeable plist backends."""
+
+    def round_trip_fixtures(self, name):
+        codec = phasetool.PLIST_IO.codecs[name]
+        if not codec.is_available():
+            raise SkipTest("The {} plist backend is not installed.".format(
+                name))
+        fixtures = glob.glob("test/resources/repo/pkgsinfo/*.pkginfo")
+        fixtures += glob.glob("test/resources/repo/catalogs/*")
+        for path in fixtures:
+            with open(path, "rb") as fixture:
+                data = fixture.read()
+            assert_equal(data, codec.dumps(codec.loads(data)))
+        if codec.writes_binary:
+            plist = codec.loads(data)
+            binary = codec.dumps(plist, binary=True)
+            assert_true(binary.startswith(phasetool.BINARY_PLIST_HEADER))
+            assert_equal(plist, codec.loads(binary))
+
+    def test_stdlib_round_trip(self):
+        self.round_trip_fixtures("stdlib")
+
+    def test_foundation_round_trip(self):
+        self.round_trip_fixtures("foundation")
+
+    def test_biplist_round_trip(self):
+        self.round_trip_fixtures("biplist")
+
+    def test_binary_requires_a_binary_backend(self):
+        plist_io = phasetool.PlistIO([phasetool.PlistCodec()])
+        assert_raises(phasetool.PhasetoolError, plist_io.configure,
+                      binary_cache=True)
+        assert_raises(phasetool.PlistReadError, plist_io.loads,
+                      phasetool.BINARY_PLIST_HEADER + "\x00")
+
+
+class TestParseCache(object):
+    """Test the LRU cache of parsed plists."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.store = os.path.join(self.tempdir, "parse_cache.sqlite")
+        self.path = os.path.join(self.tempdir, "Crypt-0.7.2.pkginfo")
+        shutil.copy("test/resources/repo/pkgsinfo/Crypt-0.7.2.pkginfo",
+                    self.path)
+
+    def tearDown(self):
+        phasetool.PARSE_CACHE.configure(memory_bytes=0)
+        shutil.rmtree(self.tempdir)
+
+    def test_get_returns_copies(self):
+        cache = phasetool.ParseCache()
+        cache.configure()
+        cache.put("key", {"catalogs": ["phase1"]})
+        cache.get("key")["catalogs"].append("phase2")
+        assert_equal({"catalogs": ["phase1"]}, cache.get("key"))
+        assert_is_none(cache.get("other"))
+        assert_equal({"hits": 2, "misses": 1}, cache.stats)
+
+    def test_memory_lru_eviction(self):
+        cache = phasetool.ParseCache()
+        cache.configure(memory_bytes=200)
+        for key in ("a", "b", "c"):
+            cache.put(key, "x" * 80)
+            cache.get("a")
+        assert_list_equal(["c", "a"], cache._entries.keys())
+
+    def test_store_is_shared_and_trimmed(self):
+        cache = phasetool.ParseCache()
+        cache.configure(self.store, disk_bytes=200)
+        for key in ("a", "b", "c"):
+            cache.put(key, "x" * 80)
+        cache.close()
+
+        cache = phasetool.ParseCache()
+        cache.configure(self.store, disk_bytes=200)
+        assert_is_none(cache.get("a"))
+        assert_equal("x" * 80, cache.get("c"))
+        stats = cache.read_stats()
+        assert_equal((1, 1, 1, 2), (stats["hits"], stats["misses"],
+                                    stats["evictions"], stats["entries"]))
+
+    def test_read_plist_is_cached_until_changed(self):
+        phasetool.PARSE_CACHE.configure(self.store, disk_bytes=1024 * 1024)
+        with mock.patch("phasetool.PLIST_IO.loads",
+                        wraps=phasetool.PLIST_IO.loads) as mock_loads:
+            pkginfo = phasetool.read_plist(self.path)
+            pkginfo["name"] = "Changed"
+            assert_equal("Crypt", phasetool.read_plist(self.path)["name"])
+            assert_equal(1, mock_loads.call_count)
+            phasetool.mutate_pkginfos(
+                [self.path], lambda pkginfo: phasetool.set_catalog(
+                    "phase1", pkginfo))
+            assert_equal(1, mock_loads.call_count)
+            assert_equal(["phase1"],
+                         phasetool.read_plist(self.path)["catalogs"])
+            assert_equal(2, mock_loads.call_count)
+
+
+class TestPkginfoIndex(RepoFixture):
+    """Test the persistent pkginfo scan index."""
+
+    def setUp(self):
+        super(TestPkginfoIndex, self).setUp()
+        self.index = phasetool.PkginfoIndex(
+            os.path.join(self.tempdir, "index.sqlite"))
+
+    def test_matches_full_scan(self):
+        expected = sorted(phasetool.iter_testing_records(self.repo),
+                          key=lambda record: record.path)
+        result = sorted(
+            phasetool.iter_testing_records(self.repo, self.index),
+            key=lambda record: record.path)
+        assert_list_equal(expected, result)
+
+    @mock.patch("phasetool.read_pkginfo_summary",
+                wraps=phasetool.read_pkginfo_summary)
+    def test_only_changed_files_are_parsed(self, mock_read_plist):
+        list(self.index.update(self.repo))
+        mock_read_plist.reset_mock()
+        list(self.index.update(self.repo))
+        assert_false(mock_read_plist.called)
+
+        path = os.path.join(self.repo, "pkgsinfo", "Crypt-1.5.0.pkginfo")
+        with open(path, "a") as pkginfo_file:
+            pkginfo_file.write("\n")
+        list(self.index.update(self.repo))
+        mock_read_plist.assert_called_once_with(path)
+
+    def test_deleted_files_are_dropped(self):
+        path = os.path.join(self.repo, "pkgsinfo", "Crypt-1.5.0.pkginfo")
+        assert_in(path, dict(self.index.update(self.repo)))
+        os.remove(path)
+        assert_not_in(path, dict(self.index.update(self.repo)))
+
+
+class TestPkginfoModel(RepoFixture):
+    """Test the live pkginfo model used by serve."""
+
+    def setUp(self):
+        super(TestPkginfoModel, self).setUp()
+        self.model = phasetool.PkginfoModel(self.repo)
+        self.model.scan()
+        self.path = os.path.join(self.repo, "pkgsinfo", "Crypt-1.5.0.pkginfo")
+
+    def test_matches_full_scan(self):
+        expected = sorted(
+            (phasetool.make_record(path, summary) for path, summary in
+             phasetool.iter_pkginfo_summaries(self.repo)),
+            key=lambda record: record.path)
+        assert_list_equal(expected, sorted(self.model.records(),
+                                           key=lambda record: record.path))
+
+    @mock.patch("phasetool.read_pkginfo_summary",
+                wraps=phasetool.read_pkginfo_summary)
+    def test_refresh(self, mock_read_summary):
+        self.model.refresh([self.path])
+        assert_false(mock_read_summary.called)
+
+        pkginfo = phasetool.read_plist(self.path)
+        pkginfo["version"] = "1.5.1"
+        write_plist(pkginfo, self.path)
+        self.model.refresh([self.path])
+        mock_read_summary.assert_called_once_with(self.path)
+        records = {record.path: record for record in self.model.records()}
+        assert_equal("1.5.1", records[self.path].version)
+
+        os.remove(self.path)
+        self.model.refresh([self.path])
+        assert_not_in(self.path, [record.path for record in
+                                  self.model.records()])
+
+    def test_serve_collect(self):
+        socket_path = os.path.join(self.tempdir, "phasetool.sock")
+        output_path = os.path.join(self.tempdir, "output")
+        os.mkdir(output_path)
+        server = phasetool.PhasetoolServer(socket_path, self.model)
+        thread = threading.Thread(target=server.handle_request)
+        thread.start()
+        try:
+            status = phasetool.send_request(
+                socket_path, ["--socket", socket_path, "collect",
+                              output_path])
+        finally:
+            thread.join()
+            server.server_close()
+        assert_equal(0, status)
+        assert_equal(2, len(os.listdir(output_path)))
+
+    @mock.patch("sys.stderr")
+    def test_unreachable_socket_fails(self, _):
+        socket_path = os.path.join(self.tempdir, "missing.sock")
+        with mock.patch("sys.argv", ["phasetool", "--socket", socket_path,
+                                     "collect", self.tempdir]):
+            with assert_raises(SystemExit) as context:
+                phasetool.main()
+        assert_equal(1, context.exception.code)
+
+    def test_serve_rejects_local_options(self):
+        server = phasetool.PhasetoolServer(
+            os.path.join(self.tempdir, "phasetool.sock"), self.model)
+        try:
+            status, output = server.run(
+                ["--profile", "report.json", "collect", self.tempdir],
+                os.getcwd())
+        finally:
+            server.server_close()
+        assert_equal(1, status)
+        assert_in("--profile", output)
+        assert_false(glob.glob(os.path.join(self.tempdir, "*.md")))
+
+    def test_serve_captures_only_the_request(self):
+        server = phasetool.PhasetoolServer(
+            os.path.join(self.tempdir, "phasetool.sock"), self.model)
+        started = threading.Event()
+        printed = threading.Event()
+
+        def watcher():
+            started.wait()
+            print "watcher output"
+            printed.set()
+
+        def fake_query(_):
+            started.set()
+            printed.wait()
+            print "request output"
+
+        thread = threading.Thread(target=watcher)
+        thread.start()
+        try:
+            with mock.patch("phasetool.query", fake_query):
+                status, output = server.run(["query", "name == x"],
+                                            os.getcwd())
+        finally:
+            thread.join()
+            server.server_close()
+        assert_equal(0, status)
+        assert_equal(u"request output\n", output)
+
+
+class TestQuery(RepoFixture):
+    """Test query expressions and the query index."""
+
+    expressions = (
+        "catalogs contains testing",
+        "catalogs contains test",
+        "name startswith Cr and not version == 1.5.0",
+        "catalogs startswith phase or (name endswith pt and version >= 1.0)",
+        "version > 0.9 and version <= 1.5",
+        "version == 1.0",
+        "unattended_install == true",
+        "force_install_after_date < 2026-11-01",
+        "name == 'Placeholder'")
+
+    def setUp(self):
+        super(TestQuery, self).setUp()
+        self.index = phasetool.QueryIndex(
+            os.path.join(self.tempdir, "query.sqlite"))
+        self.pkginfos = {path: phasetool.read_plist(path) for path in
+                         phasetool.iter_pkginfo_paths(self.repo)}
+
+    def test_index_matches_parsed_pkginfos(self):
+        self.index.update(self.repo)
+        for text in self.expressions:
+            expression = phasetool.parse_query(text)
+            expected = sorted(path for path, pkginfo in
+                              self.pkginfos.items() if
+                              expression.matches(pkginfo))
+            assert_list_equal(expected,
+                              self.index.select(self.repo, expression))
+
+    def test_matches(self):
+        pkginfo = {"name": "Office", "catalogs": ["phase2", "testing"],
+                   "force_install_after_date": datetime.datetime(2026, 10, 1),
+                   "unattended_install": False}
+        expression = phasetool.parse_query(
+            "catalogs contains phase2 and name startswith Office and "
+            "force_install_after_date < 2026-11-01")
+        assert_true(expression.matches(pkginfo))
+        for text in ("catalogs contains phase", "unattended_install == yes",
+                     "version == 1.0", "not name != Office"):
+            assert_equal(text == "not name != Office",
+                         phasetool.parse_query(text).matches(pkginfo))
+
+    def test_invalid_expressions(self):
+        for text in ("name ==", "(name == Crypt", "name == Crypt and",
+                     "name = Crypt", "name == Crypt version == 1"):
+            assert_raises(phasetool.QueryError, phasetool.parse_query, text)
+
+    @mock.patch("phasetool.parse_pkginfo_attributes",
+                wraps=phasetool.parse_pkginfo_attributes)
+    def test_only_changed_files_are_parsed(self, mock_parse):
+        self.index.update(self.repo)
+        mock_parse.reset_mock()
+        path = os.path.join(self.repo, "pkgsinfo", "Crypt-1.5.0.pkginfo")
+        phasetool.set_catalog("development", self.pkginfos[path])
+        write_plist(self.pkginfos[path], path)
+        self.index.update(self.repo)
+        mock_parse.assert_called_once_with(path)
+        assert_list_equal([path], self.index.select(
+            self.repo, phasetool.parse_query("catalogs contains development")))
+
+    def test_where_selects_paths(self):
+        args = MockArgs(self.repo, None)
+        args.cache_dir = self.tempdir
+        args.jobs = 1
+        args.where = "version startswith 0."
+        args.pkginfo = [os.path.join(self.repo, "pkgsinfo", filename) for
+                        filename in ("Crypt-0.8.0.pkginfo",
+                                     "Crypt-1.0.0.pkginfo")]
+        assert_list_equal(args.pkginfo[:1],
+                          phasetool.get_selected_paths(args))
+        args.pkginfo = []
+        assert_equal(3, len(phasetool.get_selected_paths(args)))
+
+
+class TestProfiler(object):
+    """Test the per-stage profiler."""
+
+    def setUp(self):
+        self.profiler = phasetool.Profiler()
+
+    def test_disabled_profiler_records_nothing(self):
+        with self.profiler.stage("walk"):
+            pass
+        with self.profiler.file("parse", "/test/1.pkginfo") as record:
+            record.bytes_read = 10
+        assert_equal({}, self.profiler.stages)
+        assert_list_equal([], self.profiler.slowest)
+
+    def test_profiler(self):
+        self.profiler.enable(slowest_count=2)
+        with self.profiler.stage("scan"):
+            items = list(self.profiler.iter_stage("walk", range(3)))
+        assert_list_equal(range(3), items)
+        for number, seconds in enumerate((0.3, 0.1, 0.2)):
+            self.profiler.record_file("parse", "/test/{}.pkginfo".format(
+                number), seconds, bytes_read=100)
+        with self.profiler.file("write output", "/test/out.md") as record:
+            record.bytes_written = 5
+
+        report = self.profiler.get_report()
+        assert_list_equal(["scan", "walk", "parse", "write output"],
+                          report["stages"].keys())
+        assert_equal(4, report["stages"]["walk"]["calls"])
+        assert_equal(3, report["stages"]["parse"]["files"])
+        assert_equal(300, report["stages"]["parse"]["bytes_read"])
+        assert_equal(5, report["stages"]["write output"]["bytes_written"])
+        assert_list_equal(["/test/0.pkginfo", "/test/2.pkginfo"],
+                          [entry["path"] for entry in
+                           report["slowest_files"]])
+
+
 class TestMDOutput(object):
 
     def setUp(self):
@@ -180,16 +822,31 @@ class TestMDOutput(object):
                                              "version": "0.0.3"}}
         self.test_output_path = "/test/phase_testing.md"
         self.expected_result = ("## November Phase Testing Updates\n\n"
-                           "- Wicked Fancy 0.0.1\n"
-                           "- a fancy 0.0.2\n"
-                           u"- \U0001F49A 0.0.3\n"
-                           "- z fancy 0.0.3").encode("utf-8")
+                                "## Schedule\n"
+                                "| Phase | Available | Required |\n"
+                                "| ----- | --------- | -------- |\n"
+                                "| Phase 1 | 2015-11-02 | 2015-11-05 |\n"
+                                "| Phase 2 | 2015-11-08 | 2015-11-12 |\n"
+                                "| Phase 3 | 2015-11-15 | 2015-11-19 |\n"
+                                "| Production | 2015-11-22 | 2015-11-27 |\n"
+                                "\n"
+                                "- Wicked Fancy 0.0.1\n"
+                                "- a fancy 0.0.2\n"
+                                u"- \U0001F49A 0.0.3\n"
+                                "- z fancy 0.0.3").encode("utf-8")
 
-    @mock.patch("phasetool.write_file", )
-    def test_write_path_list(self, mock_write_file):
-        phasetool.write_markdown(self.pkginfos, self.test_output_path)
-        assert_equal(self.expected_result, mock_write_file.call_args[0][0])
-        assert_equal(self.test_output_path, mock_write_file.call_args[0][1])
+    @mock.patch("phasetool.datetime", wraps=datetime)
+    @mock.patch("phasetool.write_lines", )
+    def test_write_path_list(self, mock_write_lines, mock_datetime):
+        mock_datetime.datetime.now.return_value = datetime.datetime(
+            2015, 11, 2)
+        mock_datetime.date.today.return_value = datetime.date(2015, 11, 2)
+        records = sorted((phasetool.make_record(path, summary) for
+                          path, summary in self.pkginfos.items()),
+                         key=lambda record: record.path)
+        phasetool.write_markdown(records, self.test_output_path)
+        assert_equal(self.expected_result, join_lines(mock_write_lines))
+        assert_equal(self.test_output_path, mock_write_lines.call_args[0][1])
 
 
 class TestPathOutput(object):
@@ -199,28 +856,410 @@ class TestPathOutput(object):
         self.test_output_path = "/test/phase_testing_files.txt"
 
     def run_write_file_list(self):
-        test_data = {self.test_path: None}
+        test_data = [phasetool.make_record(self.test_path, {})]
         phasetool.write_path_list(test_data, self.test_output_path)
 
-    @mock.patch("phasetool.write_file", )
-    def test_write_path_list(self, mock_write_file):
+    @mock.patch("phasetool.write_lines", )
+    def test_write_path_list(self, mock_write_lines):
         self.run_write_file_list()
-        assert_equal(self.test_path, mock_write_file.call_args[0][0])
-        assert_equal(self.test_output_path, mock_write_file.call_args[0][1])
+        assert_equal(self.test_path, join_lines(mock_write_lines))
+        assert_equal(self.test_output_path, mock_write_lines.call_args[0][1])
 
-    @mock.patch("phasetool.write_file", )
-    def test_write_unicode_path_list(self, mock_write_file):
+    @mock.patch("phasetool.write_lines", )
+    def test_write_unicode_path_list(self, mock_write_lines):
         self.test_path += u"\U0001F49A\n"
         self.run_write_file_list()
         expected = self.test_path.encode("utf-8")
-        assert_equal(expected, mock_write_file.call_args[0][0])
+        assert_equal(expected, join_lines(mock_write_lines))
+
+
+class TestWriteLines(object):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_write_lines(self):
+        path = os.path.join(self.tempdir, "output.txt")
+        lines = (line for line in (u"first", u"\U0001F49A", u"last"))
+        phasetool.write_lines(lines, path)
+        with open(path) as output_file:
+            assert_equal(u"first\n\U0001F49A\nlast".encode("utf-8"),
+                         output_file.read())
+
+
+class TestMutatePkginfos(object):
+    """Test the batched pkginfo mutation engine."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.paths = []
+        for version in ("0.8.0", "0.9.0", "1.0.0"):
+            path = os.path.join(self.tempdir,
+                                "Crypt-{}.pkginfo".format(version))
+            shutil.copy("test/resources/repo/pkgsinfo/Crypt-0.7.2.pkginfo",
+                        path)
+            self.paths.append(path)
+        self.corrupt = os.path.join(self.tempdir, "Corrupt.pkginfo")
+        with open(self.corrupt, "w") as corrupt_file:
+            corrupt_file.write("<plist><dict>")
+        self.missing = os.path.join(self.tempdir, "Missing.pkginfo")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_mutate_pkginfos(self):
+        def mutator(pkginfo):
+            phasetool.set_catalog("phase2", pkginfo)
+            return True
+
+        paths = self.paths + [self.corrupt, self.missing]
+        summary = phasetool.mutate_pkginfos(paths, mutator, jobs=4)
+        assert_list_equal(self.paths, summary.results["changed"])
+        assert_list_equal([self.missing], summary.results["missing"])
+        assert_list_equal([self.corrupt], summary.results["failed"])
+        assert_in(self.corrupt, summary.errors)
+        for path in self.paths:
+            assert_list_equal(["phase2"],
+                              phasetool.read_plist(path)["catalogs"])
+
+    @mock.patch("phasetool.PkginfoWriter.stage")
+    def test_unchanged_pkginfos_are_not_written(self, mock_stage):
+        summary = phasetool.mutate_pkginfos(self.paths, lambda _: False)
+        assert_list_equal(self.paths, summary.results["unchanged"])
+        assert_false(mock_stage.called)
+
+    def test_writes_leave_no_temp_files_or_journal(self):
+        journal_dir = os.path.join(self.tempdir, "journal")
+        phasetool.mutate_pkginfos(
+            self.paths, lambda pkginfo: phasetool.set_catalog(
+                "phase3", pkginfo), journal_dir=journal_dir)
+        expected = [os.path.basename(path) for path in
+                    self.paths + [self.corrupt, journal_dir]]
+        assert_list_equal(sorted(expected), sorted(os.listdir(self.tempdir)))
+        assert_list_equal([], os.listdir(journal_dir))
+
+    def test_validate(self):
+        no_version = os.path.join(self.tempdir, "NoVersion.pkginfo")
+        write_plist({"name": "Crypt", "catalogs": "x"}, no_version)
+        journal_dir = os.path.join(self.tempdir, "journal")
+        before = sorted(os.listdir(self.tempdir))
+        paths = self.paths + [self.corrupt, self.missing, no_version]
+        with mock.patch("phasetool.PkginfoWriter.commit") as mock_commit:
+            summary = phasetool.mutate_pkginfos(
+                paths, lambda pkginfo: phasetool.set_catalog(
+                    "phase3", pkginfo), jobs=4, journal_dir=journal_dir,
+                validate=True)
+        assert_true(summary.aborted)
+        assert_false(mock_commit.called)
+        assert_list_equal(self.paths, summary.results["changed"])
+        assert_list_equal([self.missing], summary.results["missing"])
+        assert_list_equal([no_version], summary.results["invalid"])
+        assert_list_equal([self.corrupt], summary.results["failed"])
+        assert_equal("Missing version; catalogs is not a list of strings",
+                     summary.errors[no_version])
+        # Staged writes and the journal are gone.
+        assert_list_equal(before + ["journal"],
+                          sorted(os.listdir(self.tempdir)))
+        assert_list_equal([], os.listdir(journal_dir))
+
+    @mock.patch("phasetool.read_plist", wraps=phasetool.read_plist)
+    def test_invalid_batch_changes_nothing(self, _):
+        args = MockArgs(self.tempdir, None)
+        args.jobs = 2
+        args.cache_dir = self.tempdir
+        args.update_catalogs = False
+        before = [os.stat(path).st_mtime for path in self.paths]
+        with mock.patch("sys.stdout"):
+            assert_raises(SystemExit, phasetool.run_mutation, args,
+                          self.paths + [self.missing], lambda _: True)
+        for path in self.paths:
+            assert_list_equal(["production"],
+                              phasetool.read_plist(path)["catalogs"])
+        assert_list_equal(before, [os.stat(path).st_mtime for path in
+                                   self.paths])
+
+    def test_pkginfos_are_read_once(self):
+        args = MockArgs(self.tempdir, None)
+        args.jobs = 1
+        args.cache_dir = self.tempdir
+        args.update_catalogs = False
+        size = sum(os.path.getsize(path) for path in self.paths)
+        profiler = phasetool.Profiler()
+        profiler.enable()
+        with mock.patch("phasetool.PROFILER", profiler), \
+                mock.patch("sys.stdout"):
+            phasetool.run_mutation(args, self.paths, lambda pkginfo:
+                                   phasetool.set_catalog("phase1", pkginfo))
+        stages = profiler.get_report()["stages"]
+        assert_equal(len(self.paths), stages["read pkginfo"]["files"])
+        assert_equal(size, stages["read pkginfo"]["bytes_read"])
+        assert_not_in("validate", stages)
+
+    @mock.patch("phasetool.PkginfoWriter.commit")
+    @mock.patch("phasetool.PkginfoWriter.stage")
+    def test_dry_run_diffs_without_writing(self, mock_stage, mock_commit):
+        before = [os.stat(path).st_mtime for path in self.paths]
+        summary = phasetool.mutate_pkginfos(
+            self.paths, lambda pkginfo: phasetool.set_catalog(
+                "phase3", pkginfo), journal_dir=self.missing, dry_run=True)
+        assert_list_equal(self.paths, summary.results["changed"])
+        assert_list_equal(self.paths, summary.diffs.keys())
+        assert_false(mock_stage.called or mock_commit.called)
+        assert_false(os.path.exists(self.missing))
+        assert_list_equal(before, [os.stat(path).st_mtime for path in
+                                   self.paths])
+        diff = summary.diffs[self.paths[0]]
+        assert_list_equal(
+            ["--- " + self.paths[0], "+++ " + self.paths[0],
+             "@@ catalogs @@", " <array>", "-\t<string>production</string>",
+             "+\t<string>phase3</string>", " </array>"], diff)
+
+    def test_diff_pkginfos(self):
+        diff = phasetool.diff_pkginfos(
+            "test.pkginfo", {"name": "Crypt", "unattended_install": True},
+            {"name": "Crypt", "force_install_after_date": "x"})
+        assert_list_equal(
+            ["--- test.pkginfo", "+++ test.pkginfo",
+             "@@ force_install_after_date @@", "+<string>x</string>",
+             "@@ unattended_install @@", "-<true/>"], diff)
+
+
+class TestUpdateCatalogs(RepoFixture):
+    """Test patching catalogs in place after a mutation."""
+
+    def setUp(self):
+        super(TestUpdateCatalogs, self).setUp()
+        self.path = os.path.join(self.repo, "pkgsinfo", "Crypt-1.5.0.pkginfo")
+
+    def read_catalog(self, catalog):
+        return phasetool.read_plist(
+            os.path.join(self.repo, "catalogs", catalog))
+
+    def test_update_catalogs(self):
+        def mutator(pkginfo):
+            phasetool.set_unattended_install(True, pkginfo)
+            return phasetool.set_catalog("production", pkginfo)
+
+        summary = phasetool.mutate_pkginfos([self.path], mutator,
+                                            keep_changes=True)
+        updated = phasetool.update_catalogs(self.repo, summary.changes)
+        assert_list_equal(["all", "production", "testing"], updated)
+
+        expected = phasetool.make_catalog_entry(
+            phasetool.read_plist(self.path))
+        assert_list_equal([], self.read_catalog("testing"))
+        production = self.read_catalog("production")
+        assert_equal(2, len(production))
+        assert_equal(expected, production[-1])
+        assert_not_in("notes", production[-1])
+        assert_false(any(key.startswith("_") for key in production[-1]))
+        all_catalog = self.read_catalog("all")
+        assert_equal(5, len(all_catalog))
+        assert_equal(expected, all_catalog[-1])
+        # Catalogs the item never belonged to are left alone.
+        with open(os.path.join(self.repo, "catalogs", "phase1")) as catalog:
+            with open("test/resources/repo/catalogs/phase1") as fixture:
+                assert_equal(fixture.read(), catalog.read())
+
+
+class TestMutationJournal(object):
+    """Test recovering an interrupted batch of writes."""
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.journal_dir = os.path.join(self.tempdir, "journal")
+        self.path = os.path.join(self.tempdir, "Crypt-0.7.2.pkginfo")
+        shutil.copy("test/resources/repo/pkgsinfo/Crypt-0.7.2.pkginfo",
+                    self.path)
+        with open(self.path) as pkginfo_file:
+            self.original = pkginfo_file.read()
+        # Stage a change, but "crash" before committing it.
+        writer = phasetool.PkginfoWriter([self.path], self.journal_dir)
+        pkginfo = phasetool.read_plist(self.path)
+        phasetool.set_catalog("phase1", pkginfo)
+        writer.stage(pkginfo, self.path, self.original)
+        self.journal = phasetool.MutationJournal.list(self.journal_dir)[0]
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_interrupted_batch_leaves_original(self):
+        with open(self.path) as pkginfo_file:
+            assert_equal(self.original, pkginfo_file.read())
+        assert_list_equal([self.path], self.journal.paths)
+
+    def test_resume(self):
+        assert_equal({}, self.journal.resume())
+        assert_list_equal(["phase1"],
+                          phasetool.read_plist(self.path)["catalogs"])
+        assert_list_equal(["Crypt-0.7.2.pkginfo", "journal"],
+                          sorted(os.listdir(self.tempdir)))
+        assert_list_equal([], os.listdir(self.journal_dir))
+
+    def test_resume_reports_lost_write(self):
+        os.remove(phasetool.get_temp_path(self.path, self.journal.journal_id))
+        errors = self.journal.resume()
+        assert_list_equal([self.path], errors.keys())
+        assert_true(os.path.isdir(self.journal.path))
+
+    def test_relative_paths_resolve_from_any_dir(self):
+        cwd = os.getcwd()
+        os.chdir(self.tempdir)
+        try:
+            writer = phasetool.PkginfoWriter(
+                ["Crypt-0.7.2.pkginfo"],
+                os.path.join(self.tempdir, "relative_journal"))
+        finally:
+            os.chdir(cwd)
+        journal = phasetool.MutationJournal(writer.journal.path)
+        assert_list_equal([self.path], journal.paths)
+        writer.stage({"name": "Crypt"}, self.path, self.original)
+        assert_equal({}, journal.rollback())
+        with open(self.path) as pkginfo_file:
+            assert_equal(self.original, pkginfo_file.read())
+
+    def test_batches_in_one_process_get_their_own_journal(self):
+        # self.journal was left behind; a second batch in the same
+        # second must not collide with it.
+        writer = phasetool.PkginfoWriter([self.path], self.journal_dir)
+        assert_not_equal(self.journal.journal_id, writer.batch_id)
+        assert_equal(2, len(os.listdir(self.journal_dir)))
+
+    def test_rollback(self):
+        # Simulate the crash happening after the rename.
+        phasetool.commit_directory((self.tempdir, [(
+            self.path, phasetool.get_temp_path(
+                self.path, self.journal.journal_id))]))
+        assert_equal({}, self.journal.rollback())
+        with open(self.path) as pkginfo_file:
+            assert_equal(self.original, pkginfo_file.read())
+        assert_list_equal([], os.listdir(self.journal_dir))
+
+
+class TestBulkEdits(object):
+    """Test compiling and applying bulk edit specs."""
+
+    def test_parse_typed_value(self):
+        values = {"Plain": "Plain", "http://example.com": "http://example.com",
+                  "string:int:5": "int:5", "bool:false": False,
+                  "bool:YES": True, "int:5": 5, "real:1.5": 1.5,
+                  "date:2011-08-03T13:00:00Z":
+                      datetime.datetime(2011, 8, 3, 13, 0, 0),
+                  "list:a,b": ["a", "b"], "list:": [],
+                  'list:["a", 1]': ["a", 1], 'dict:{"a": [1]}': {"a": [1]}}
+        for text, expected in values.items():
+            assert_equal(expected, phasetool.parse_typed_value(text))
+        for text in ("bool:maybe", "int:five", "date:soon", "dict:[]",
+                     "list:[1"):
+            assert_raises(ValueError, phasetool.parse_typed_value, text)
+
+    def test_compile_edits(self):
+        pkginfo = {"name": "Crypt", "catalogs": ["testing"],
+                   "developer": "Someone", "icon_name": "Crypt.png"}
+        edits = phasetool.compile_edits(
+            [{"set": {"developer": "Crypt Devs"}, "remove": ["icon_name"]},
+             {"if": "catalogs contains production",
+              "set": {"unattended_install": True}}],
+            "name == Crypt")
+        for condition, operations in edits:
+            if condition.matches(pkginfo):
+                for operation in operations:
+                    operation(pkginfo)
+        assert_equal({"name": "Crypt", "catalogs": ["testing"],
+                      "developer": "Crypt Devs"}, pkginfo)
+
+    def test_check_edit_spec(self):
+        assert_is_none(phasetool.check_edit_spec(
+            [{"set": {"developer": "Crypt Devs"}, "remove": ["icon_name"],
+              "if": "name == Crypt"}]))
+        assert_equal("Not a list of edit groups",
+                     phasetool.check_edit_spec({"set": {"a": "b"}}))
+        assert_equal(
+            "group 0 is not a dictionary; group 1 has unknown keys unset; "
+            "group 1 remove is not a list of strings",
+            phasetool.check_edit_spec(["set", {"unset": ["a"],
+                                               "remove": "a"}]))
+
+    def test_malformed_spec_exits(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            spec = os.path.join(tempdir, "spec.plist")
+            write_plist({"set": {"developer": "Crypt Devs"}}, spec)
+            args = phasetool.build_argparser().parse_args(
+                ["bulk", "--spec", spec, "a.pkginfo"])
+            with mock.patch("sys.stdout"):
+                assert_raises(SystemExit, phasetool.get_bulk_edits, args)
+        finally:
+            shutil.rmtree(tempdir)
+
+
+class TestScheduler(RepoFixture):
+    """Test the rolling phase schedule."""
+
+    def setUp(self):
+        super(TestScheduler, self).setUp()
+        self.schedule = scheduler.Schedule(
+            os.path.join(self.tempdir, "schedule.sqlite"))
+        self.start = datetime.date(2026, 10, 1)
+
+    def test_due(self):
+        self.schedule.add("/repo", ["a.pkginfo", "b.pkginfo"], self.start)
+        self.schedule.add("/other", ["a.pkginfo"], datetime.date(2026, 9, 1))
+        assert_list_equal([], self.schedule.due("/repo",
+                                                datetime.date(2026, 9, 30)))
+        transitions = self.schedule.due("/repo", self.start)
+        assert_list_equal(
+            [scheduler.Transition("a.pkginfo", self.start, 0),
+             scheduler.Transition("b.pkginfo", self.start, 0)], transitions)
+
+        self.schedule.advance("/repo", transitions[:1])
+        # b missed phases 1 and 2, so moves straight to phase 3.
+        assert_list_equal(
+            [scheduler.Transition("b.pkginfo", self.start, 2),
+             scheduler.Transition("a.pkginfo", self.start, 2)],
+            self.schedule.due("/repo", datetime.date(2026, 10, 15)))
+        self.schedule.advance("/repo", [
+            scheduler.Transition("a.pkginfo", self.start, 3)])
+        assert_list_equal(["b.pkginfo"], [
+            entry.relpath for entry in self.schedule.entries("/repo")])
+
+    def test_get_required_date(self):
+        assert_equal(datetime.datetime(2026, 10, 11, 13),
+                     scheduler.get_required_date(self.start, 1))
+
+    def test_tick(self):
+        path = os.path.join(self.repo, "pkgsinfo/Crypt-0.7.2.pkginfo")
+        missing = os.path.join(self.repo, "pkgsinfo/Missing.pkginfo")
+        repo_key = os.path.abspath(self.repo)
+        self.schedule.add(repo_key, [os.path.relpath(path, self.repo),
+                                     os.path.relpath(missing, self.repo)],
+                          self.start)
+        args = MockArgs(self.repo, None)
+        args.jobs = 2
+        args.cache_dir = self.tempdir
+        args.update_catalogs = False
+        for day, catalog, force_date, unattended in (
+                (datetime.date(2026, 10, 8), "phase2",
+                 datetime.datetime(2026, 10, 11, 13), False),
+                (datetime.date(2026, 11, 1), "production",
+                 datetime.datetime(2026, 10, 26, 13), True)):
+            args.date = str(day)
+            phasetool.tick_schedule(args, self.schedule, repo_key)
+            pkginfo = phasetool.read_plist(path)
+            assert_equal([catalog], pkginfo["catalogs"])
+            assert_equal(force_date, pkginfo["force_install_after_date"])
+            assert_equal(unattended, pkginfo["unattended_install"])
+        assert_list_equal([], self.schedule.entries(repo_key))
 
 
 class TestPrepareUnits(object):
     """Test the phasetool prepare units."""
 
     def setUp(self):
-        self.test_plist = phasetool.plistlib.readPlist(
+        self.test_plist = phasetool.read_plist(
             "test/resources/repo/pkgsinfo/Crypt-0.7.2.pkginfo")
         self.test_date = "2011-08-03T13:00:00Z"
         self.test_datetime = datetime.datetime.strptime(
@@ -248,3 +1287,70 @@ class TestPrepareUnits(object):
         phasetool.set_catalog("production", self.test_plist)
         assert_list_equal(self.test_plist["catalogs"], ["production"])
 
+
+class TestStartup(RepoFixture):
+    """Keep phasetool's startup cheap for cron and automation."""
+
+    # Seconds; generous, as this guards against heavy imports creeping
+    # back in rather than measuring.
+    budget = 1.0
+    optional_modules = ("FoundationPlist", "mount_shares_better",
+                        "multiprocessing", "pyinotify", "socket",
+                        "SocketServer", "sqlite3")
+
+    def run_phasetool(self, args):
+        """Run phasetool in a fresh interpreter.
+
+        Returns:
+            Tuple of seconds taken and the optional modules imported.
+        """
+        script = (
+            "import sys\n"
+            "import phasetool\n"
+            "sys.argv = ['phasetool'] + {!r}\n"
+            "try:\n"
+            "    phasetool.main()\n"
+            "except SystemExit:\n"
+            "    pass\n"
+            "sys.stderr.write(repr(sorted(set({!r}) & set(sys.modules))))\n"
+            ).format(args, self.optional_modules)
+        start = time.time()
+        process = subprocess.Popen([sys.executable, "-c", script],
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        _, stderr = process.communicate()
+        return time.time() - start, stderr.splitlines()[-1]
+
+    def test_help(self):
+        seconds, modules = self.run_phasetool(["--help"])
+        assert_equal("[]", modules)
+        assert_less(seconds, self.budget)
+
+    def test_bulk(self):
+        path = os.path.join(self.repo, "pkgsinfo", "Crypt-1.0.0.pkginfo")
+        seconds, modules = self.run_phasetool(
+            ["--repo", self.repo, "--cache-dir", self.tempdir, "bulk",
+             "developer", "Example", path])
+        assert_equal("[]", modules)
+        assert_less(seconds, self.budget)
+        assert_equal("Example", phasetool.read_plist(path)["developer"])
+
+    def test_collect(self):
+        seconds, modules = self.run_phasetool(
+            ["--repo", self.repo, "--cache-dir", self.tempdir, "collect",
+             self.tempdir])
+        assert_equal("[]", modules)
+        assert_less(seconds, self.budget)
+        assert_equal(2, len(glob.glob(
+            os.path.join(self.tempdir, "*-phase_testing*"))))
+
+
+def join_lines(mock_write_lines):
+    """Return the output a mocked write_lines call would have written."""
+    return u"\n".join(mock_write_lines.call_args[0][0]).encode("utf-8")
+
+
+def write_plist(plist, path):
+    """Write plist to path with phasetool's configured backend."""
+    with open(path, "wb") as plist_file:
+        plist_file.write(phasetool.PLIST_IO.dumps(plist))